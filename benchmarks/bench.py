@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+    Throughput benchmark for the docx builder.
+
+    Generate a synthetic corpus (see corpus.py), build it with the working
+    tree's docx builder in a fresh process and report pages/sec, nodes/sec,
+    output bytes and peak RSS::
+
+        $ python benchmarks/bench.py -n 100 -m 30 --save base.json
+        ... change writer.py or docx/docx.py ...
+        $ python benchmarks/bench.py -n 100 -m 30 --compare base.json
+
+    The result file is a stable JSON document (see RESULT_FORMAT) holding
+    the corpus options, the environment and the best of --repeat runs.
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import zipfile
+import platform
+import optparse
+import tempfile
+import subprocess
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import corpus
+
+RESULT_FORMAT = 1
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+
+#: words of body text counted as one page when estimating page count.
+WORDS_PER_PAGE = 500
+
+#: metrics shown by report/compare, and whether bigger is better.
+METRICS = [
+    ('pages', None),
+    ('nodes', None),
+    ('build_time', False),
+    ('write_time', False),
+    ('pages_per_sec', True),
+    ('nodes_per_sec', True),
+    ('output_bytes', False),
+    ('peak_rss_kb', False),
+]
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def count_pages(docxfile):
+    """Estimate the page count of a docx file.
+
+    Word lays pages out at display time, so take the larger of explicit
+    page breaks + 1 and body words / WORDS_PER_PAGE.
+    """
+    z = zipfile.ZipFile(docxfile)
+    try:
+        xml = z.read('word/document.xml').decode('utf-8')
+    finally:
+        z.close()
+    # namespace prefixes vary (w: or ns0:), match any
+    breaks = len(re.findall(r'<(?:\w+:)?br\s[^>]*type="page"', xml))
+    texts = re.findall(r'<(?:\w+:)?t(?:\s[^>]*)?>([^<]*)<', xml)
+    words = sum(len(t.split()) for t in texts)
+    return max(breaks + 1, words // WORDS_PER_PAGE)
+
+
+def build_once(srcdir, outdir):
+    """Build `srcdir` with the docx builder in this process.
+
+    Run by the child process, return the measured values as a dict.
+    """
+    from sphinx.application import Sphinx
+
+    doctreedir = os.path.join(outdir, '.doctrees')
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        start = timer()
+        app = Sphinx(srcdir, srcdir, outdir, doctreedir, 'docx', {},
+                     devnull, sys.stderr, True)
+        app.build(force_all=True)
+        build_time = timer() - start
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+    nodes = 0
+    for docname in app.env.all_docs:
+        nodes += len(list(app.env.get_doctree(docname).traverse()))
+
+    outputs = [os.path.join(outdir, f) for f in os.listdir(outdir)
+               if f.endswith('.docx')]
+    phases = {}
+    statsfile = os.path.join(outdir, 'docx_stats.json')
+    if os.path.exists(statsfile):
+        for phase in json.load(open(statsfile))['phases']:
+            phases[phase['name']] = phase['wall']
+    # the docx builder's own work: top level phases of DocxBuilder.write
+    write_time = sum(t for n, t in phases.items() if '/' not in n)
+
+    return {
+        'build_time': build_time,
+        'write_time': write_time or build_time,
+        'nodes': nodes,
+        'pages': sum(count_pages(f) for f in outputs),
+        'output_bytes': sum(os.path.getsize(f) for f in outputs),
+        'peak_rss_kb': peak_rss(),
+        'phases': phases,
+    }
+
+
+def run_child(srcdir, outdir):
+    """Build in a fresh interpreter so that peak RSS belongs to one run."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC_DIR, BENCH_DIR] + filter(None, [env.get('PYTHONPATH')]))
+    resultfile = os.path.join(outdir, 'bench-result.json')
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           srcdir, outdir, resultfile]
+    if subprocess.call(cmd, env=env) != 0:
+        raise RuntimeError('benchmark build failed: %s' % ' '.join(cmd))
+    return json.load(open(resultfile))
+
+
+def best_of(runs):
+    """Combine runs: fastest times, the rest from that run."""
+    best = min(runs, key=lambda r: r['write_time'])
+    result = dict(best)
+    result['build_time'] = min(r['build_time'] for r in runs)
+    result['pages_per_sec'] = result['pages'] / result['write_time']
+    result['nodes_per_sec'] = result['nodes'] / result['write_time']
+    return result
+
+
+def run(opts, repeat=3, workdir=None):
+    workdir = workdir or tempfile.mkdtemp(prefix='docx-bench-')
+    try:
+        srcdir = os.path.join(workdir, 'source')
+        corpus.generate(srcdir, opts)
+        runs = []
+        for i in range(repeat):
+            outdir = os.path.join(workdir, 'out%d' % i)
+            runs.append(run_child(srcdir, outdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import sphinx
+    return {
+        'format': RESULT_FORMAT,
+        'corpus': opts.todict(),
+        'repeat': repeat,
+        'environment': {
+            'python': platform.python_version(),
+            'sphinx': sphinx.__version__,
+            'platform': platform.platform(),
+        },
+        'results': best_of(runs),
+    }
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
+
+
+def report(result, baseline=None):
+    lines = []
+    if baseline is None:
+        for name, better in METRICS:
+            lines.append('%-16s %14s' % (
+                name, format_value(result['results'].get(name))))
+        return lines
+
+    if baseline['corpus'] != result['corpus']:
+        lines.append('WARNING: baseline was measured on a different corpus')
+    lines.append('%-16s %14s %14s %9s' % (
+        'metric', 'baseline', 'current', 'change'))
+    for name, better in METRICS:
+        old = baseline['results'].get(name)
+        new = result['results'].get(name)
+        change = ''
+        if old and new is not None:
+            delta = (new - old) * 100.0 / old
+            change = '%+.1f%%' % delta
+            if better is not None and abs(delta) >= 5:
+                improved = (delta > 0) == better
+                change += improved and ' +' or ' -'
+        lines.append('%-16s %14s %14s %9s' % (
+            name, format_value(old), format_value(new), change))
+    return lines
+
+
+def main(argv=sys.argv):
+    if len(argv) == 5 and argv[1] == '--child':
+        result = build_once(argv[2], argv[3])
+        f = open(argv[4], 'w')
+        try:
+            json.dump(result, f)
+        finally:
+            f.close()
+        return 0
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    corpus.add_options(parser)
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='number of builds, best one is kept [%default]')
+    parser.add_option('--save', metavar='FILE',
+                      help='write the result as JSON to FILE')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the result with a saved JSON FILE')
+    values, args = parser.parse_args(argv[1:])
+    opts = corpus.options_from(values)
+
+    result = run(opts, values.repeat)
+    baseline = None
+    if values.compare:
+        baseline = json.load(open(values.compare))
+        if baseline.get('format') != RESULT_FORMAT:
+            parser.error('unsupported baseline format in %s' % values.compare)
+    for line in report(result, baseline):
+        print line
+    if values.save:
+        f = open(values.save, 'w')
+        try:
+            json.dump(result, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
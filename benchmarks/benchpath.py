@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+    Path setup of the benchmark scripts that import the extension modules.
+
+    Importing this module puts the extension directory on sys.path, so the
+    scripts import it first and then the extension modules, as the tests
+    do with tests/helpers.py.
+"""
+
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src',
+                           'sphinxcontrib-docxbuilder')
+
+if PACKAGE_DIR not in sys.path:
+    sys.path.insert(0, PACKAGE_DIR)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    Synthetic Sphinx project generator for docx builder benchmarks.
+
+    Generate a project with N files of M paragraphs each, plus bullet and
+    numbered lists, tables, literal blocks and images::
+
+        $ python benchmarks/corpus.py --files 50 --paragraphs 40 /tmp/corpus
+
+    The output only depends on the options, so two runs with the same
+    options produce the same project.
+"""
+
+import os
+import sys
+import zlib
+import struct
+import random
+import optparse
+
+
+WORDS = (
+    'sphinx docutils document builder paragraph section table image list '
+    'literal block template style heading relationship archive compress '
+    'translate render measure throughput memory output value result page '
+    'node element run text format option module package function class'
+).split()
+
+CONF_PY = '''\
+# -*- coding: utf-8 -*-
+# Generated by benchmarks/corpus.py
+extensions = ['sphinxcontrib-docxbuilder']
+source_suffix = '.rst'
+master_doc = 'index'
+project = u'corpus'
+copyright = u'benchmark'
+version = '1.0'
+release = '1.0'
+exclude_patterns = ['_build']
+'''
+
+
+class CorpusOptions(object):
+    """Size of a generated corpus.  Counts except files/paragraphs are per
+    file."""
+
+    def __init__(self, files=20, paragraphs=20, lists=2, tables=1,
+                 literals=2, images=1, unique_images=4, image_size=(320, 240),
+                 seed=0):
+        self.files = files
+        self.paragraphs = paragraphs
+        self.lists = lists
+        self.tables = tables
+        self.literals = literals
+        self.images = images
+        self.unique_images = unique_images
+        self.image_size = tuple(image_size)
+        self.seed = seed
+
+    def todict(self):
+        return dict(self.__dict__, image_size=list(self.image_size))
+
+
+def png(width, height, seed):
+    """Return bytes of an RGB PNG image with a seed dependent pattern."""
+    rows = []
+    for y in range(height):
+        row = bytearray([0])  # filter type: None
+        for x in range(width):
+            row.extend(((x * seed + y) & 255, (x + y * seed) & 255,
+                        (x ^ y ^ seed) & 255))
+        rows.append(bytes(row))
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + tag + data + \
+            struct.pack('>I', crc)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) +
+            chunk(b'IEND', b''))
+
+
+def sentence(rnd, words=12):
+    text = ' '.join(rnd.choice(WORDS) for i in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def paragraph(rnd):
+    parts = [sentence(rnd, rnd.randint(8, 16)) for i in range(4)]
+    # sprinkle inline markup
+    parts[1] = '*%s* %s' % (rnd.choice(WORDS), parts[1])
+    parts[2] = '**%s** %s' % (rnd.choice(WORDS), parts[2])
+    parts[3] = '``%s()`` %s' % (rnd.choice(WORDS), parts[3])
+    return ' '.join(parts)
+
+
+def heading(text, char):
+    return [text, char * len(text), '']
+
+
+def document(rnd, opts, index):
+    lines = heading('Chapter %d' % (index + 1), '=')
+    blocks = []
+    for i in range(opts.paragraphs):
+        blocks.append([paragraph(rnd), ''])
+    for i in range(opts.lists):
+        marker = i % 2 and '#.' or '*'
+        items = ['%s %s' % (marker, sentence(rnd, 6)) for j in range(5)]
+        blocks.append(items + [''])
+    for i in range(opts.tables):
+        border = '=========  =========  ========='
+        table = [border, 'Name       Value      Note', border]
+        for j in range(4):
+            table.append('%-9s  %-9s  %s' % (rnd.choice(WORDS)[:9],
+                         rnd.randint(0, 9999), rnd.choice(WORDS)))
+        blocks.append(table + [border, ''])
+    for i in range(opts.literals):
+        code = ['::', '']
+        for j in range(6):
+            code.append('    %s = %s(%d)' % (rnd.choice(WORDS),
+                        rnd.choice(WORDS), j))
+        blocks.append(code + [''])
+    for i in range(opts.images):
+        image = (index * opts.images + i) % max(opts.unique_images, 1)
+        blocks.append(['.. image:: images/image%d.png' % image, ''])
+
+    # spread the blocks over sections so headings are exercised too
+    rnd.shuffle(blocks)
+    sections = max(1, len(blocks) // 10)
+    per_section = len(blocks) // sections + 1
+    for s in range(sections):
+        lines.extend(heading('Section %d.%d' % (index + 1, s + 1), '-'))
+        for block in blocks[s * per_section:(s + 1) * per_section]:
+            lines.extend(block)
+    return '\n'.join(lines) + '\n'
+
+
+def generate(outdir, opts):
+    """Write the corpus described by `opts` into `outdir`.
+
+    Return the list of generated docnames (without index).
+    """
+    rnd = random.Random(opts.seed)
+    imagedir = os.path.join(outdir, 'images')
+    if not os.path.isdir(imagedir):
+        os.makedirs(imagedir)
+
+    write(os.path.join(outdir, 'conf.py'), CONF_PY)
+    width, height = opts.image_size
+    if opts.images:
+        for i in range(max(opts.unique_images, 1)):
+            write(os.path.join(imagedir, 'image%d.png' % i),
+                  png(width, height, i + 1), 'wb')
+
+    docnames = ['chapter%04d' % i for i in range(opts.files)]
+    index = heading('Benchmark corpus', '*')
+    index += ['.. toctree::', '   :maxdepth: 2', '']
+    index += ['   %s' % name for name in docnames]
+    write(os.path.join(outdir, 'index.rst'), '\n'.join(index) + '\n')
+    for i, name in enumerate(docnames):
+        write(os.path.join(outdir, name + '.rst'), document(rnd, opts, i))
+    return docnames
+
+
+def write(filename, data, mode='w'):
+    f = open(filename, mode)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def add_options(parser):
+    parser.add_option('-n', '--files', type='int', default=20,
+                      help='number of source files [%default]')
+    parser.add_option('-m', '--paragraphs', type='int', default=20,
+                      help='paragraphs per file [%default]')
+    parser.add_option('--lists', type='int', default=2,
+                      help='lists per file [%default]')
+    parser.add_option('--tables', type='int', default=1,
+                      help='tables per file [%default]')
+    parser.add_option('--literals', type='int', default=2,
+                      help='literal blocks per file [%default]')
+    parser.add_option('--images', type='int', default=1,
+                      help='images per file [%default]')
+    parser.add_option('--unique-images', type='int', default=4,
+                      help='distinct image files [%default]')
+    parser.add_option('--image-size', default='320x240',
+                      help='image size in pixels, WxH [%default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed [%default]')
+
+
+def options_from(values):
+    width, height = [int(x) for x in values.image_size.split('x')]
+    return CorpusOptions(
+        files=values.files, paragraphs=values.paragraphs, lists=values.lists,
+        tables=values.tables, literals=values.literals, images=values.images,
+        unique_images=values.unique_images, image_size=(width, height),
+        seed=values.seed)
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options] OUTDIR')
+    add_options(parser)
+    values, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('OUTDIR is required')
+    docnames = generate(args[0], options_from(values))
+    print 'generated %d files into %s' % (len(docnames) + 1, args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the DocxTranslator dispatch table.
+
+    Translate a large doctree, parsed from generated corpus documents (see
+    corpus.py), with docutils' walkabout() and getattr() dispatch and with
+    DocxTranslator.walk() and its dispatch table, then compare the
+    per-node cost of both for the node types whose handlers do nothing or
+    skip the node, where dispatch is all the work::
+
+        $ python benchmarks/dispatch.py --files 50 --paragraphs 40
+"""
+
+import sys
+import random
+import optparse
+import timeit
+
+import benchpath  # puts the extension modules on sys.path
+
+from docutils import nodes
+from docutils.core import publish_doctree
+
+import corpus
+import writer
+from stats import BuildStats
+
+
+class BenchBuilder(object):
+    """The parts of the docx builder the translator uses on a doctree
+    without images."""
+
+    def __init__(self):
+        self.stats = BuildStats()
+
+    def warn(self, message):
+        print >> sys.stderr, message
+
+
+class BenchContainer(object):
+
+    def __init__(self):
+        self.docbody = []
+        self.media = {}
+        self.prepared = {}
+        self.fragments = None
+
+
+def make_doctree(opts):
+    """Return one document holding the body of `opts.files` corpus files,
+    each with a target, a comment and a field list added."""
+    rnd = random.Random(opts.seed)
+    doctree = None
+    for index in range(opts.files):
+        source = '\n'.join([
+            '.. _chapter-%d:' % index, '',
+            '.. generated by benchmarks/dispatch.py', '',
+            ':version: %d' % index, '',
+            corpus.document(rnd, opts, index)])
+        tree = publish_doctree(source, settings_overrides={
+                'report_level': 5, 'halt_level': 5})
+        if doctree is None:
+            doctree = tree
+        else:
+            doctree.extend(tree.children)
+    return doctree
+
+
+def translate(doctree, table):
+    translator = writer.DocxTranslator(doctree, BenchBuilder(),
+                                       BenchContainer())
+    if table:
+        translator.walk(doctree)
+    else:
+        doctree.walkabout(translator)
+    return translator
+
+
+def dispatch_getattr(translator, nodelist):
+    for node in nodelist:
+        try:
+            translator.dispatch_visit(node)
+        except nodes.SkipNode:
+            continue
+        translator.dispatch_departure(node)
+
+
+def dispatch_table(translator, nodelist):
+    for node in nodelist:
+        visit, depart = translator.handlers(node.__class__)
+        if visit is writer.SKIP:
+            continue
+        if visit is not None:
+            visit(translator, node)
+        if depart is not None:
+            depart(translator, node)
+
+
+def best_time(func, number, repeat):
+    """Return the best time of `number` calls in seconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    corpus.add_options(parser)
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='measurements, best is kept [%default]')
+    values, args = parser.parse_args(argv[1:])
+    opts = corpus.options_from(values)
+    opts.images = 0  # no builder environment to find them
+
+    doctree = make_doctree(opts)
+    bytype = {}
+    for node in doctree.traverse():
+        bytype.setdefault(node.__class__, []).append(node)
+    count = sum(len(nodelist) for nodelist in bytype.values())
+
+    old = best_time(lambda: translate(doctree, False), 1, values.repeat)
+    new = best_time(lambda: translate(doctree, True), 1, values.repeat)
+    print '%d nodes: walkabout %.3fs, dispatch table %.3fs (%.2fx)' % (
+        count, old, new, old / new)
+    print
+
+    translator = translate(doctree, True)
+    print '%-24s %8s %8s %12s %12s %8s' % (
+        'node type', 'handler', 'count', 'before(us)', 'after(us)',
+        'speedup')
+    for nodeclass, nodelist in sorted(bytype.items(),
+                                      key=lambda item: -len(item[1])):
+        visit, depart = translator.handlers(nodeclass)
+        if visit is writer.SKIP:
+            kind = 'skip'
+        elif visit is None and depart is None:
+            kind = 'pass'
+        else:
+            # the handler's own work is the same either way
+            print '%-24s %8s %8d' % (nodeclass.__name__, 'call',
+                                     len(nodelist))
+            continue
+        before = best_time(lambda: dispatch_getattr(translator, nodelist),
+                           10, values.repeat) / len(nodelist) * 1e6
+        after = best_time(lambda: dispatch_table(translator, nodelist),
+                          10, values.repeat) / len(nodelist) * 1e6
+        print '%-24s %8s %8d %12.3f %12.3f %7.2fx' % (
+            nodeclass.__name__, kind, len(nodelist), before, after,
+            before / after)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
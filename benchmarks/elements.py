@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of the docx element constructors.
+
+    Compare the per-element cost of paragraph(), heading(), pagebreak() and
+    table() against the original makeelement() based implementation, which
+    rebuilt the '{namespace}tag' strings and namespace maps on every call::
+
+        $ python benchmarks/elements.py
+"""
+
+import sys
+import optparse
+import timeit
+
+import benchpath  # puts the extension modules on sys.path
+
+from lxml import etree
+import docx
+
+
+# -- original implementation, kept as the "before" reference -------------
+
+def legacy_makeelement(tagname, tagtext=None, nsprefix='w', attributes=None,
+                       attrnsprefix=None):
+    namespacemap = None
+    if type(nsprefix) == list:
+        namespacemap = {}
+        for prefix in nsprefix:
+            namespacemap[prefix] = docx.nsprefixes[prefix]
+        nsprefix = nsprefix[0]
+    if nsprefix:
+        namespace = '{' + docx.nsprefixes[nsprefix] + '}'
+    else:
+        namespace = ''
+    newelement = etree.Element(namespace + tagname, nsmap=namespacemap)
+    if attributes:
+        if not attrnsprefix:
+            if nsprefix == 'w':
+                attributenamespace = namespace
+            else:
+                attributenamespace = ''
+        else:
+            attributenamespace = '{' + docx.nsprefixes[attrnsprefix] + '}'
+        for tagattribute in attributes:
+            newelement.set(attributenamespace + tagattribute,
+                           attributes[tagattribute])
+    if tagtext:
+        newelement.text = tagtext
+    return newelement
+
+
+def legacy_paragraph(paratext, style='BodyText', breakbefore=False):
+    paragraph = legacy_makeelement('p')
+    run = legacy_makeelement('r')
+    if breakbefore:
+        run.append(legacy_makeelement('lastRenderedPageBreak'))
+    text = legacy_makeelement('t', tagtext=paratext)
+    pPr = legacy_makeelement('pPr')
+    style = docx.stylenames.get(style, 'BodyText')
+    pPr.append(legacy_makeelement('pStyle', attributes={'val': style}))
+    run.append(text)
+    paragraph.append(pPr)
+    paragraph.append(run)
+    return paragraph
+
+
+def legacy_heading(headingtext, headinglevel):
+    paragraph = legacy_makeelement('p')
+    pr = legacy_makeelement('pPr')
+    style = docx.stylenames.get('Heading' + str(headinglevel), 'Normal')
+    pStyle = legacy_makeelement('pStyle', attributes={'val': style})
+    run = legacy_makeelement('r')
+    text = legacy_makeelement('t', tagtext=headingtext)
+    pr.append(pStyle)
+    run.append(text)
+    paragraph.append(pr)
+    paragraph.append(run)
+    return paragraph
+
+
+def legacy_pagebreak():
+    pagebreak = legacy_makeelement('p')
+    run = legacy_makeelement('r')
+    run.append(legacy_makeelement('br', attributes={'type': 'page'}))
+    pagebreak.append(run)
+    return pagebreak
+
+
+def legacy_table(contents):
+    table = legacy_makeelement('tbl')
+    tableprops = legacy_makeelement('tblPr')
+    for prop in [
+            legacy_makeelement('tblStyle',
+                               attributes={'val': 'ColorfulGrid-Accent1'}),
+            legacy_makeelement('tblW', attributes={'w': '0', 'type': 'auto'}),
+            legacy_makeelement('tblLook', attributes={'val': '0400'})]:
+        tableprops.append(prop)
+    table.append(tableprops)
+    tablegrid = legacy_makeelement('tblGrid')
+    for _ in range(len(contents[0][0])):
+        tablegrid.append(legacy_makeelement('gridCol',
+                                            attributes={'w': '2390'}))
+    table.append(tablegrid)
+    row = legacy_makeelement('tr')
+    rowprops = legacy_makeelement('trPr')
+    rowprops.append(legacy_makeelement('cnfStyle',
+                                       attributes={'val': '000000100000'}))
+    row.append(rowprops)
+    for heading in contents[0]:
+        cell = legacy_makeelement('tc')
+        cellprops = legacy_makeelement('tcPr')
+        cellprops.append(legacy_makeelement(
+            'tcW', attributes={'w': '2390', 'type': 'dxa'}))
+        cellprops.append(legacy_makeelement('shd', attributes={
+            'val': 'clear', 'color': 'auto', 'fill': '548DD4',
+            'themeFill': 'text2', 'themeFillTint': '99'}))
+        cell.append(cellprops)
+        cell.append(legacy_paragraph(heading))
+        row.append(cell)
+    table.append(row)
+    for contentrow in contents[1:]:
+        row = legacy_makeelement('tr')
+        for content in contentrow:
+            cell = legacy_makeelement('tc')
+            cellprops = legacy_makeelement('tcPr')
+            cellprops.append(legacy_makeelement('tcW',
+                                                attributes={'type': 'dxa'}))
+            cell.append(cellprops)
+            cell.append(legacy_paragraph(content))
+            row.append(cell)
+        table.append(row)
+    return table
+
+
+# -- benchmark ------------------------------------------------------------
+
+TEXT = u'The quick brown fox jumps over the lazy dog. ' * 4
+TABLE = [['Name', 'Value', 'Note']] + [['row', str(i), 'text']
+                                       for i in range(5)]
+
+CASES = [
+    ('paragraph', lambda: legacy_paragraph(TEXT, breakbefore=True),
+     lambda: docx.paragraph(TEXT, breakbefore=True)),
+    ('heading', lambda: legacy_heading(TEXT, 2),
+     lambda: docx.heading(TEXT, 2)),
+    ('pagebreak', legacy_pagebreak, lambda: docx.pagebreak()),
+    ('table 3x6', lambda: legacy_table(TABLE), lambda: docx.table(TABLE)),
+]
+
+
+def best_time(func, number, repeat):
+    """Return the best time per call in microseconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--number', type='int', default=2000,
+                      help='calls per measurement [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='measurements, best is kept [%default]')
+    values, args = parser.parse_args(argv[1:])
+
+    print '%-12s %12s %12s %8s' % (
+        'element', 'before(us)', 'after(us)', 'speedup')
+    for name, before, after in CASES:
+        old = best_time(before, values.number, values.repeat)
+        new = best_time(after, values.number, values.repeat)
+        print '%-12s %12.2f %12.2f %7.2fx' % (name, old, new, old / new)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    Import time benchmark for the docx builder extension.
+
+    Measure what loading the extension costs a Sphinx run that does not use
+    the docx builder (e.g. ``sphinx-build -b html`` with the extension
+    listed in conf.py)::
+
+        $ python benchmarks/startup.py
+
+    Each measurement runs in a fresh interpreter with Sphinx already
+    imported, and reports the extension's import time together with an
+    ``python -X importtime`` style table (cumulative and self time per
+    imported module). The ``-X importtime`` option itself needs Python 3.7,
+    so the table is collected by wrapping ``__import__`` instead.
+
+    Modules listed in HEAVY_MODULES must not be imported at extension load
+    time; the exit status is 1 if one of them is.
+"""
+
+import os
+import sys
+import json
+import optparse
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+EXTENSION = 'sphinxcontrib-docxbuilder'
+
+#: modules that belong to DocxBuilder.init/prepare_writing, not to import.
+HEAVY_MODULES = ['lxml', 'lxml.etree', 'PIL', 'Image', 'docx', 'writer']
+
+CHILD = r'''
+import sys, json
+from timeit import default_timer as timer
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+import sphinx.builders  # paid by every sphinx run anyway
+
+rows = []
+stack = []
+original_import = builtins.__import__
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return original_import(name, *args, **kwargs)
+    stack.append(0.0)
+    start = timer()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        elapsed = timer() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        rows.append((int(elapsed * 1e6), int((elapsed - children) * 1e6),
+                     len(stack), name))
+
+before = set(sys.modules)
+builtins.__import__ = timed_import
+start = timer()
+__import__(%(extension)r)
+elapsed = timer() - start
+builtins.__import__ = original_import
+loaded = sorted(m for m in set(sys.modules) - before if sys.modules[m])
+sys.stdout.write('\n' + json.dumps(
+    {'seconds': elapsed, 'modules': loaded, 'importtime': rows}))
+'''
+
+
+def child_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def measure(python=sys.executable, repeat=5):
+    """Import the extension in `repeat` fresh interpreters.
+
+    Return the result of the fastest run: import time in seconds, loaded
+    modules and importtime rows (cumulative us, self us, depth, name).
+    """
+    code = CHILD % {'extension': EXTENSION}
+    best = None
+    for i in range(repeat):
+        proc = subprocess.Popen([python, '-c', code], env=child_env(),
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError('importing %s failed' % EXTENSION)
+        # the result is the last line, the extension may print on import
+        result = json.loads(out.decode('utf-8').splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def heavy_modules(result):
+    loaded = set(result['modules'])
+    loaded.update(name.split('.')[-1] for name in result['modules'])
+    return [m for m in HEAVY_MODULES if m in loaded]
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='number of fresh interpreters [%default]')
+    parser.add_option('--python', default=sys.executable,
+                      help='interpreter to measure [%default]')
+    parser.add_option('--top', type='int', default=15,
+                      help='slowest imports to show [%default]')
+    parser.add_option('--json', action='store_true',
+                      help='print the result as JSON')
+    values, args = parser.parse_args(argv[1:])
+
+    result = measure(values.python, values.repeat)
+    heavy = result['heavy_modules'] = heavy_modules(result)
+
+    if values.json:
+        print json.dumps(result, indent=2, sort_keys=True)
+    else:
+        print 'import %s: %.1f ms (best of %d), %d new modules' % (
+            EXTENSION, result['seconds'] * 1000, values.repeat,
+            len(result['modules']))
+        rows = sorted(result['importtime'], reverse=True)[:values.top]
+        if rows:
+            print '%13s %13s  %s' % ('cumulative', 'self', 'import')
+            for cumulative, own, depth, name in rows:
+                print '%10d us %10d us  %s%s' % (
+                    cumulative, own, '  ' * depth, name)
+        if heavy:
+            print 'heavy modules imported at load time: %s' % ', '.join(heavy)
+    return heavy and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
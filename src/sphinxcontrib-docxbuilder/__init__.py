@@ -4,3 +4,12 @@ from builder import DocxBuilder
 def setup(app):
     app.add_builder(DocxBuilder)
     app.add_config_value('docx_template', None, 'env')
+    app.add_config_value('docx_documents', [], 'env')
+    app.add_config_value('docx_trace', 'off', '')
+    app.add_config_value('docx_streaming', False, '')
+    app.add_config_value('docx_compression', None, '')
+    app.add_config_value('docx_image_normalize', False, '')
+    app.add_config_value('docx_fragment_cache', True, '')
+    app.add_config_value('docx_reproducible', False, '')
+    # sphinx 1.3 and later read this; older versions ignore it
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
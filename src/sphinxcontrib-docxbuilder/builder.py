@@ -10,6 +10,8 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
+import time
 import codecs
 from os import path
 
@@ -20,7 +22,8 @@ from sphinx.builders import Builder
 from sphinx.util.osutil import ensuredir, os_path
 from sphinx.util.nodes import inline_all_toctrees
 from sphinx.util.console import bold, darkgreen, brown
-from writer import DocxWriter
+from cache import PickleCache, content_hash, replace_file
+from stats import BuildStats
 
 
 class DocxBuilder(Builder):
@@ -28,18 +31,127 @@ class DocxBuilder(Builder):
     format = 'docx'
     out_suffix = '.docx'
 
+    stats_filename = 'docx_stats.json'
+    buildinfo_filename = 'docx-buildinfo.pickle'
+
     def init(self):
-        pass
+        self.stats = BuildStats()
+        # set in worker processes, see start_worker()
+        self.worker_process = False
+        self.worker_warnings = []
+        # {target file: (its mtime, time it was last built)}, see built_mtime()
+        self.written = {}
+
+    def document_entries(self, check=True):
+        """Return the documents to write, as (start docname, target name
+        without suffix, template) tuples from docx_documents.  Without
+        docx_documents, master_doc is written to "<project>-<version>".
+        Malformed entries and entries with unknown start documents are
+        left out, with a warning if `check` is true.
+        """
+        entries = self.config.docx_documents
+        if not entries:
+            return [(self.config.master_doc, "%s-%s" % (
+                self.config.project, self.config.version), None)]
+        documents = []
+        for entry in entries:
+            if not isinstance(entry, (tuple, list)) or \
+                    len(entry) not in (2, 3) or \
+                    not all(isinstance(value, basestring)
+                            for value in entry[:2]):
+                if check:
+                    self.warn('"docx_documents" entries must be '
+                              '(startdocname, targetname[, template]) '
+                              'tuples, ignoring %r' % (entry,))
+                continue
+            docname, targetname = entry[:2]
+            template = len(entry) > 2 and entry[2] or None
+            if check and docname not in self.env.all_docs:
+                self.warn('"docx_documents" config value references '
+                          'unknown document %s' % docname)
+                continue
+            if targetname.endswith(self.out_suffix):
+                targetname = targetname[:-len(self.out_suffix)]
+            documents.append((docname, targetname, template))
+        return documents
+
+    def config_hash(self):
+        """Hash of the docx_* config values; the env only tracks the
+        ones that need a re-read."""
+        values = sorted((name, repr(self.config[name]))
+                        for name in self.config.values
+                        if name.startswith('docx_'))
+        return content_hash(repr(values))
+
+    def buildinfo(self):
+        return PickleCache(path.join(self.doctreedir,
+                                     self.buildinfo_filename))
+
+    def built_mtime(self, filename, buildinfo):
+        """Return when the target `filename` was last built: its mtime,
+        or the time of the build that left it unchanged."""
+        mtime = path.getmtime(filename)
+        record = buildinfo.get('written', {}).get(path.abspath(filename))
+        if record is not None and record[0] == mtime:
+            return max(mtime, record[1])
+        return mtime
 
     def get_outdated_docs(self):
-        return 'pass'
+        """Return the documents that are newer than the docx files.
+
+        Documents are assembled into few docx files, so any outdated
+        document (or a newer template, or changed docx_* config values)
+        makes them be written again; if none is, the build stops before
+        assembling.
+        """
+        buildinfo = self.buildinfo()
+        mtimes = [0]
+        templates = set([self.config.docx_template])
+        # before the environment is updated, all_docs may be incomplete;
+        # entries that write() will skip must not keep the targets stale
+        for docname, targetname, template in self.document_entries(False):
+            if docname not in self.env.found_docs:
+                continue
+            target = path.join(self.outdir,
+                               os_path(targetname) + self.out_suffix)
+            try:
+                mtimes.append(self.built_mtime(target, buildinfo))
+            except EnvironmentError:
+                mtimes[0] = None
+            templates.add(template)
+        # the oldest target, 0 if one is missing
+        targetmtime = mtimes[0] is not None and min(mtimes[1:] or [0]) or 0
+        if buildinfo.get('config') != self.config_hash():
+            targetmtime = 0
+        for template in filter(None, templates):
+            try:
+                if path.getmtime(path.join(self.srcdir, template)) > \
+                        targetmtime:
+                    targetmtime = 0
+            except EnvironmentError:
+                pass
+        outdated = []
+        for docname in self.env.found_docs:
+            if docname not in self.env.all_docs:
+                outdated.append(docname)
+                continue
+            try:
+                srcmtime = path.getmtime(self.env.doc2path(docname))
+                doctreemtime = path.getmtime(path.join(
+                        self.doctreedir, os_path(docname) + '.doctree'))
+            except EnvironmentError:
+                outdated.append(docname)
+                continue
+            if max(srcmtime, doctreemtime) > targetmtime:
+                outdated.append(docname)
+        return outdated
 
     def get_target_uri(self, docname, typ=None):
         return ''
 
-    def fix_refuris(self, tree):
+    def fix_refuris(self, tree, startdocname):
         # fix refuris with double anchor
-        fname = self.config.master_doc + self.out_suffix
+        fname = startdocname + self.out_suffix
         for refnode in tree.traverse(nodes.reference):
             if 'refuri' not in refnode:
                 continue
@@ -52,42 +164,191 @@ class DocxBuilder(Builder):
                 refnode['refuri'] = fname + refuri[hashindex:]
 
     def prepare_writing(self, docnames):
-        self.writer = DocxWriter(self)
-
-    def assemble_doctree(self):
-        master = self.config.master_doc
-        tree = self.env.get_doctree(master)
-        tree = inline_all_toctrees(self, set(), master, tree, darkgreen)
-        tree['docname'] = master
-        self.env.resolve_references(tree, master, self)
-        self.fix_refuris(tree)
+        # writer pulls in lxml and the docx module; import it only when the
+        # docx builder really writes, not when the extension is loaded.
+        from writer import DocxWriter
+        self.writer_class = DocxWriter
+
+    def assemble_doctree(self, startdocname):
+        with self.stats.phase('assemble_doctree'):
+            tree = self.env.get_doctree(startdocname)
+            tree = inline_all_toctrees(self, set(), startdocname, tree,
+                                       darkgreen)
+            tree['docname'] = startdocname
+        with self.stats.phase('resolve_references'):
+            self.env.resolve_references(tree, startdocname, self)
+        with self.stats.phase('fix_refuris'):
+            self.fix_refuris(tree, startdocname)
         return tree
 
     def write(self, *ignored):
         docnames = self.env.all_docs
 
         self.info(bold('preparing documents... '), nonl=True)
-        self.prepare_writing(docnames)
+        with self.stats.phase('prepare_writing'):
+            self.prepare_writing(docnames)
         self.info('done')
 
-        self.info(bold('assembling single document... '), nonl=True)
-        doctree = self.assemble_doctree()
+        documents = self.document_entries()
+        workers = min(self.parallel_workers(), len(documents))
+        if workers > 1 and hasattr(os, 'fork'):
+            self.write_parallel(documents, workers)
+        else:
+            for document in documents:
+                self.write_document(document)
+
+        buildinfo = self.buildinfo()
+        buildinfo['config'] = self.config_hash()
+        written = dict(buildinfo.get('written', {}))
+        written.update(self.written)
+        buildinfo['written'] = written
+        try:
+            buildinfo.save()
+        except (IOError, OSError), err:
+            self.warn("error writing file %s: %s" %
+                      (buildinfo.filename, err))
+
+    def write_document(self, document):
+        """Assemble and write one (start docname, target name, template)
+        entry of document_entries()."""
+        startdocname, targetname, template = document
+        self.info(bold('assembling document %s... ' % targetname),
+                  nonl=True)
+        doctree = self.assemble_doctree(startdocname)
         self.info()
+        with self.stats.phase('prepare_writing'):
+            self.writer = self.writer_class(self, template)
+        self.info(bold('preparing images... '), nonl=True)
+        with self.stats.phase('prepare_images'):
+            self.writer.prepare_images(doctree)
+        self.info('done')
+        with self.stats.phase('prepare_fragments'):
+            self.writer.prepare_fragments(doctree)
         self.info(bold('writing... '), nonl=True)
-        docname = "%s-%s" % (self.config.project, self.config.version)
-        self.write_doc(docname, doctree)
+        self.write_doc(targetname, doctree)
         self.info('done')
 
+        tracer = self.writer.tracer
+        if tracer:
+            self.info(bold('node trace (%s):' % tracer.level))
+            for line in tracer.report():
+                self.info(line)
+            tracer.close()
+
+    def write_parallel(self, documents, workers):
+        """Write the documents in a pool of `workers` processes.
+
+        The processes are forked from this one, so they share the read
+        environment instead of loading it again.  Their statistics are
+        added to this build's and their warnings are emitted here.
+        """
+        global _builder
+        from multiprocessing import Pool
+        _builder = self
+        try:
+            pool = Pool(workers)
+            try:
+                results = pool.map(_write_document, documents)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _builder = None
+        for stats, warnings, written in results:
+            self.stats.merge(stats)
+            self.emit_warnings(warnings)
+            self.written.update(written)
+
+    def start_worker(self):
+        """Set up this builder for a task in a forked worker process.
+
+        Statistics start over, and warnings are collected instead of
+        being reported, to be returned to the parent process with the
+        task's result and passed to emit_warnings() there.
+        """
+        self.worker_process = True
+        self.stats = BuildStats()
+        self.worker_warnings = []
+
+        def warn(*args, **kwargs):
+            self.worker_warnings.append((args, kwargs))
+        self.warn = warn
+
+    def emit_warnings(self, warnings):
+        """Report the warnings collected by a worker process."""
+        for args, kwargs in warnings:
+            self.warn(*args, **kwargs)
+
+    def parallel_workers(self):
+        """Return the number of worker threads/processes to use, given by
+        the -j option of sphinx-build (1 if it is not supported)."""
+        return max(getattr(self.app, 'parallel', 0) or 1, 1)
+
+    def process_workers(self):
+        """Return the number of worker processes to use; processes of a
+        multiprocessing pool cannot start processes themselves."""
+        if self.worker_process:
+            return 1
+        return self.parallel_workers()
+
     def write_doc(self, docname, doctree):
         destination = StringOutput(encoding='utf-8')
-        self.writer.write(doctree, destination)
         outfilename = path.join(
                 self.outdir, os_path(docname) + self.out_suffix)
-        ensuredir(path.dirname(outfilename))
         try:
-            self.writer.save(outfilename)
-        except (IOError, OSError), err:
-            self.warn("error writing file %s: %s" % (outfilename, err))
+            with self.stats.phase('translate'):
+                self.writer.write(doctree, destination)
+            ensuredir(path.dirname(outfilename))
+            try:
+                with self.stats.phase('save'):
+                    if self.config.docx_reproducible:
+                        tmpname = '%s.%d.tmp' % (outfilename, os.getpid())
+                        try:
+                            self.writer.save(tmpname)
+                        except Exception:
+                            if path.exists(tmpname):
+                                os.remove(tmpname)
+                            raise
+                        self.replace_output(tmpname, outfilename)
+                    else:
+                        self.writer.save(outfilename)
+                self.written[path.abspath(outfilename)] = (
+                        path.getmtime(outfilename), time.time())
+            except (IOError, OSError), err:
+                self.warn("error writing file %s: %s" % (outfilename, err))
+        finally:
+            self.writer.discard()
+
+    def replace_output(self, tmpname, filename):
+        """Move the newly written `tmpname` to `filename`, unless that
+        has the same content: then it is left alone, mtime included, so
+        copies and caches of it do not see a change."""
+        from docx import file_hash
+        if path.exists(filename) and file_hash(filename) == file_hash(tmpname):
+            os.remove(tmpname)
+            self.info('%s is unchanged' % path.basename(filename))
+            return
+        replace_file(tmpname, filename)
 
     def finish(self):
-        pass
+        if not self.stats.phases:
+            return
+        self.info(bold('build phases:'))
+        for line in self.stats.report():
+            self.info(line)
+        statsfile = path.join(self.outdir, self.stats_filename)
+        try:
+            self.stats.dump(statsfile)
+        except (IOError, OSError), err:
+            self.warn("error writing file %s: %s" % (statsfile, err))
+
+
+# the builder of write_parallel(), inherited by its forked workers
+_builder = None
+
+
+def _write_document(document):
+    builder = _builder
+    builder.start_worker()
+    builder.write_document(document)
+    return builder.stats, builder.worker_warnings, builder.written
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Persistent caches kept in the Sphinx doctree directory between builds.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def replace_file(tmpname, filename):
+    """Rename the newly written `tmpname` to `filename`, replacing it."""
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)  # rename() does not replace on Windows
+    os.rename(tmpname, filename)
+
+
+def content_hash(data):
+    """Return a hex digest identifying `data` (a byte string)."""
+    return hashlib.sha1(data).hexdigest()
+
+
+class PickleCache(object):
+    """A small dict-like cache stored in one pickle file.
+
+    The file is read at construction and written back by :meth:`save` when
+    something changed.  A missing, unreadable or outdated (different
+    `version`) file just gives an empty cache.
+    """
+
+    def __init__(self, filename, version=1):
+        self.filename = filename
+        self.version = version
+        self.data = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.filename, 'rb')
+        except (IOError, OSError):
+            return
+        try:
+            try:
+                version, data = pickle.load(f)
+            except Exception:
+                return
+        finally:
+            f.close()
+        if version == self.version and isinstance(data, dict):
+            self.data = data
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        f = open(tmpname, 'wb')
+        try:
+            pickle.dump((self.version, self.data), f,
+                        pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        replace_file(tmpname, self.filename)
+        self.dirty = False
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.data)
@@ -7,13 +7,17 @@ See LICENSE for licensing information.
 '''
 
 from lxml import etree
-import Image
 import zipfile
-import shutil
+import struct
+import hashlib
+import zlib
 import re
 import time
 import os
+import sys
+from StringIO import StringIO
 from os.path import join
+from timeit import default_timer
 
 # Record template directory's location which is just 'template' for a docx
 # developer or 'site-packages/docx-template' if you have installed docx
@@ -21,15 +25,57 @@ TEMPLATE_DIR = join(os.path.dirname(__file__),'docx-template') # installed
 if not os.path.isdir(TEMPLATE_DIR):
     TEMPLATE_DIR = join(os.path.dirname(__file__),'template') # dev
 
-# FIXME: QUICK-HACK to prevent picture() from staining template directory.
-# temporary directory will create per module import.
+# The template (a Template object, see below) is only read. Parts generated
+# for a document (e.g. media added by picture()) go into the part table
+# `generated_parts`, {archive name: data}, and are written by savedocx() on
+# top of the template parts. data is a string, or a FilePart for parts
+# that are read from a file only when the archive is written.
 template_dir = TEMPLATE_DIR
-def set_template(template_path):
-    global template_dir
+template = None
+generated_parts = {}
+
+# Media parts by content hash, {sha1: (relationship id, archive name)}, so
+# an image used several times is stored and related only once.
+media_parts = {}
+
+
+class FilePart(object):
+    '''A part whose content is the file `filename`. Iterating it yields
+    the content in chunks, so the file is never held in memory.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        return _file_chunks(self.filename)
+
+    def __repr__(self):
+        return '<FilePart %s>' % self.filename
+
+
+def set_template(template_path, names=None):
+    '''Use the template in template_path. `names` is the style name mapping
+    of its styles.xml as returned by read_stylenames(), if already known.'''
+    global template_dir, template
     template_dir = template_path
-    update_stylenames(join(template_dir, 'word', 'styles.xml'))
+    template = Template.load(template_path, names)
+    reset_parts()
+    stylenames.clear()
+    stylenames.update(default_stylenames)
+    stylenames.update(template.stylenames)
+
+
+def get_template():
+    '''Return the current Template, loading the default one if needed'''
+    if template is None:
+        set_template(template_dir)
+    return template
+
 
-# END of QUICK-HACK
+def reset_parts():
+    '''Forget parts generated for a previous document'''
+    generated_parts.clear()
+    media_parts.clear()
 
 
 # All Word prefixes / namespace matches used in document.xml & core.xml.
@@ -88,6 +134,46 @@ stylenames = {
     'ListBullet': 'ListBullet',
     'ListNumber': 'ListNumber',
 }
+default_stylenames = dict(stylenames)
+
+
+class QNames(object):
+    '''Qualified (Clark notation) names of one namespace prefix, computed
+    once and then cached as attributes: QNames('w').p is '{...main}p'.'''
+
+    def __init__(self, prefix):
+        self._namespace = '{%s}' % nsprefixes[prefix] if prefix else ''
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        qname = self._namespace + name
+        setattr(self, name, qname)
+        return qname
+
+
+_qnames = {}
+
+
+def qnames(prefix):
+    '''Return the shared QNames of prefix (None for no namespace)'''
+    try:
+        return _qnames[prefix]
+    except KeyError:
+        names = _qnames[prefix] = QNames(prefix)
+        return names
+
+
+W = qnames('w')
+R = qnames('r')
+A = qnames('a')
+WP = qnames('wp')
+PIC = qnames('pic')
+NONS = qnames(None)
+
+Element = etree.Element
+SubElement = etree.SubElement
+
 
 def norm_name(name, namespaces):
     ns, name = name.split(':', 1)
@@ -95,28 +181,402 @@ def norm_name(name, namespaces):
     return "{%s}%s" % (ns, name)
 
 
+def read_stylenames(style_file):
+    '''Return {style name: styleId} of a styles.xml file (or file object).
+    The name is taken from <w:aliases> if present, else from <w:name>.
+    The file is parsed in a single streaming pass.'''
+    style_tag = norm_name('w:style', nsprefixes)
+    aliases_tag = norm_name('w:aliases', nsprefixes)
+    name_tag = norm_name('w:name', nsprefixes)
+    val_attr = norm_name('w:val', nsprefixes)
+    styleid_attr = norm_name('w:styleId', nsprefixes)
+    names = {}
+    for event, style_elem in etree.iterparse(style_file, tag=style_tag):
+        name_elem = style_elem.find(aliases_tag)
+        if name_elem is None:
+            name_elem = style_elem.find(name_tag)
+        names[name_elem.get(val_attr)] = style_elem.get(styleid_attr)
+        # drop parsed styles, only the mapping is kept
+        style_elem.clear()
+        while style_elem.getprevious() is not None:
+            del style_elem.getparent()[0]
+    return names
+
+
 def update_stylenames(style_file):
-    xmlcontent = open(style_file, 'r').read()
-    xml = etree.fromstring(xmlcontent)
-    style_elems = xml.xpath('w:style', namespaces=nsprefixes)
-    for style_elem in style_elems:
-        aliases_elems = style_elem.xpath('w:aliases', namespaces=nsprefixes)
-        if aliases_elems:
-            name = aliases_elems[0].attrib[norm_name('w:val', nsprefixes)]
+    stylenames.update(read_stylenames(style_file))
+
+
+class Template(object):
+    '''A docx/dotx template, parsed once.
+
+    The template is either a directory holding the extracted parts or the
+    docx/dotx archive itself. The parts the document is built on are parsed
+    when first used and then kept in memory:
+
+    * contenttypes: {part name: content type} of the Override entries
+    * relationships: [[type, target], ...] of word/_rels/document.xml.rels
+    * stylenames: {style name: styleId} of word/styles.xml
+    * numbering: parsed word/numbering.xml, or None
+
+    The other parts are only copied into the output by copy_part(). Parts
+    of an archive are copied without being decompressed and compressed
+    again.
+
+    A Template is never modified after loading, so Template.load() shares
+    one instance per template (and unchanged content) in a process.'''
+
+    _loaded = {}
+    ignore = ['.DS_Store']  # nuisance from some os's
+
+    def __init__(self, path, names=None):
+        self.path = path
+        self.partnames = []
+        self.is_archive = os.path.isfile(path)
+        if self.is_archive:
+            archive = zipfile.ZipFile(path)
+            try:
+                for name in archive.namelist():
+                    if name.endswith('/') or \
+                            name.split('/')[-1] in self.ignore:
+                        continue
+                    self.partnames.append(name)
+            finally:
+                archive.close()
+            self.partnames.sort()
+        else:
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename in self.ignore:
+                        continue
+                    relpath = os.path.relpath(join(dirpath, filename), path)
+                    self.partnames.append('/'.join(relpath.split(os.sep)))
+        self._stylenames = names
+
+    @classmethod
+    def load(cls, path, names=None):
+        '''Return the shared Template of path'''
+        path = os.path.abspath(path)
+        key = (path, cls.signature(path))
+        template = cls._loaded.get(key)
+        if template is None:
+            for old in [k for k in cls._loaded if k[0] == path]:
+                del cls._loaded[old]
+            template = cls._loaded[key] = cls(path, names)
+        elif names is not None and template._stylenames is None:
+            template._stylenames = names
+        return template
+
+    @staticmethod
+    def signature(path):
+        '''Size and mtime of the archive, or names, sizes and mtimes of
+        all files below the directory'''
+        if os.path.isfile(path):
+            st = os.stat(path)
+            return (st.st_size, st.st_mtime)
+        result = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                st = os.stat(join(dirpath, filename))
+                result.append((dirpath, filename, st.st_size, st.st_mtime))
+        return tuple(sorted(result))
+
+    def filename(self, partname):
+        '''Return the file name of a part of a directory template'''
+        return join(self.path, *partname.split('/'))
+
+    def open_archive(self):
+        return zipfile.ZipFile(self.path)
+
+    def read(self, partname):
+        if self.is_archive:
+            archive = self.open_archive()
+            try:
+                return archive.read(partname)
+            finally:
+                archive.close()
+        f = open(self.filename(partname), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def parse(self, partname):
+        if partname not in self.partnames:
+            raise RuntimeError('You need %r file in template' % partname)
+        return etree.fromstring(self.read(partname))
+
+    def copy_part(self, partname, docxfile, archive=None, level=6):
+        '''Write the part into the zip file docxfile. Parts of a directory
+        are deflated at level, parts of an archive are copied as they are
+        stored. For an archive template, `archive` may be the already
+        opened template archive.'''
+        if not self.is_archive:
+            write_part(docxfile, partname, FilePart(self.filename(partname)),
+                       level)
+        elif archive is not None:
+            copy_zip_entry(archive, archive.getinfo(partname), docxfile)
         else:
-            name_elem = style_elem.xpath('w:name', namespaces=nsprefixes)[0]
-            name = name_elem.attrib[norm_name('w:val', nsprefixes)]
-        value = style_elem.attrib[norm_name('w:styleId', nsprefixes)]
-        stylenames[name] = value
-        print "### '%s' = '%s'" % (name, value)
+            archive = self.open_archive()
+            try:
+                copy_zip_entry(archive, archive.getinfo(partname), docxfile)
+            finally:
+                archive.close()
 
+    def _cached(self, attr, compute):
+        value = self.__dict__.get(attr)
+        if value is None:
+            value = self.__dict__[attr] = compute()
+        return value
 
-import tempfile
-temp_dir = tempfile.mkdtemp(prefix='docx-')
-os.rmdir(temp_dir)
-shutil.copytree(TEMPLATE_DIR, temp_dir)
-set_template(temp_dir)
-# END of QUICK-HACK
+    @property
+    def contenttypes(self):
+        return self._cached('_contenttypes', lambda: dict(
+            (x.get('PartName'), x.get('ContentType'))
+            for x in self.parse('[Content_Types].xml')
+            if x.get('PartName')))
+
+    @property
+    def relationships(self):
+        return self._cached('_relationships', lambda: [
+            (x.get('Type'), x.get('Target'))
+            for x in self.parse('word/_rels/document.xml.rels')])
+
+    @property
+    def stylenames(self):
+        return self._cached('_stylenames', lambda: read_stylenames(
+            StringIO(self.read('word/styles.xml'))))
+
+    @property
+    def numbering(self):
+        if 'word/numbering.xml' not in self.partnames:
+            return None
+        return self._cached('_numbering',
+                            lambda: self.parse('word/numbering.xml'))
+
+    @property
+    def text_width(self):
+        '''Width in EMU between the page margins of the last section of
+        word/document.xml, DEFAULT_TEXT_WIDTH if the template has none'''
+        return self._cached('_text_width', self._read_text_width)
+
+    def _read_text_width(self):
+        if 'word/document.xml' not in self.partnames:
+            return DEFAULT_TEXT_WIDTH
+        sections = self.parse('word/document.xml').findall('.//' + W.sectPr)
+        if not sections:
+            return DEFAULT_TEXT_WIDTH
+        size = sections[-1].find(W.pgSz)
+        margins = sections[-1].find(W.pgMar)
+        try:
+            width = int(size.get(W.w))
+            if margins is not None:
+                width -= int(margins.get(W.left, 0)) + \
+                    int(margins.get(W.right, 0))
+        except (AttributeError, TypeError, ValueError):
+            return DEFAULT_TEXT_WIDTH
+        if width <= 0:
+            return DEFAULT_TEXT_WIDTH
+        return width * EMU_PER_TWIP
+
+
+# Deflate level (0-9) by part name extension, used by savedocx(). Level 0
+# stores the part: already compressed media gains nothing from deflate.
+# '*' is the level of all other parts, mostly XML.
+COMPRESSION = {'*': 6, '.png': 0, '.jpg': 0, '.jpeg': 0, '.gif': 0,
+               '.tif': 0, '.tiff': 0, '.emf': 6, '.wmf': 6}
+
+# 1980-01-01T00:00:00Z, the earliest date of a zip member
+ZIP_EPOCH = 315532800
+
+
+def compression_policy(setting=None):
+    '''Return the {extension: level} policy for setting, which is None
+    for the default policy COMPRESSION, the deflate level of XML (and other
+    not yet compressed) parts, or a dict updating COMPRESSION.'''
+    policy = dict(COMPRESSION)
+    if isinstance(setting, dict):
+        policy.update(setting)
+    elif setting is not None:
+        policy['*'] = setting
+    result = {}
+    for key, level in policy.items():
+        level = int(level)
+        if not 0 <= level <= 9:
+            raise ValueError('invalid compression level %r for %r' %
+                             (level, key))
+        result[key.lower()] = level
+    return result
+
+
+def compress_level(policy, partname):
+    '''Return the deflate level of partname in policy'''
+    ext = os.path.splitext(partname)[1].lower()
+    return policy.get(ext, policy['*'])
+
+
+def zip_date_time(timestamp=None):
+    '''Return the zip member date_time of the POSIX timestamp, or of now if
+    it is None. Zip dates start in 1980, earlier timestamps are clamped.'''
+    if timestamp is None:
+        return time.localtime(time.time())[:6]
+    return time.gmtime(max(timestamp, ZIP_EPOCH))[:6]
+
+
+# Zip members are written raw by _write_member(): their data is compressed
+# beforehand, in threads (see compress_part()), or copied compressed from
+# the template (see copy_zip_entry()). This uses internals of the Python 2
+# zipfile module; where they are missing, members are written with
+# ZipFile.writestr() instead, which compresses them at zlib's default level.
+RAW_ZIP = sys.version_info[0] == 2 and \
+    hasattr(zipfile.ZipFile, '_writecheck') and \
+    hasattr(zipfile.ZipInfo, 'FileHeader') and \
+    all(hasattr(zipfile, name)
+        for name in ('sizeFileHeader', 'structFileHeader',
+                     '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH'))
+
+
+def compress_part(partname, data, level=6, date_time=None):
+    '''Return (zinfo, chunks) of the part deflated at level (0 stores it),
+    ready to be written by _write_member(). data is a string or an
+    iterable of strings, e.g. a FilePart. date_time defaults to now; given
+    one, the zip metadata only depends on the arguments.
+
+    This only uses zlib, which releases the GIL, so parts can be
+    compressed in threads. A stored FilePart is not read here: its CRC
+    and size are None until _write_member() reads and writes it in one
+    pass, so they always match the data. Without RAW_ZIP, the chunks are
+    the data as it is, compressed when it is written.'''
+    if isinstance(data, basestring):
+        data = [data]
+    zinfo = zipfile.ZipInfo(partname, date_time or zip_date_time())
+    if date_time is not None:
+        zinfo.create_system = 3  # not the building platform's
+    zinfo.external_attr = 0600 << 16
+    compressor = None
+    if level:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    if not RAW_ZIP or (compressor is None and isinstance(data, FilePart)):
+        zinfo.CRC = zinfo.file_size = zinfo.compress_size = None
+        return zinfo, data
+    chunks = []
+    crc = size = 0
+    for chunk in data:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            chunks.append(chunk)
+    if compressor is not None:
+        chunks.append(compressor.flush())
+    zinfo.CRC = crc & 0xffffffff
+    zinfo.file_size = size
+    if compressor is None:
+        zinfo.compress_size = size
+    else:
+        zinfo.compress_size = sum(len(chunk) for chunk in chunks)
+    return zinfo, chunks
+
+
+def write_part(docxfile, partname, data, level=6):
+    '''Write the part into the zip file docxfile, deflated at level (0
+    stores it). data is a string or an iterable of strings.'''
+    zinfo, chunks = compress_part(partname, data, level)
+    _write_member(docxfile, zinfo, chunks)
+
+
+def copy_zip_entry(source, info, target):
+    '''Copy the member `info` of the ZipFile source into the ZipFile
+    target as it is stored, without decompressing and compressing it
+    (with RAW_ZIP only).'''
+    if info.flag_bits & 0x1 or not RAW_ZIP:
+        # encrypted, or no raw access: let zipfile deal with it
+        target.writestr(info, source.read(info))
+        return
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    zinfo.create_system = info.create_system
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zinfo.flag_bits = info.flag_bits & ~0x08  # sizes are in the header
+    _write_member(target, zinfo, _read_member(source, info))
+
+
+def _read_member(source, info):
+    '''Yield the data of the member `info` of the ZipFile source as it is
+    stored, compressed. Like _write_member(), this needs RAW_ZIP.'''
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    source.fp.seek(fields[zipfile._FH_FILENAME_LENGTH] +
+                   fields[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(remaining, 1 << 16))
+        if not chunk:
+            raise zipfile.BadZipfile('truncated member %r' % info.filename)
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _write_member(docxfile, zinfo, chunks):
+    '''Write the member zinfo and its data chunks, as they are stored, to
+    the ZipFile docxfile. zinfo holds their CRC and sizes, or None for
+    data that is stored as it is: then the CRC and size are computed while
+    writing and the header is written again with them.
+
+    With _read_member(), this is the only code using zipfile internals,
+    see RAW_ZIP; without them, the data is given to ZipFile.writestr().'''
+    if not RAW_ZIP:
+        docxfile.writestr(zinfo, ''.join(chunks))
+        return
+    unknown = zinfo.CRC is None
+    if unknown:
+        zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+    elif max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile('part %r is too large' % zinfo.filename)
+    fp = docxfile.fp
+    zinfo.header_offset = fp.tell()
+    docxfile._writecheck(zinfo)
+    docxfile._didModify = True
+    fp.write(zinfo.FileHeader())
+    crc = size = 0
+    for chunk in chunks:
+        if unknown:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+        fp.write(chunk)
+    if unknown:
+        if size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('part %r is too large' %
+                                       zinfo.filename)
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = zinfo.compress_size = size
+        end = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader())
+        fp.seek(end)
+    docxfile.filelist.append(zinfo)
+    docxfile.NameToInfo[zinfo.filename] = zinfo
+    if hasattr(docxfile, 'start_dir'):
+        docxfile.start_dir = fp.tell()
+
+
+def _file_chunks(filename, size=1 << 16):
+    f = open(filename, 'rb')
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
 
 
 def opendocx(file):
@@ -126,45 +586,146 @@ def opendocx(file):
     document = etree.fromstring(xmlcontent)    
     return document
 
+# Symbolic references in documents, resolved by RefResolver: a media
+# relationship id is MEDIA_REF + the content hash of the media file, a
+# drawing id (wp:docPr/@id) is AUTO_ID.
+MEDIA_REF = 'media:'
+AUTO_ID = 'auto'
+
+
+class RefResolver(object):
+    '''Replace symbolic references by their values in one pass over the
+    document, in document order: media references by the relationship id
+    of the media part (see add_media()), AUTO_ID drawing ids by unique
+    numbers.'''
+
+    def __init__(self):
+        self.drawing_id = 0
+
+    def resolve(self, element):
+        for node in element.iter(WP.docPr, A.blip):
+            if node.tag == A.blip:
+                ref = node.get(R.embed)
+                if ref and ref.startswith(MEDIA_REF):
+                    try:
+                        relid = media_parts[ref[len(MEDIA_REF):]][0]
+                    except KeyError:
+                        raise ValueError('unknown media reference %r' % ref)
+                    node.set(R.embed, relid)
+            elif node.get(NONS.id) == AUTO_ID:
+                self.drawing_id += 1
+                node.set(NONS.id, str(self.drawing_id))
+        return element
+
+
+# Namespaces declared by the document element. Top level blocks are made
+# with the same map, so they use its prefixes and need no declarations of
+# their own, in a document tree as in a DocumentStream.
+DOCUMENT_NSMAP = {'w': nsprefixes['w']}
+
+
 def newdocument():
-    document = makeelement('document')
-    document.append(makeelement('body'))
+    document = Element(W.document, nsmap=DOCUMENT_NSMAP)
+    SubElement(document, W.body)
     return document
 
+
+_XMLNS_DECLARATION = re.compile(r' xmlns:[^\s=]+="[^"]*"')
+
+
+class DocumentStream(object):
+    '''A document whose body is serialized as it is built.
+
+    Use it in place of both newdocument() and its body element: append()
+    writes each top level block to a temporary file right away, so only
+    the block being built is held in memory. savedocx() closes the stream
+    and copies the file into the archive as word/document.xml; discard()
+    removes the file if the document is not saved.'''
+
+    def __init__(self):
+        import tempfile
+        fd, self.filename = tempfile.mkstemp(prefix='docx-', suffix='.xml')
+        self._file = os.fdopen(fd, 'wb')
+        # the document element's namespace declarations, left out of the
+        # blocks' start tags
+        self._declared = set(' xmlns:%s="%s"' % item
+                             for item in DOCUMENT_NSMAP.items())
+        self._file.write("<?xml version='1.0' encoding='UTF-8' "
+                         "standalone='yes'?>\n<w:document%s>\n<w:body>\n" %
+                         ''.join(sorted(self._declared)))
+        self.resolver = RefResolver()
+        self.blocks = 0
+
+    def append(self, element):
+        '''Serialize a finished top level block element'''
+        data = etree.tostring(self.resolver.resolve(element),
+                              encoding='UTF-8', pretty_print=True)
+        end = data.index('>')
+        self._file.write(_XMLNS_DECLARATION.sub(
+            lambda m: '' if m.group(0) in self._declared else m.group(0),
+            data[:end]))
+        self._file.write(data[end:])
+        self.blocks += 1
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def close(self):
+        '''Finish the document element and the file'''
+        if self._file is not None:
+            try:
+                self._file.write('</w:body>\n</w:document>\n')
+            finally:
+                self._file.close()
+                self._file = None
+
+    def discard(self):
+        '''Close the stream and remove its temporary file'''
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+_nsmaps = {}
+
+
 def makeelement(tagname,tagtext=None,nsprefix='w',attributes=None,attrnsprefix=None):
-    '''Create an element & return it''' 
+    '''Create an element & return it.
+    attributes is a list of (name, value) pairs, set in that order, or a
+    dict, whose names are set in sorted order so the output does not depend
+    on the hash seed.'''
     # Deal with list of nsprefix by making namespacemap
     namespacemap = None
     if type(nsprefix) == list:
-        namespacemap = {}
-        for prefix in nsprefix:
-            namespacemap[prefix] = nsprefixes[prefix]
+        key = tuple(nsprefix)
+        namespacemap = _nsmaps.get(key)
+        if namespacemap is None:
+            namespacemap = _nsmaps[key] = dict(
+                (prefix, nsprefixes[prefix]) for prefix in nsprefix)
         nsprefix = nsprefix[0] # FIXME: rest of code below expects a single prefix
-    if nsprefix:
-        namespace = '{'+nsprefixes[nsprefix]+'}'
-    else:
-        # For when namespace = None
-        namespace = ''
-    newelement = etree.Element(namespace+tagname, nsmap=namespacemap)
+    names = qnames(nsprefix)
+    newelement = Element(getattr(names, tagname), nsmap=namespacemap)
     # Add attributes with namespaces
     if attributes:
         # If they haven't bothered setting attribute namespace, use an empty string
         # (equivalent of no namespace)
-        if not attrnsprefix:
-            # Quick hack: it seems every element that has a 'w' nsprefix for its tag uses the same prefix for it's attributes  
-            if nsprefix == 'w':
-                attributenamespace = namespace
-            else:
-                attributenamespace = ''
+        if attrnsprefix:
+            attrnames = qnames(attrnsprefix)
+        elif nsprefix == 'w':
+            # Quick hack: it seems every element that has a 'w' nsprefix for its tag uses the same prefix for it's attributes
+            attrnames = names
         else:
-            attributenamespace = '{'+nsprefixes[attrnsprefix]+'}'
-                    
-        for tagattribute in attributes:
-            newelement.set(attributenamespace+tagattribute, attributes[tagattribute])
+            attrnames = NONS
+        if isinstance(attributes, dict):
+            attributes = sorted(attributes.items())
+        for tagattribute, value in attributes:
+            newelement.set(getattr(attrnames, tagattribute), value)
     if tagtext:
-        newelement.text = tagtext    
+        newelement.text = tagtext
     return newelement
 
+
 def pagebreak(type='page', orient='portrait'):
     '''Insert a break, default 'page'.
     See http://openxmldeveloper.org/forums/thread/4075.aspx
@@ -173,242 +734,299 @@ def pagebreak(type='page', orient='portrait'):
     validtypes = ['page', 'section']
     if type not in validtypes:
         raise ValueError('Page break style "%s" not implemented. Valid styles: %s.' % (type, validtypes))
-    pagebreak = makeelement('p')
+    pagebreak = Element(W.p, nsmap=DOCUMENT_NSMAP)
     if type == 'page':
-        run = makeelement('r')
-        br = makeelement('br',attributes={'type':type})
-        run.append(br)
-        pagebreak.append(run)
+        run = SubElement(pagebreak, W.r)
+        SubElement(run, W.br, {W.type: type})
     elif type == 'section':
-        pPr = makeelement('pPr')
-        sectPr = makeelement('sectPr')
+        pPr = SubElement(pagebreak, W.pPr)
+        sectPr = SubElement(pPr, W.sectPr)
         if orient == 'portrait':
-            pgSz = makeelement('pgSz',attributes={'w':'12240','h':'15840'})
+            SubElement(sectPr, W.pgSz, {W.w: '12240', W.h: '15840'})
         elif orient == 'landscape':
-            pgSz = makeelement('pgSz',attributes={'h':'12240','w':'15840', 'orient':'landscape'})
-        sectPr.append(pgSz)
-        pPr.append(sectPr)
-        pagebreak.append(pPr)
-    return pagebreak    
+            SubElement(sectPr, W.pgSz,
+                       {W.h: '12240', W.w: '15840', W.orient: 'landscape'})
+    return pagebreak
+
+
+# Font of runs formatted as code, see run().
+CODE_FONT = 'Courier New'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
+def run(text, format='', breakbefore=False):
+    '''Make a run of text, formatted by the characters of format: 'c' code
+    (monospaced), 'b' bold, 'i' italic, 'u' underline. Return the run
+    element.'''
+    run = Element(W.r)
+    if format:
+        rPr = SubElement(run, W.rPr)
+        # in the order of the schema
+        if 'c' in format:
+            SubElement(rPr, W.rFonts, {W.ascii: CODE_FONT,
+                                       W.hAnsi: CODE_FONT, W.cs: CODE_FONT})
+        if 'b' in format:
+            SubElement(rPr, W.b)
+        if 'i' in format:
+            SubElement(rPr, W.i)
+        if 'u' in format:
+            SubElement(rPr, W.u, {W.val: 'single'})
+    if breakbefore:
+        SubElement(run, W.lastRenderedPageBreak)
+    t = SubElement(run, W.t)
+    if text:
+        t.text = text
+        if text[0].isspace() or text[-1].isspace():
+            # Word drops the spaces between runs otherwise
+            t.set(XML_SPACE, 'preserve')
+    return run
+
+
+def _append_runs(paragraph, runs, breakbefore=False):
+    '''Append the (text, format) runs to paragraph, at least one.'''
+    for text, format in runs or [('', '')]:
+        paragraph.append(run(text, format, breakbefore))
+        breakbefore = False
+
 
 def paragraph(paratext,style='BodyText',breakbefore=False):
-    '''Make a new paragraph element, containing a run, and some text. 
+    '''Make a new paragraph element, containing a run, and some text.
+    paratext is a string, or a list of (text, format) runs (see run()).
     Return the paragraph element.'''
-    # Make our elements
-    paragraph = makeelement('p')
-    run = makeelement('r')    
-    
+    paragraph = Element(W.p, nsmap=DOCUMENT_NSMAP)
+    pPr = SubElement(paragraph, W.pPr)
+    SubElement(pPr, W.pStyle, {W.val: stylenames.get(style, 'BodyText')})
+    if not isinstance(paratext, basestring):
+        _append_runs(paragraph, paratext, breakbefore)
+        return paragraph
+    run = SubElement(paragraph, W.r)
     # Insert lastRenderedPageBreak for assistive technologies like
     # document narrators to know when a page break occurred.
     if breakbefore:
-        lastRenderedPageBreak = makeelement('lastRenderedPageBreak')
-        run.append(lastRenderedPageBreak)    
-    text = makeelement('t',tagtext=paratext)
-    pPr = makeelement('pPr')
-    style = stylenames.get(style, 'BodyText')
-    pStyle = makeelement('pStyle',attributes={'val':style})
-    pPr.append(pStyle)
-                
-    # Add the text the run, and the run to the paragraph
-    run.append(text)    
-    paragraph.append(pPr)    
-    paragraph.append(run)    
-    # Return the combined paragraph
+        SubElement(run, W.lastRenderedPageBreak)
+    text = SubElement(run, W.t)
+    if paratext:
+        text.text = paratext
     return paragraph
 
-def contenttypes():
-    prev_dir = os.getcwd() # save previous working dir
-    os.chdir(template_dir)
-
-    filename = '[Content_Types].xml'
-    if not os.path.exists(filename):
-        raise RuntimeError('You need %r file in template' % filename)
 
-    parts = dict([
-        (x.attrib['PartName'], x.attrib['ContentType'])
-        for x in etree.fromstring(open(filename).read()).xpath('*')
-        if 'PartName' in x.attrib
-    ])
+def contenttypes():
+    parts = get_template().contenttypes
 
     # FIXME - doesn't quite work...read from string as temp hack...
     #types = makeelement('Types',nsprefix='ct')
     types = etree.fromstring('''<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"></Types>''')
-    for part in parts:
-        types.append(makeelement('Override',nsprefix=None,attributes={'PartName':part,'ContentType':parts[part]}))
+    for part in sorted(parts):
+        types.append(makeelement('Override',nsprefix=None,attributes=[('PartName',part),('ContentType',parts[part])]))
     # Add support for filetypes
-    filetypes = {'rels':'application/vnd.openxmlformats-package.relationships+xml','xml':'application/xml','jpeg':'image/jpeg','gif':'image/gif','png':'image/png'}
-    for extension in filetypes:
-        types.append(makeelement('Default',nsprefix=None,attributes={'Extension':extension,'ContentType':filetypes[extension]}))
-
-    os.chdir(prev_dir)
+    filetypes = [('rels','application/vnd.openxmlformats-package.relationships+xml'),('xml','application/xml'),('jpeg','image/jpeg'),('gif','image/gif'),('png','image/png')]
+    for extension, contenttype in filetypes:
+        types.append(makeelement('Default',nsprefix=None,attributes=[('Extension',extension),('ContentType',contenttype)]))
     return types
 
+
 def heading(headingtext,headinglevel):
-    '''Make a new heading, return the heading element'''
-    # Make our elements
-    paragraph = makeelement('p')
-    pr = makeelement('pPr')
+    '''Make a new heading, return the heading element. headingtext is a
+    string or a list of (text, format) runs like in paragraph().'''
+    paragraph = Element(W.p, nsmap=DOCUMENT_NSMAP)
+    pPr = SubElement(paragraph, W.pPr)
     style = stylenames.get('Heading' + str(headinglevel), 'Normal')
-    pStyle = makeelement('pStyle',attributes={'val': style})
-    run = makeelement('r')
-    text = makeelement('t',tagtext=headingtext)
-    # Add the text the run, and the run to the paragraph
-    pr.append(pStyle)
-    run.append(text)
-    paragraph.append(pr)   
-    paragraph.append(run)    
-    # Return the combined paragraph
-    return paragraph   
+    SubElement(pPr, W.pStyle, {W.val: style})
+    if not isinstance(headingtext, basestring):
+        _append_runs(paragraph, headingtext)
+        return paragraph
+    run = SubElement(paragraph, W.r)
+    text = SubElement(run, W.t)
+    if headingtext:
+        text.text = headingtext
+    return paragraph
+
 
 def table(contents):
-    '''Get a list of lists, return a table'''
-    table = makeelement('tbl')
-    columns = len(contents[0][0])    
+    '''Get a list of rows, lists of cell contents (paragraph() text or
+    runs), return a table'''
+    table = Element(W.tbl, nsmap=DOCUMENT_NSMAP)
+    columns = len(contents[0])
     # Table properties
-    tableprops = makeelement('tblPr')
-    tablestyle = makeelement('tblStyle',attributes={'val':'ColorfulGrid-Accent1'})
-    tablewidth = makeelement('tblW',attributes={'w':'0','type':'auto'})
-    tablelook = makeelement('tblLook',attributes={'val':'0400'})
-    for tableproperty in [tablestyle,tablewidth,tablelook]:
-        tableprops.append(tableproperty)
-    table.append(tableprops)    
-    # Table Grid    
-    tablegrid = makeelement('tblGrid')
+    tableprops = SubElement(table, W.tblPr)
+    SubElement(tableprops, W.tblStyle, {W.val: 'ColorfulGrid-Accent1'})
+    SubElement(tableprops, W.tblW, {W.w: '0', W.type: 'auto'})
+    SubElement(tableprops, W.tblLook, {W.val: '0400'})
+    # Table Grid
+    tablegrid = SubElement(table, W.tblGrid)
     for _ in range(columns):
-        tablegrid.append(makeelement('gridCol',attributes={'w':'2390'}))
-    table.append(tablegrid)     
-    # Heading Row    
-    row = makeelement('tr')
-    rowprops = makeelement('trPr')
-    cnfStyle = makeelement('cnfStyle',attributes={'val':'000000100000'})
-    rowprops.append(cnfStyle)
-    row.append(rowprops)
+        SubElement(tablegrid, W.gridCol, {W.w: '2390'})
+    # Heading Row
+    row = SubElement(table, W.tr)
+    rowprops = SubElement(row, W.trPr)
+    SubElement(rowprops, W.cnfStyle, {W.val: '000000100000'})
     for heading in contents[0]:
-        cell = makeelement('tc')  
-        # Cell properties  
-        cellprops = makeelement('tcPr')
-        cellwidth = makeelement('tcW',attributes={'w':'2390','type':'dxa'})
-        cellstyle = makeelement('shd',attributes={'val':'clear','color':'auto','fill':'548DD4','themeFill':'text2','themeFillTint':'99'})
-        cellprops.append(cellwidth)
-        cellprops.append(cellstyle)
-        cell.append(cellprops)        
+        cell = SubElement(row, W.tc)
+        # Cell properties
+        cellprops = SubElement(cell, W.tcPr)
+        SubElement(cellprops, W.tcW, {W.w: '2390', W.type: 'dxa'})
+        SubElement(cellprops, W.shd, {
+            W.val: 'clear', W.color: 'auto', W.fill: '548DD4',
+            W.themeFill: 'text2', W.themeFillTint: '99'})
         # Paragraph (Content)
         cell.append(paragraph(heading))
-        row.append(cell)
-    table.append(row)            
-    # Contents Rows   
+    # Contents Rows
     for contentrow in contents[1:]:
-        row = makeelement('tr')     
-        for content in contentrow:   
-            cell = makeelement('tc')
+        row = SubElement(table, W.tr)
+        for content in contentrow:
+            cell = SubElement(row, W.tc)
             # Properties
-            cellprops = makeelement('tcPr')
-            cellwidth = makeelement('tcW',attributes={'type':'dxa'})
-            cellprops.append(cellwidth)
-            cell.append(cellprops)
+            cellprops = SubElement(cell, W.tcPr)
+            SubElement(cellprops, W.tcW, {W.type: 'dxa'})
             # Paragraph (Content)
             cell.append(paragraph(content))
-            row.append(cell)    
-        table.append(row)   
-    return table                 
+    return table
+
+
+def file_hash(filename):
+    '''Return the sha1 hex digest of the file content, read in chunks.
+    The builder also uses it for its caches.'''
+    digest = hashlib.sha1()
+    for chunk in _file_chunks(filename):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def add_media(relationshiplist, picpath, medianame=None, digest=None):
+    '''Add the image file picpath as a media part related from the
+    document, unless a file with the same content was added before. The
+    part is named after medianame, the base name of picpath by default.
+    digest is file_hash(picpath), if already known.
+    Return (relationship id, archive name, added).'''
+    if digest is None:
+        digest = file_hash(picpath)
+    if digest in media_parts:
+        relid, partname = media_parts[digest]
+        return relid, partname, False
+    picname = os.path.basename(medianame or picpath)
+    if 'word/media/' + picname in generated_parts:
+        # another image with the same name
+        root, ext = os.path.splitext(picname)
+        picname = '%s-%s%s' % (root, digest[:8], ext)
+    partname = 'word/media/' + picname
+    generated_parts[partname] = FilePart(picpath)
+    relid = 'rId'+str(len(relationshiplist)+1)
+    relationshiplist.append([
+        'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image',
+        'media/'+picname])
+    media_parts[digest] = (relid, partname)
+    return relid, partname, True
+
+
+# OpenXML measures on-screen objects in English Metric Units
+# 1cm = 36000 EMUs, 1 inch = 914400 EMUs, 1 twip (page setup) = 635 EMUs
+EMU_PER_INCH = 914400
+EMU_PER_TWIP = 635
+# size of a pixel of an image without a known resolution
+EMU_PER_PIXEL = 12667
+# text width of a Letter page with 1 inch margins, for templates without
+# page setup
+DEFAULT_TEXT_WIDTH = 6 * EMU_PER_INCH + EMU_PER_INCH // 2
+
+
+def picture_extent(pixelwidth, pixelheight, dpi=None, maxwidth=None):
+    '''Return the displayed (width, height) in EMU of an image of the pixel
+    size at dpi, its (horizontal, vertical) dots per inch or None if
+    unknown, scaled down to maxwidth EMU if it is wider.'''
+    if dpi and dpi[0] > 0 and dpi[1] > 0:
+        width = int(round(pixelwidth * EMU_PER_INCH / float(dpi[0])))
+        height = int(round(pixelheight * EMU_PER_INCH / float(dpi[1])))
+    else:
+        width = pixelwidth * EMU_PER_PIXEL
+        height = pixelheight * EMU_PER_PIXEL
+    if maxwidth and width > maxwidth:
+        height = int(round(height * maxwidth / float(width)))
+        width = maxwidth
+    return width, height
+
 
 def picture(relationshiplist, picname, picdescription, pixelwidth=None,
-            pixelheight=None, nochangeaspect=True, nochangearrowheads=True):
+            pixelheight=None, nochangeaspect=True, nochangearrowheads=True,
+            medianame=None, digest=None, extent=None):
     '''Take a relationshiplist, picture file name, and return a paragraph containing the image
-    and an updated relationshiplist'''
+    and an updated relationshiplist. The media part is named after
+    medianame if given, else after the picture file. digest is the
+    file_hash() of the picture file, if already known. extent is the
+    displayed (width, height) in EMU, see picture_extent(); by default
+    each pixel is EMU_PER_PIXEL.'''
     # http://openxmldeveloper.org/articles/462.aspx
     # Create an image. Size may be specified, otherwise it will based on the
     # pixel size of image. Return a paragraph containing the picture'''  
-    # Copy the file into the media dir
-    media_dir = join(template_dir,'word','media')
-    if not os.path.isdir(media_dir):
-        os.mkdir(media_dir)
-    picpath, picname = os.path.abspath(picname), os.path.basename(picname)
-    shutil.copyfile(picpath, join(media_dir,picname))
+    # Add the file to the generated media parts, it is read when saving
+    picpath = os.path.abspath(picname)
+    if digest is None:
+        digest = file_hash(picpath)
+    picrelid, partname, added = add_media(relationshiplist, picpath,
+                                          medianame, digest)
+    picname = partname.rsplit('/', 1)[-1]
 
     # Check if the user has specified a size
-    if not pixelwidth or not pixelheight:
+    if extent is None and (not pixelwidth or not pixelheight):
         # If not, get info from the picture itself
+        # PIL is imported here so that importing docx stays cheap.
+        try:
+            from PIL import Image
+        except ImportError:
+            import Image
         pixelwidth,pixelheight = Image.open(picpath).size[0:2]
 
-    # OpenXML measures on-screen objects in English Metric Units
-    # 1cm = 36000 EMUs            
-    emuperpixel = 12667
-    width = str(pixelwidth * emuperpixel)
-    height = str(pixelheight * emuperpixel)   
-    
-    # Set relationship ID to the first available  
-    picid = '2'    
-    picrelid = 'rId'+str(len(relationshiplist)+1)
-    relationshiplist.append([
-        'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image',
-        'media/'+picname])
+    if extent is None:
+        extent = picture_extent(pixelwidth, pixelheight)
+    width, height = str(extent[0]), str(extent[1])
     
+    # Relationship and drawing ids are only resolved when the document is
+    # saved (see RefResolver), so the drawing can be cached and reused.
+    picid = AUTO_ID
+    picrelid = MEDIA_REF + digest
+
+    # Build the drawing from the outside in:
+    # p/r/drawing/wp:inline/a:graphic/a:graphicData/pic:pic
+    paragraph = Element(W.p, nsmap=DOCUMENT_NSMAP)
+    run = SubElement(paragraph, W.r)
+    drawing = SubElement(run, W.drawing)
+    inline = SubElement(drawing, WP.inline, {
+        NONS.distT: '0', NONS.distB: '0', NONS.distL: '0', NONS.distR: '0'})
+    SubElement(inline, WP.extent, {NONS.cx: width, NONS.cy: height})
+    SubElement(inline, WP.effectExtent,
+               {NONS.l: '25400', NONS.t: '0', NONS.r: '0', NONS.b: '0'})
+    SubElement(inline, WP.docPr, {
+        NONS.id: picid, NONS.name: 'Picture 1', NONS.descr: picdescription})
+    framepr = SubElement(inline, WP.cNvGraphicFramePr)
+    SubElement(framepr, A.graphicFrameLocks, {NONS.noChangeAspect: '1'})
+    graphic = SubElement(inline, A.graphic)
+    graphicdata = SubElement(graphic, A.graphicData, {
+        NONS.uri: 'http://schemas.openxmlformats.org/drawingml/2006/picture'})
+    pic = SubElement(graphicdata, PIC.pic)
+
     # There are 3 main elements inside a picture
-    # 1. The Blipfill - specifies how the image fills the picture area (stretch, tile, etc.)
-    blipfill = makeelement('blipFill',nsprefix='pic')
-    blipfill.append(makeelement('blip',nsprefix='a',attrnsprefix='r',attributes={'embed':picrelid}))
-    stretch = makeelement('stretch',nsprefix='a')
-    stretch.append(makeelement('fillRect',nsprefix='a'))
-    blipfill.append(makeelement('srcRect',nsprefix='a'))
-    blipfill.append(stretch)
-    
-    # 2. The non visual picture properties 
-    nvpicpr = makeelement('nvPicPr',nsprefix='pic')
-    cnvpr = makeelement('cNvPr',nsprefix='pic',
-                        attributes={'id':'0','name':'Picture 1','descr':picname}) 
-    nvpicpr.append(cnvpr) 
-    cnvpicpr = makeelement('cNvPicPr',nsprefix='pic')                           
-    cnvpicpr.append(makeelement('picLocks', nsprefix='a', 
-                    attributes={'noChangeAspect':str(int(nochangeaspect)),
-                    'noChangeArrowheads':str(int(nochangearrowheads))}))
-    nvpicpr.append(cnvpicpr)
-        
+    # 1. The non visual picture properties
+    nvpicpr = SubElement(pic, PIC.nvPicPr)
+    SubElement(nvpicpr, PIC.cNvPr,
+               {NONS.id: '0', NONS.name: 'Picture 1', NONS.descr: picname})
+    cnvpicpr = SubElement(nvpicpr, PIC.cNvPicPr)
+    SubElement(cnvpicpr, A.picLocks, {
+        NONS.noChangeAspect: str(int(nochangeaspect)),
+        NONS.noChangeArrowheads: str(int(nochangearrowheads))})
+
+    # 2. The Blipfill - specifies how the image fills the picture area (stretch, tile, etc.)
+    blipfill = SubElement(pic, PIC.blipFill)
+    SubElement(blipfill, A.blip, {R.embed: picrelid})
+    SubElement(blipfill, A.srcRect)
+    stretch = SubElement(blipfill, A.stretch)
+    SubElement(stretch, A.fillRect)
+
     # 3. The Shape properties
-    sppr = makeelement('spPr',nsprefix='pic',attributes={'bwMode':'auto'})
-    xfrm = makeelement('xfrm',nsprefix='a')
-    xfrm.append(makeelement('off',nsprefix='a',attributes={'x':'0','y':'0'}))
-    xfrm.append(makeelement('ext',nsprefix='a',attributes={'cx':width,'cy':height}))
-    prstgeom = makeelement('prstGeom',nsprefix='a',attributes={'prst':'rect'})
-    prstgeom.append(makeelement('avLst',nsprefix='a'))
-    sppr.append(xfrm)
-    sppr.append(prstgeom)
-    
-    # Add our 3 parts to the picture element
-    pic = makeelement('pic',nsprefix='pic')    
-    pic.append(nvpicpr)
-    pic.append(blipfill)
-    pic.append(sppr)
-    
-    # Now make the supporting elements
-    # The following sequence is just: make element, then add its children
-    graphicdata = makeelement('graphicData',nsprefix='a',
-        attributes={'uri':'http://schemas.openxmlformats.org/drawingml/2006/picture'})
-    graphicdata.append(pic)
-    graphic = makeelement('graphic',nsprefix='a')
-    graphic.append(graphicdata)
-
-    framelocks = makeelement('graphicFrameLocks',nsprefix='a',attributes={'noChangeAspect':'1'})    
-    framepr = makeelement('cNvGraphicFramePr',nsprefix='wp')
-    framepr.append(framelocks)
-    docpr = makeelement('docPr',nsprefix='wp',
-        attributes={'id':picid,'name':'Picture 1','descr':picdescription})
-    effectextent = makeelement('effectExtent',nsprefix='wp',
-        attributes={'l':'25400','t':'0','r':'0','b':'0'})
-    extent = makeelement('extent',nsprefix='wp',attributes={'cx':width,'cy':height})
-    inline = makeelement('inline',
-        attributes={'distT':"0",'distB':"0",'distL':"0",'distR':"0"},nsprefix='wp')
-    inline.append(extent)
-    inline.append(effectextent)
-    inline.append(docpr)
-    inline.append(framepr)
-    inline.append(graphic)
-    drawing = makeelement('drawing')
-    drawing.append(inline)
-    run = makeelement('r')
-    run.append(drawing)
-    paragraph = makeelement('p')
-    paragraph.append(run)
+    sppr = SubElement(pic, PIC.spPr, {NONS.bwMode: 'auto'})
+    xfrm = SubElement(sppr, A.xfrm)
+    SubElement(xfrm, A.off, {NONS.x: '0', NONS.y: '0'})
+    SubElement(xfrm, A.ext, {NONS.cx: width, NONS.cy: height})
+    prstgeom = SubElement(sppr, A.prstGeom, {NONS.prst: 'rect'})
+    SubElement(prstgeom, A.avLst)
     return relationshiplist,paragraph
 
 
@@ -459,8 +1077,9 @@ def getdocumenttext(document):
             paratextlist.append(paratext)                    
     return paratextlist        
 
-def coreproperties(title,subject,creator,keywords,lastmodifiedby=None):
+def coreproperties(title,subject,creator,keywords,lastmodifiedby=None,timestamp=None):
     '''Create core properties (common document properties referred to in the 'Dublin Core' specification).
+    created/modified are the POSIX timestamp, or now if it is None.
     See appproperties() for other stuff.'''
     coreprops = makeelement('coreProperties',nsprefix='cp')    
     coreprops.append(makeelement('title',tagtext=title,nsprefix='dc'))
@@ -473,7 +1092,10 @@ def coreproperties(title,subject,creator,keywords,lastmodifiedby=None):
     coreprops.append(makeelement('revision',tagtext='1',nsprefix='cp'))
     coreprops.append(makeelement('category',tagtext='Examples',nsprefix='cp'))
     coreprops.append(makeelement('description',tagtext='Examples',nsprefix='dc'))
-    currenttime = time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if timestamp is None:
+        currenttime = time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    else:
+        currenttime = time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(timestamp))
     # Document creation and modify times
     # Prob here: we have an attribute who name uses one namespace, and that 
     # attribute's value uses another namespace.
@@ -489,25 +1111,26 @@ def appproperties():
     appprops = etree.fromstring(
     '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
     <Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties" xmlns:vt="http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes"></Properties>''')
-    props = {
-            'Template':'Normal.dotm',
-            'TotalTime':'6',
-            'Pages':'1',  
-            'Words':'83',   
-            'Characters':'475', 
-            'Application':'Microsoft Word 12.0.0',
-            'DocSecurity':'0',
-            'Lines':'12', 
-            'Paragraphs':'8',
-            'ScaleCrop':'false', 
-            'LinksUpToDate':'false', 
-            'CharactersWithSpaces':'583',  
-            'SharedDoc':'false',
-            'HyperlinksChanged':'false',
-            'AppVersion':'12.0000',    
-            }
-    for prop in props:
-        appprops.append(makeelement(prop,tagtext=props[prop],nsprefix=None))
+    # in the order of the schema, a dict would make it depend on the hash
+    props = [
+            ('Template','Normal.dotm'),
+            ('TotalTime','6'),
+            ('Pages','1'),
+            ('Words','83'),
+            ('Characters','475'),
+            ('Application','Microsoft Word 12.0.0'),
+            ('DocSecurity','0'),
+            ('Lines','12'),
+            ('Paragraphs','8'),
+            ('ScaleCrop','false'),
+            ('LinksUpToDate','false'),
+            ('CharactersWithSpaces','583'),
+            ('SharedDoc','false'),
+            ('HyperlinksChanged','false'),
+            ('AppVersion','12.0000'),
+            ]
+    for prop, value in props:
+        appprops.append(makeelement(prop,tagtext=value,nsprefix=None))
     return appprops
 
 
@@ -519,21 +1142,9 @@ def websettings():
     return web
 
 def relationshiplist():
-    prev_dir = os.getcwd() # save previous working dir
-    os.chdir(template_dir)
-
-    filename = 'word/_rels/document.xml.rels'
-    if not os.path.exists(filename):
-        raise RuntimeError('You need %r file in template' % filename)
-
-    relationships = etree.fromstring(open(filename).read())
-    relationshiplist = [
-            [x.attrib['Type'], x.attrib['Target']]
-            for x in relationships.xpath('*')
-    ]
+    '''Return a new relationship list, starting with the template's'''
+    return [list(rel) for rel in get_template().relationships]
 
-    os.chdir(prev_dir)
-    return relationshiplist
 
 def wordrelationships(relationshiplist):
     '''Generate a Word relationships file'''
@@ -547,48 +1158,140 @@ def wordrelationships(relationshiplist):
     count = 0
     for relationship in relationshiplist:
         # Relationship IDs (rId) start at 1.
-        relationships.append(makeelement('Relationship',attributes={'Id':'rId'+str(count+1),
-        'Type':relationship[0],'Target':relationship[1]},nsprefix=None))
+        relationships.append(makeelement('Relationship',attributes=[('Id','rId'+str(count+1)),
+        ('Type',relationship[0]),('Target',relationship[1])],nsprefix=None))
         count += 1
     return relationships    
 
-def savedocx(document,coreprops,appprops,contenttypes,websettings,wordrelationships,docxfilename):
-    '''Save a modified document'''
-    assert os.path.isdir(template_dir)
+
+class _nophase(object):
+    '''Stand-in for timer.phase() when no timer is given'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def _phase(timer, name):
+    if timer is None:
+        return _nophase()
+    return timer.phase(name)
+
+
+def _compress_job(job):
+    '''Compress a (partname, data, level, date_time) job of savedocx().
+    Return None for parts that are copied as they are (data is None).'''
+    partname, data, level, date_time = job
+    if data is None:
+        return None
+    start = default_timer()
+    zinfo, chunks = compress_part(partname, data, level, date_time)
+    return zinfo, chunks, default_timer() - start
+
+
+def _imap_parts(jobs, workers):
+    '''Yield (job, _compress_job(job)) in the order of jobs, compressing in
+    up to `workers` threads.'''
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield job, _compress_job(job)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        for i, result in enumerate(pool.imap(_compress_job, jobs)):
+            yield jobs[i], result
+    finally:
+        pool.terminate()
+
+
+def savedocx(document,coreprops,appprops,contenttypes,websettings,wordrelationships,docxfilename,timer=None,compression=None,workers=1,timestamp=None):
+    '''Save a modified document.
+    compression is the compression policy as returned by
+    compression_policy(), the default policy if None. Parts are compressed
+    in up to `workers` threads, and written in a fixed order.
+    Zip members are dated at the POSIX timestamp if given (now if None),
+    so the same parts always make the same file.
+    If timer is given, XML serialization and zip compression are recorded
+    as its 'serialize' and 'zip' phases (timer.phase(name) must return a
+    context manager), and the size, compressed size and time of each part
+    with timer.add_part(partname, size, compressed, seconds).'''
+    template = get_template()
+    if compression is None:
+        compression = compression_policy()
     docxfile = zipfile.ZipFile(docxfilename,mode='w',compression=zipfile.ZIP_DEFLATED)
-    
-    # Move to the template data path
-    prev_dir = os.path.abspath('.') # save previous working dir
-    os.chdir(template_dir)
-    
-    # Serialize our trees into out zip file
-    treesandfiles = {document:'word/document.xml',
-                     coreprops:'docProps/core.xml',
-                     appprops:'docProps/app.xml',
-                     contenttypes:'[Content_Types].xml',
-                     websettings:'word/webSettings.xml',
-                     wordrelationships:'word/_rels/document.xml.rels'}
-    for tree in treesandfiles:
-        print 'Saving: '+treesandfiles[tree]    
-        treestring = etree.tostring(tree, pretty_print=True)
-        docxfile.writestr(treesandfiles[tree],treestring)
-    
-    # Add & compress support files
-    files_to_ignore = ['.DS_Store'] # nuisance from some os's
-    files_to_skip = treesandfiles.values()
-    for dirpath,dirnames,filenames in os.walk('.'):
-        for filename in filenames:
-            if filename in files_to_ignore:
-                continue
-            templatefile = join(dirpath,filename)
-            archivename = os.path.normpath(templatefile)
-            archivename = '/'.join(archivename.split(os.sep))  # multibyte ok?
-            if archivename in files_to_skip:
-                continue
-            print 'Saving: '+archivename          
-            docxfile.write(templatefile, archivename)
+    # (partname, data, level, date_time) in archive order, data None for
+    # template parts copied from its archive
+    jobs = []
+    date_time = timestamp is not None and zip_date_time(timestamp) or None
+
+    def add_job(partname, data):
+        jobs.append((partname, data, compress_level(compression, partname),
+                     date_time))
+
+    # A DocumentStream is already serialized, copy its file
+    streamed = isinstance(document, DocumentStream)
+    if streamed:
+        with _phase(timer, 'serialize'):
+            document.close()
+        add_job('word/document.xml', FilePart(document.filename))
+
+    # Serialize our trees
+    treesandfiles = [(document, 'word/document.xml'),
+                     (coreprops, 'docProps/core.xml'),
+                     (appprops, 'docProps/app.xml'),
+                     (contenttypes, '[Content_Types].xml'),
+                     (websettings, 'word/webSettings.xml'),
+                     (wordrelationships, 'word/_rels/document.xml.rels')]
+    if streamed:
+        del treesandfiles[0]
+    for tree, archivename in treesandfiles:
+        with _phase(timer, 'serialize'):
+            if tree is document:
+                RefResolver().resolve(document)
+            add_job(archivename, etree.tostring(tree, pretty_print=True))
+
+    # Support files from the template
+    files_to_skip = set(name for tree, name in treesandfiles)
+    files_to_skip.add('word/document.xml')
+    files_to_skip.update(generated_parts)
+    archive = template.is_archive and template.open_archive() or None
+    for archivename in template.partnames:
+        if archivename in files_to_skip:
+            continue
+        if archive is not None:
+            jobs.append((archivename, None, None, None))
+        else:
+            add_job(archivename,
+                    FilePart(template.filename(archivename)))
+
+    # Generated parts
+    for archivename in sorted(generated_parts):
+        add_job(archivename, generated_parts[archivename])
+
+    try:
+        with _phase(timer, 'zip'):
+            for job, result in _imap_parts(jobs, workers):
+                archivename = job[0]
+                print 'Saving: ' + archivename
+                start = default_timer()
+                if result is None:
+                    template.copy_part(archivename, docxfile, archive)
+                    zinfo = docxfile.getinfo(archivename)
+                    seconds = 0
+                else:
+                    zinfo, chunks, seconds = result
+                    _write_member(docxfile, zinfo, chunks)
+                if timer is not None:
+                    timer.add_part(archivename, zinfo.file_size,
+                                   zinfo.compress_size,
+                                   seconds + default_timer() - start)
+            docxfile.close()
+    finally:
+        if archive is not None:
+            archive.close()
+        if streamed:
+            document.discard()
     print 'Saved new file to: '+docxfilename
-    os.chdir(prev_dir) # restore previous working dir
     return
-    
-
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.fragments
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Translated WordprocessingML fragments, cached per document.
+
+    The assembled doctree holds one ``start_of_file`` node per included
+    document.  The body blocks translated from such a node are kept in the
+    doctree directory, keyed by a hash of the node's content and of
+    everything else the translation depends on, so an unchanged document
+    is not translated again.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+
+from lxml import etree
+
+from cache import PickleCache, content_hash
+from docx import file_hash
+
+#: bump when the cache files change, to drop cached fragments.  Changes of
+#: the translator are detected by source_hash().
+FRAGMENT_FORMAT = 6
+
+
+def source_hash(filenames):
+    """Return a hash of the source files `filenames` (module __file__
+    values), part of the fragment keys so that fragments translated by
+    other code are not used."""
+    digests = []
+    for filename in filenames:
+        if filename.endswith(('.pyc', '.pyo')):
+            filename = filename[:-1]
+        try:
+            digests.append(file_hash(filename))
+        except (IOError, OSError):
+            # only the bytecode is installed, assume it is unchanged
+            digests.append(os.path.basename(filename))
+    return content_hash(' '.join(digests))
+
+
+class Fragment(object):
+    """The translation of one document.
+
+    * blocks: serialized body block elements, holding symbolic media
+      references and drawing ids (see docx.RefResolver)
+    * media: (stored file, media name, digest) of the images the blocks
+      refer to
+    * pending: (text, format) runs left to the enclosing translator state
+    * sectionlevel: translator section level after the document
+    """
+
+    def __init__(self, blocks, media, pending, sectionlevel):
+        self.blocks = blocks
+        self.media = media
+        self.pending = pending
+        self.sectionlevel = sectionlevel
+
+    def elements(self):
+        """Return the blocks as elements."""
+        return [etree.fromstring(block) for block in self.blocks]
+
+
+class FragmentRecorder(object):
+    """Stand-in for the document body while a document is translated:
+    blocks are appended to `docbody` (unless it is None) and recorded,
+    until release() is called."""
+
+    def __init__(self, docbody, docname, key):
+        self.docbody = docbody
+        self.docname = docname
+        self.key = key
+        self.blocks = []
+        self.media = []
+
+    def append(self, element):
+        # before the body (e.g. a docx.DocumentStream) resolves references
+        if self.blocks is not None:
+            self.blocks.append(etree.tostring(element))
+        if self.docbody is not None:
+            self.docbody.append(element)
+
+    def release(self):
+        """Drop the recorded blocks and stop recording; blocks are still
+        appended to docbody, and fragment() returns None."""
+        self.blocks = None
+
+    def fragment(self, pending, sectionlevel):
+        if self.blocks is None:
+            return None
+        return Fragment(self.blocks, self.media, pending, sectionlevel)
+
+
+class FragmentCache(object):
+    """Fragments stored in `directory`, one pickle file per document.
+
+    A file keeps the fragments of the last `keep` keys put, so documents
+    included by several docx_documents targets, e.g. with different
+    templates, are reused by each of them.
+    """
+
+    def __init__(self, directory, keep=4):
+        self.directory = directory
+        self.keep = keep
+        self.hits = 0
+        self.misses = 0
+
+    def _cache(self, docname):
+        return PickleCache(os.path.join(
+            self.directory, content_hash(docname.encode('utf-8')) +
+            '.pickle'), version=FRAGMENT_FORMAT)
+
+    def get(self, docname, key):
+        fragment = self._cache(docname).get(key, (0, None))[1]
+        if fragment is None or \
+                not all(os.path.exists(m[0]) for m in fragment.media):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fragment
+
+    def put(self, docname, key, fragment):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        cache = self._cache(docname)
+        # {key: (serial, fragment)}, the highest serial was put last
+        serial = max([s for s, f in cache.data.values()] or [0]) + 1
+        cache[key] = (serial, fragment)
+        for old in sorted(cache.data, key=lambda k: cache.data[k][0],
+                          reverse=True)[self.keep:]:
+            del cache.data[old]
+        cache.save()
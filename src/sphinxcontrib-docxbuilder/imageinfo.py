@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.imageinfo
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Image size and resolution from the file header.
+
+    PNG, GIF and JPEG headers are parsed directly, which only reads the
+    first few KiB of a file.  Other formats (and files the parsers do not
+    understand) fall back to PIL, imported only when needed.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import struct
+
+from cache import PickleCache
+from docx import file_hash
+
+
+class ImageInfo(object):
+    """Pixel size, resolution (dots per inch, None if unknown) and format
+    of an image."""
+
+    def __init__(self, width, height, dpi=None, format=None):
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.format = format
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def __eq__(self, other):
+        return isinstance(other, ImageInfo) and \
+            self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<ImageInfo %s %dx%d dpi=%r>' % (
+            self.format, self.width, self.height, self.dpi)
+
+
+def _png(f):
+    head = f.read(33)
+    if len(head) < 33 or head[12:16] != 'IHDR':
+        return None
+    width, height = struct.unpack('>II', head[16:24])
+    dpi = None
+    # pHYs must come before the first IDAT chunk
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        length, tag = struct.unpack('>I4s', chunk)
+        if tag == 'pHYs':
+            data = f.read(9)
+            if len(data) == 9:
+                x, y, unit = struct.unpack('>IIB', data)
+                if unit == 1:  # pixels per metre
+                    dpi = (int(round(x * 0.0254)), int(round(y * 0.0254)))
+            break
+        if tag in ('IDAT', 'IEND'):
+            break
+        f.seek(length + 4, 1)  # data and CRC
+    return ImageInfo(width, height, dpi, 'PNG')
+
+
+def _gif(f):
+    head = f.read(10)
+    if len(head) < 10:
+        return None
+    width, height = struct.unpack('<HH', head[6:10])
+    return ImageInfo(width, height, None, 'GIF')
+
+
+# start of frame markers, i.e. all SOFn but DHT, JPG and DAC
+_JPEG_SOF = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+
+
+def _jpeg(f):
+    f.read(2)
+    dpi = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return None
+        code = ord(marker[1])
+        if code == 0xff:  # fill byte
+            f.seek(-1, 1)
+            continue
+        if code in (0x01, 0xd8) or 0xd0 <= code <= 0xd7:
+            continue  # markers without a segment
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        length = struct.unpack('>H', data)[0] - 2
+        if code in _JPEG_SOF:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            return ImageInfo(width, height, dpi, 'JPEG')
+        if code == 0xe0 and length >= 12:  # APP0
+            data = f.read(12)
+            length -= 12
+            if data[:5] == 'JFIF\x00':
+                unit, x, y = struct.unpack('>BHH', data[7:12])
+                if unit == 1 and x and y:
+                    dpi = (x, y)
+                elif unit == 2 and x and y:  # dots per cm
+                    dpi = (int(round(x * 2.54)), int(round(y * 2.54)))
+        f.seek(length, 1)
+
+
+_PARSERS = [
+    ('\x89PNG\r\n\x1a\n', _png),
+    ('GIF87a', _gif),
+    ('GIF89a', _gif),
+    ('\xff\xd8', _jpeg),
+]
+
+
+def read_header(filename):
+    """Return the ImageInfo of a PNG, GIF or JPEG file from its header, or
+    None if the format is not known."""
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(8)
+        for prefix, parser in _PARSERS:
+            if magic.startswith(prefix):
+                f.seek(0)
+                try:
+                    return parser(f)
+                except struct.error:
+                    return None
+    finally:
+        f.close()
+    return None
+
+
+def read_pil(filename):
+    """Return the ImageInfo of any image PIL can open."""
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    image = Image.open(filename)
+    dpi = image.info.get('dpi')
+    if dpi:
+        dpi = tuple(int(round(d)) for d in dpi[:2])
+    return ImageInfo(image.size[0], image.size[1], dpi or None, image.format)
+
+
+def probe(filename):
+    """Return the ImageInfo of an image file."""
+    return read_header(filename) or read_pil(filename)
+
+
+class ImageProber(object):
+    """Probe and hash images, caching the results by path, mtime and size
+    in the pickle file `cachefile` (kept in the doctree directory), so an
+    unchanged image costs one stat() call."""
+
+    def __init__(self, cachefile):
+        # {absolute path: ((mtime, size), ImageInfo, file_hash())}, the
+        # ImageInfo or hash None until it is asked for
+        self.cache = PickleCache(cachefile, version=2)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, filename, info=False, digest=False):
+        """Return (ImageInfo, file_hash()) of `filename`.  The ones asked
+        for by `info` and `digest` are computed if they are not cached for
+        the current mtime and size; others are None unless cached."""
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        cached = self.cache.get(filename)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, None, None)
+        stamp, result, hashed = cached
+        if info:
+            if result is None:
+                self.misses += 1
+                result = probe(filename)
+            else:
+                self.hits += 1
+        if digest and hashed is None:
+            hashed = file_hash(filename)
+        if (stamp, result, hashed) != cached:
+            self.cache[filename] = (stamp, result, hashed)
+        return result, hashed
+
+    def probe(self, filename):
+        """Return the ImageInfo of `filename`."""
+        return self.lookup(filename, info=True)[0]
+
+    def digest(self, filename):
+        """Return the file_hash() of `filename`."""
+        return self.lookup(filename, digest=True)[1]
+
+    def save(self):
+        self.cache.save()
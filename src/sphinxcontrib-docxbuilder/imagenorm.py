@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.imagenorm
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Optional image normalization for the docx output.
+
+    Images larger than what fits a page at a useful resolution are scaled
+    down and recompressed before they are stored in the docx file.  The
+    results are cached on disk by source content and settings, so each
+    image is converted once, and misses are converted in a process pool.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+
+from cache import content_hash, replace_file
+from docx import file_hash
+
+
+#: default settings: a 6.5 x 9 inch text area at 150 dpi.
+NORMALIZE_DEFAULTS = {
+    'max_width': 975,
+    'max_height': 1350,
+    'jpeg_quality': 85,
+}
+
+#: formats that are recompressed, by file extension.
+FORMATS = {
+    '.png': 'PNG',
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+}
+
+
+def normalize_settings(setting):
+    """Return the settings dict for the docx_image_normalize value
+    `setting` (false, true or a dict updating NORMALIZE_DEFAULTS), or None
+    if normalization is off."""
+    if not setting:
+        return None
+    settings = dict(NORMALIZE_DEFAULTS)
+    if isinstance(setting, dict):
+        unknown = set(setting) - set(NORMALIZE_DEFAULTS)
+        if unknown:
+            raise ValueError('unknown settings: %s' %
+                             ', '.join(sorted(unknown)))
+        settings.update(setting)
+    for key, value in settings.items():
+        settings[key] = int(value)
+    return settings
+
+
+def normalize_image(source, target, settings):
+    """Write `source` scaled down to fit the settings and recompressed to
+    `target`.  Return False, writing nothing, if that would not make the
+    image smaller."""
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    image = Image.open(source)
+    format = image.format
+    size = (settings['max_width'], settings['max_height'])
+    scaled = image.size[0] > size[0] or image.size[1] > size[1]
+    if scaled:
+        image.thumbnail(size, getattr(Image, 'LANCZOS', Image.ANTIALIAS))
+    options = {}
+    if format == 'JPEG':
+        options['quality'] = settings['jpeg_quality']
+        options['optimize'] = True
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+    elif format == 'PNG':
+        options['optimize'] = True
+    else:
+        return False
+    tmpname = '%s.%d.tmp' % (target, os.getpid())
+    image.save(tmpname, format, **options)
+    if not scaled and os.path.getsize(tmpname) >= os.path.getsize(source):
+        os.remove(tmpname)
+        return False
+    replace_file(tmpname, target)
+    return True
+
+
+def _normalize_job(job):
+    source, target, settings = job
+    try:
+        return normalize_image(source, target, settings), None
+    except Exception, err:
+        return False, '%s: %s' % (err.__class__.__name__, err)
+
+
+class ImageNormalizer(object):
+    """Normalize images into `cachedir`.
+
+    A normalized image is named by the hash of the source content and of
+    the settings.  Images that would not get smaller are remembered by an
+    empty marker file, and used as they are.
+    """
+
+    def __init__(self, cachedir, settings, workers=1, digest=file_hash):
+        self.cachedir = cachedir
+        self.settings = settings
+        self.settings_key = content_hash(repr(sorted(settings.items())))
+        self.workers = workers
+        # file_hash() or a cached equivalent, e.g. ImageProber.digest
+        self.digest = digest
+        self.errors = {}
+
+    def target(self, source, digest=None):
+        """Return the file name of the normalized `source`, whose
+        file_hash() is `digest` if it is already known."""
+        ext = os.path.splitext(source)[1].lower()
+        key = content_hash((digest or self.digest(source)) +
+                           self.settings_key)
+        return os.path.join(self.cachedir, key + ext)
+
+    def cached(self, target):
+        """Return the cached result for `target`: its file name, False for
+        images used as they are, None if not converted yet."""
+        if os.path.exists(target):
+            return target
+        if os.path.exists(target + '.orig'):
+            return False
+        return None
+
+    def normalize_all(self, sources):
+        """Convert the images in `sources` that are not cached yet."""
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        jobs = []
+        for source in sorted(set(sources)):
+            if os.path.splitext(source)[1].lower() not in FORMATS:
+                continue
+            target = self.target(source)
+            if self.cached(target) is None:
+                jobs.append((source, target, self.settings))
+        if not jobs:
+            return
+        if self.workers > 1 and len(jobs) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(self.workers, len(jobs)))
+            try:
+                results = pool.map(_normalize_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_normalize_job, jobs)
+        for (source, target, settings), (done, error) in zip(jobs, results):
+            if error:
+                self.errors[source] = error
+            elif not done:
+                open(target + '.orig', 'w').close()
+
+    def normalize(self, source, digest=None):
+        """Return the file name of the normalized `source` image, which is
+        `source` itself if it is not changed.  `digest` is as in
+        target()."""
+        if os.path.splitext(source)[1].lower() not in FORMATS:
+            return source
+        target = self.target(source, digest)
+        if self.cached(target) is None and source not in self.errors:
+            self.normalize_all([source])
+        return self.cached(target) or source
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.media
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Image pre-pass: everything the translator needs to know about the
+    images of a document, computed before translation and in parallel.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+from imageinfo import ImageInfo
+
+
+class MediaRecord(object):
+    """An image of the document, ready to be added.
+
+    * source: the image file referred to by the document
+    * info: ImageInfo of the source
+    * path: the file stored in the docx file, source or its normalized copy
+    * digest: file_hash() of path
+    * stored: ImageInfo of path, with the resolution of the source scaled
+      to its pixel size, so it is displayed at the size of the source
+    """
+
+    def __init__(self, source, info, path, digest, stored=None):
+        self.source = source
+        self.info = info
+        self.path = path
+        self.digest = digest
+        self.stored = stored or info
+
+    def __repr__(self):
+        return '<MediaRecord %s>' % self.source
+
+
+def make_record(source, prober, normalizer=None):
+    """Probe, normalize and hash one image.  The probe results and hashes
+    are cached by `prober`, so an unchanged image is not read again."""
+    info, digest = prober.lookup(source, info=True, digest=True)
+    path, stored = source, info
+    if normalizer is not None:
+        path = normalizer.normalize(source, digest)
+        if path != source:
+            stored, digest = prober.lookup(path, info=True, digest=True)
+            stored = ImageInfo(stored.width, stored.height,
+                               scale_dpi(info.dpi, info, stored),
+                               stored.format)
+    return MediaRecord(source, info, path, digest, stored)
+
+
+def scale_dpi(dpi, info, scaled):
+    """Return the resolution `dpi` of the image `info` (None if unknown)
+    for its copy of another pixel size, `scaled`."""
+    if not dpi or not info.width or not info.height:
+        return None
+    return (dpi[0] * scaled.width / float(info.width),
+            dpi[1] * scaled.height / float(info.height))
+
+
+def prepare_media(sources, prober, normalizer=None, workers=1):
+    """Return {source: MediaRecord} for the image files `sources`.
+
+    Images are converted by `normalizer` (if given) in its process pool,
+    then probed and hashed in up to `workers` threads, as both mostly wait
+    for file reads or run in hashlib and zlib without the GIL.
+    Images that cannot be read are left out, the translator reports them.
+    """
+    sources = sorted(set(sources))
+    if normalizer is not None:
+        normalizer.normalize_all(sources)
+
+    def record(source):
+        try:
+            return make_record(source, prober, normalizer)
+        except (IOError, OSError):
+            return None
+
+    if workers > 1 and len(sources) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(sources)))
+        try:
+            records = pool.map(record, sources)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        records = map(record, sources)
+    return dict((r.source, r) for r in records if r is not None)
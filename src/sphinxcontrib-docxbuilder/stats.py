@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.stats
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Build phase statistics for the docx builder.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+STATS_FORMAT = 3
+
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+elif sys.platform != 'win32':
+    cpu_time = time.clock  # processor time on Unix
+else:
+    def cpu_time():
+        t = os.times()
+        return t[0] + t[1]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in KiB or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024  # bytes on Mac OS X
+    return rss
+
+
+class PhaseStat(object):
+    """Accumulated times of one phase, and the largest growth of the
+    process peak memory (in KiB) during one of its calls.
+
+    * wall: elapsed time of the calls in this process
+    * worker_wall: wall time of the calls merged from worker processes,
+      added up although they ran concurrently
+    * cpu: CPU time of all calls, in this process and in workers
+    """
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.calls = 0
+        self.wall = 0.0
+        self.worker_wall = 0.0
+        self.cpu = 0.0
+        self.rss_growth = None
+
+    def todict(self):
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'wall': round(self.wall, 6),
+            'worker_wall': round(self.worker_wall, 6),
+            'cpu': round(self.cpu, 6),
+            'rss_growth_kb': self.rss_growth,
+        }
+
+
+class PartStat(object):
+    """Size, compressed size and write time of one part of the output."""
+
+    def __init__(self, name, size, compressed, wall):
+        self.name = name
+        self.size = size
+        self.compressed = compressed
+        self.wall = wall
+
+    def todict(self):
+        return {
+            'name': self.name,
+            'bytes': self.size,
+            'compressed_bytes': self.compressed,
+            'wall': round(self.wall, 6),
+        }
+
+
+class BuildStats(object):
+    """Record the time spent in each phase of a build.
+
+    Phases nest: a phase entered while another one is running is recorded
+    as ``parent/child``.  Entering the same phase again accumulates into
+    the existing record, so short and frequent steps (e.g. one image) can
+    be measured without flooding the report::
+
+        stats = BuildStats()
+        with stats.phase('translate'):
+            with stats.phase('images'):
+                ...
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.parts = []
+        self.images = 0
+        self.images_deduplicated = 0
+        self.fragments = 0
+        self.fragments_reused = 0
+        self._phases = {}
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name):
+        self._stack.append(name)
+        key = '/'.join(self._stack)
+        stat = self._phases.get(key)
+        if stat is None:
+            stat = self._phases[key] = PhaseStat(key, len(self._stack) - 1)
+            self.phases.append(stat)
+        wall, cpu, rss = timer(), cpu_time(), peak_rss()
+        try:
+            yield stat
+        finally:
+            stat.calls += 1
+            stat.wall += timer() - wall
+            stat.cpu += cpu_time() - cpu
+            if rss is not None:
+                # ru_maxrss is the peak of the process lifetime, only its
+                # growth belongs to this phase
+                stat.rss_growth = max(stat.rss_growth, peak_rss() - rss)
+            self._stack.pop()
+
+    def add_part(self, name, size, compressed, wall):
+        """Record a part written into the output archive."""
+        self.parts.append(PartStat(name, size, compressed, wall))
+
+    def add_image(self, deduplicated):
+        """Record an image reference, `deduplicated` if its content was
+        already stored."""
+        self.images += 1
+        if deduplicated:
+            self.images_deduplicated += 1
+
+    def add_fragment(self, reused):
+        """Record a document translation, `reused` from the fragment
+        cache."""
+        self.fragments += 1
+        if reused:
+            self.fragments_reused += 1
+
+    def merge(self, other, parent=None):
+        """Add the statistics of `other`, e.g. collected in a worker
+        process, with its phases nested in the `parent` phase if given.
+        Their wall times go to worker_wall, so wall stays the elapsed time
+        of this process."""
+        for stat in other.phases:
+            name, depth = stat.name, stat.depth
+            if parent:
+                name, depth = parent + '/' + name, depth + 1
+            mine = self._phases.get(name)
+            if mine is None:
+                mine = self._phases[name] = PhaseStat(name, depth)
+                self.phases.append(mine)
+            mine.calls += stat.calls
+            mine.worker_wall += stat.wall + stat.worker_wall
+            mine.cpu += stat.cpu
+            if stat.rss_growth is not None:
+                mine.rss_growth = max(mine.rss_growth, stat.rss_growth)
+        self.parts.extend(other.parts)
+        self.images += other.images
+        self.images_deduplicated += other.images_deduplicated
+        self.fragments += other.fragments
+        self.fragments_reused += other.fragments_reused
+
+    @property
+    def image_hit_rate(self):
+        return self.images and float(self.images_deduplicated) / self.images
+
+    def report(self):
+        """Return the summary tables as a list of lines."""
+        lines = ['%-32s %6s %10s %10s %10s %12s' % (
+            'phase', 'calls', 'wall(s)', 'workers(s)', 'cpu(s)',
+            'peak RSS +MB')]
+        workers = False
+        for stat in self.phases:
+            label = '  ' * stat.depth + stat.name.rsplit('/', 1)[-1]
+            if stat.rss_growth is None:
+                rss = '-'
+            else:
+                rss = '%.1f' % (stat.rss_growth / 1024.0)
+            if stat.worker_wall:
+                worker_wall = '%.3f' % stat.worker_wall
+                workers = True
+            else:
+                worker_wall = '-'
+            lines.append('%-32s %6d %10.3f %10s %10.3f %12s' % (
+                label, stat.calls, stat.wall, worker_wall, stat.cpu, rss))
+        if workers:
+            lines.append('wall: elapsed in the main process, cpu: summed '
+                         'over all processes,')
+            lines.append('workers: wall time summed over the worker '
+                         'processes, which overlap')
+        if self.parts:
+            lines.append('')
+            lines.append('%-40s %10s %10s %6s %10s' % (
+                'part', 'bytes', 'zipped', 'ratio', 'wall(s)'))
+            for part in self.parts:
+                ratio = part.size and 100.0 * part.compressed / part.size
+                lines.append('%-40s %10d %10d %5.0f%% %10.4f' % (
+                    part.name, part.size, part.compressed, ratio, part.wall))
+        if self.images:
+            lines.append('')
+            lines.append('images: %d references, %d stored, %d deduplicated '
+                         '(%.0f%%)' % (
+                             self.images,
+                             self.images - self.images_deduplicated,
+                             self.images_deduplicated,
+                             self.image_hit_rate * 100))
+        if self.fragments:
+            lines.append('documents: %d translated, %d reused from cache' % (
+                self.fragments - self.fragments_reused,
+                self.fragments_reused))
+        return lines
+
+    def todict(self):
+        return {
+            'format': STATS_FORMAT,
+            'phases': [stat.todict() for stat in self.phases],
+            'parts': [part.todict() for part in self.parts],
+            'images': {
+                'references': self.images,
+                'deduplicated': self.images_deduplicated,
+                'hit_rate': round(self.image_hit_rate, 4),
+            },
+            'fragments': {
+                'documents': self.fragments,
+                'reused': self.fragments_reused,
+            },
+        }
+
+    def dump(self, filename):
+        f = open(filename, 'w')
+        try:
+            json.dump(self.todict(), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
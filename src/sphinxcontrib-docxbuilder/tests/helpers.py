@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Shared setup of the tests.
+
+Importing this module puts the extension directory on sys.path, so the
+test modules import it first and then the extension modules.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+from nose.tools import with_setup
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(CURRENT_DIR)
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)),
+                            'examples', 'source')
+EXAMPLE_TEMPLATE = os.path.join(EXAMPLES_DIR, 'template.docx')
+EXAMPLE_IMAGE = os.path.join(EXAMPLES_DIR, 'image1.png')
+
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+_tempdirs = []
+
+
+def setup_tempdir():
+    _tempdirs.append(tempfile.mkdtemp())
+
+
+def teardown_tempdir():
+    shutil.rmtree(_tempdirs.pop(), ignore_errors=True)
+
+
+def tempdir(*names):
+    """Return the path of `names` in the temporary directory of the
+    running test (the directory itself without `names`)."""
+    return os.path.join(_tempdirs[-1], *names)
+
+
+# decorates a test that uses tempdir()
+with_tempdir = with_setup(setup_tempdir, teardown_tempdir)
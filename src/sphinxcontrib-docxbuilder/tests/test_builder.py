@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from helpers import tempdir, with_tempdir
+
+from builder import DocxBuilder
+from stats import BuildStats
+
+
+class Config(object):
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+        self.values = dict.fromkeys(values)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+class Env(object):
+
+    def __init__(self, docnames, srcdir=''):
+        self.srcdir = srcdir
+        self.found_docs = set(docnames)
+        self.all_docs = dict.fromkeys(docnames, 0)
+
+    def doc2path(self, docname):
+        return os.path.join(self.srcdir, docname + '.rst')
+
+
+def make_builder(documents, docnames=('index', 'api'), directory=''):
+    builder = DocxBuilder.__new__(DocxBuilder)
+    builder.config = Config(docx_documents=documents, master_doc='index',
+                            project='p', version='1', docx_template=None)
+    builder.env = Env(docnames, directory)
+    builder.srcdir = builder.outdir = builder.doctreedir = directory
+    builder.warnings = []
+    builder.warn = lambda message, *args: builder.warnings.append(message)
+    return builder
+
+
+def test_document_entries():
+    builder = make_builder([('index', 'manual.docx'),
+                            ['api', 'api', 'api.dotx']])
+    assert builder.document_entries() == [('index', 'manual', None),
+                                          ('api', 'api', 'api.dotx')]
+    assert builder.warnings == []
+    assert make_builder([]).document_entries() == [('index', 'p-1', None)]
+
+
+def test_malformed_document_entries_are_skipped():
+    builder = make_builder([('index',), 'index', ('index', None),
+                            ('index', 'a', None, 'extra'),
+                            ('missing', 'b'), ('api', 'api')])
+    assert builder.document_entries() == [('api', 'api', None)]
+    assert len(builder.warnings) == 5
+    builder.warnings[:] = []
+    assert builder.document_entries(False) == [('missing', 'b', None),
+                                               ('api', 'api', None)]
+    assert builder.warnings == []
+
+
+@with_tempdir
+def test_unknown_start_document_does_not_outdate_targets():
+    builder = make_builder([('index', 'manual'), ('missing', 'x')],
+                           ['index'], tempdir())
+    for name in ['index.rst', 'index.doctree', 'manual.docx']:
+        open(tempdir(name), 'w').close()
+        os.utime(tempdir(name), (1000, 1000))
+    buildinfo = builder.buildinfo()
+    buildinfo['config'] = builder.config_hash()
+    buildinfo.save()
+    assert builder.get_outdated_docs() == []
+    os.utime(tempdir('index.rst'), (2000, 2000))
+    assert builder.get_outdated_docs() == ['index']
+
+
+def test_worker_warnings_are_collected():
+    builder = make_builder([])
+    parent_warn = builder.warn
+    builder.start_worker()
+    builder.warn('message', ('index', 1))
+    assert builder.warnings == []
+    warnings = builder.worker_warnings
+    builder.warn = parent_warn
+    builder.emit_warnings(warnings)
+    assert builder.warnings == ['message']
+
+
+class FailingWriter(object):
+
+    def write(self, doctree, destination):
+        pass
+
+    def save(self, filename):
+        open(filename, 'w').write('partial')
+        raise IOError('disk full')
+
+    def discard(self):
+        pass
+
+
+@with_tempdir
+def test_failed_save_removes_temporary_file():
+    builder = make_builder([], directory=tempdir())
+    builder.config.docx_reproducible = True
+    builder.out_suffix = '.docx'
+    builder.stats = BuildStats()
+    builder.written = {}
+    builder.writer = FailingWriter()
+    builder.write_doc('manual', None)
+    assert os.listdir(tempdir()) == []
+    assert 'disk full' in builder.warnings[0]
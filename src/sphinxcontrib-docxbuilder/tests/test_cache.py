@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from helpers import tempdir, with_tempdir
+
+from cache import PickleCache
+
+
+@with_tempdir
+def test_pickle_cache_roundtrip():
+    filename = tempdir('cache.pickle')
+    cache = PickleCache(filename)
+    assert cache.get('key') is None
+    cache['key'] = {'Heading1': '1'}
+    cache.save()
+
+    cache = PickleCache(filename)
+    assert cache['key'] == {'Heading1': '1'}
+    # another version does not see the old data
+    assert 'key' not in PickleCache(filename, version=2)
+
+
+@with_tempdir
+def test_pickle_cache_ignores_broken_file():
+    filename = tempdir('cache.pickle')
+    open(filename, 'wb').write('broken')
+    assert len(PickleCache(filename)) == 0
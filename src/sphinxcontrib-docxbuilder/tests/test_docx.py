@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import zipfile
+import subprocess
+from StringIO import StringIO
+
+from helpers import CURRENT_DIR, EXAMPLE_IMAGE, EXAMPLE_TEMPLATE, \
+    tempdir, with_tempdir
+
+import docx
+
+
+def test_read_stylenames():
+    names = docx.read_stylenames(
+        os.path.join(docx.TEMPLATE_DIR, 'word', 'styles.xml'))
+    assert names['Normal'] == 'Normal'
+    assert names['heading 1'] == 'Heading1'
+
+
+def test_read_stylenames_prefers_aliases():
+    data = zipfile.ZipFile(EXAMPLE_TEMPLATE).read('word/styles.xml')
+    names = docx.read_stylenames(StringIO(data))
+    assert names['Heading1'] == '1'
+    assert names['Normal'] == 'a'
+
+
+def test_qnames_are_cached():
+    w = docx.nsprefixes['w']
+    assert docx.W.p == '{%s}p' % w
+    assert docx.qnames('w') is docx.W
+    assert docx.NONS.id == 'id'
+
+
+def test_makeelement_attribute_namespaces():
+    w = docx.nsprefixes['w']
+    r = docx.nsprefixes['r']
+    elem = docx.makeelement('pStyle', attributes={'val': 'Normal'})
+    assert elem.get('{%s}val' % w) == 'Normal'
+    elem = docx.makeelement('blip', nsprefix='a', attrnsprefix='r',
+                            attributes={'embed': 'rId1'})
+    assert elem.get('{%s}embed' % r) == 'rId1'
+    elem = docx.makeelement('docPr', nsprefix='wp', attributes={'id': '1'})
+    assert elem.get('id') == '1'
+
+
+def test_paragraph_structure():
+    p = docx.paragraph(u'text', breakbefore=True)
+    w = '{%s}' % docx.nsprefixes['w']
+    assert [c.tag for c in p] == [w + 'pPr', w + 'r']
+    assert [c.tag for c in p[1]] == [w + 'lastRenderedPageBreak', w + 't']
+    assert p[1][1].text == u'text'
+
+
+def test_template_is_parsed_once_and_shared():
+    template = docx.Template.load(docx.TEMPLATE_DIR)
+    assert docx.Template.load(docx.TEMPLATE_DIR) is template
+    assert '[Content_Types].xml' in template.partnames
+    assert 'word/styles.xml' in template.partnames
+    assert template.contenttypes['/word/document.xml'].endswith(
+        'document.main+xml')
+    assert template.relationships is template.relationships
+    assert template.numbering is not None
+    rels = docx.relationshiplist()
+    assert len(rels) == len(template.relationships)
+    rels.append(['type', 'target'])
+    assert len(docx.relationshiplist()) == len(template.relationships)
+
+
+def test_document_stream_matches_tree():
+    from lxml import etree
+    document = docx.newdocument()
+    stream = docx.DocumentStream()
+    try:
+        for block in [docx.heading(u'title', 1), docx.paragraph(u'text'),
+                      docx.table([[u'a', u'b']])]:
+            stream.append(block)
+            document[0].append(block)
+        stream.close()
+        data = open(stream.filename, 'rb').read()
+        streamed = etree.fromstring(data)
+    finally:
+        stream.discard()
+    assert not os.path.exists(stream.filename)
+    assert stream.blocks == 3
+    assert [(e.tag, (e.text or '').strip()) for e in streamed.iter()] == \
+        [(e.tag, (e.text or '').strip()) for e in document.iter()]
+    # the blocks use the prefix declared by the document element
+    assert data.count('xmlns:') == 1
+    assert etree.tostring(document).count('xmlns:') == 1
+
+
+def test_document_stream_discard_before_close():
+    stream = docx.DocumentStream()
+    stream.append(docx.paragraph(u'text'))
+    stream.discard()
+    assert stream.closed
+    assert not os.path.exists(stream.filename)
+
+
+def test_archive_template_parts_are_copied_raw():
+    template = docx.Template.load(EXAMPLE_TEMPLATE)
+    assert template.is_archive
+    assert 'word/styles.xml' in template.partnames
+    assert template.stylenames['Heading1'] == '1'
+    out = StringIO()
+    docxfile = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    template.copy_part('word/styles.xml', docxfile)
+    docxfile.close()
+    source = zipfile.ZipFile(EXAMPLE_TEMPLATE)
+    copied = zipfile.ZipFile(StringIO(out.getvalue()))
+    assert copied.testzip() is None
+    assert copied.read('word/styles.xml') == source.read('word/styles.xml')
+    assert copied.getinfo('word/styles.xml').compress_size == \
+        source.getinfo('word/styles.xml').compress_size
+
+
+def test_compression_policy_stores_media():
+    policy = docx.compression_policy(9)
+    assert docx.compress_level(policy, 'word/document.xml') == 9
+    assert docx.compress_level(policy, 'word/media/a.PNG') == 0
+    policy = docx.compression_policy({'.png': 1})
+    assert docx.compress_level(policy, 'word/media/a.png') == 1
+    out = StringIO()
+    docxfile = zipfile.ZipFile(out, 'w')
+    docx.write_part(docxfile, 'word/document.xml', ['<a/>' * 100, '<b/>'],
+                    level=9)
+    docx.write_part(docxfile, 'word/media/a.png', 'PNG', level=0)
+    docxfile.close()
+    result = zipfile.ZipFile(StringIO(out.getvalue()))
+    assert result.testzip() is None
+    assert result.read('word/document.xml') == '<a/>' * 100 + '<b/>'
+    info = result.getinfo('word/media/a.png')
+    assert info.compress_type == zipfile.ZIP_STORED
+    assert result.getinfo('word/document.xml').compress_size < 100
+
+
+class CountingPart(docx.FilePart):
+
+    reads = 0
+
+    def __iter__(self):
+        self.reads += 1
+        return docx.FilePart.__iter__(self)
+
+
+def test_stored_file_part_is_read_once():
+    part = CountingPart(EXAMPLE_IMAGE)
+    zinfo, chunks = docx.compress_part('word/media/a.png', part, level=0)
+    assert zinfo.CRC is None
+    out = StringIO()
+    docxfile = zipfile.ZipFile(out, 'w')
+    docx.write_part(docxfile, 'word/media/a.png', part, level=0)
+    docxfile.close()
+    assert part.reads == 1
+    result = zipfile.ZipFile(StringIO(out.getvalue()))
+    assert result.testzip() is None
+    assert result.read('word/media/a.png') == open(EXAMPLE_IMAGE, 'rb').read()
+
+
+def test_members_are_written_without_raw_zip():
+    # the docx module, not the package
+    module = docx.docx
+    raw_zip, module.RAW_ZIP = module.RAW_ZIP, False
+    try:
+        template = docx.Template.load(EXAMPLE_TEMPLATE)
+        out = StringIO()
+        docxfile = zipfile.ZipFile(out, 'w')
+        docx.write_part(docxfile, 'word/document.xml', ['<a/>' * 100],
+                        level=9)
+        docx.write_part(docxfile, 'word/media/a.png',
+                        docx.FilePart(EXAMPLE_IMAGE), level=0)
+        template.copy_part('word/styles.xml', docxfile)
+        docxfile.close()
+    finally:
+        module.RAW_ZIP = raw_zip
+    result = zipfile.ZipFile(StringIO(out.getvalue()))
+    assert result.testzip() is None
+    assert result.read('word/document.xml') == '<a/>' * 100
+    assert result.getinfo('word/document.xml').compress_size < 100
+    assert result.getinfo('word/media/a.png').compress_type == \
+        zipfile.ZIP_STORED
+    assert result.read('word/styles.xml') == \
+        zipfile.ZipFile(EXAMPLE_TEMPLATE).read('word/styles.xml')
+
+
+def _save_example(filename, workers, timestamp=None):
+    docx.set_template(docx.TEMPLATE_DIR)
+    document = docx.newdocument()
+    for i in range(20):
+        document[0].append(docx.paragraph(u'paragraph %d' % i))
+    docx.savedocx(document, docx.coreproperties('t', 's', 'c', [],
+                                                timestamp=timestamp),
+                  docx.appproperties(), docx.contenttypes(),
+                  docx.websettings(),
+                  docx.wordrelationships(docx.relationshiplist()),
+                  filename, workers=workers, timestamp=timestamp)
+    result = zipfile.ZipFile(filename)
+    try:
+        assert result.testzip() is None
+        # core.xml holds the save time
+        return [(name, name != 'docProps/core.xml' and result.read(name))
+                for name in result.namelist()]
+    finally:
+        result.close()
+
+
+@with_tempdir
+def test_parallel_compression_keeps_part_order():
+    serial = _save_example(tempdir('serial.docx'), 1)
+    parallel = _save_example(tempdir('parallel.docx'), 4)
+    assert [name for name, data in serial][0] == 'word/document.xml'
+    assert serial == parallel
+
+
+def test_picture_media_is_read_when_saving():
+    docx.set_template(docx.TEMPLATE_DIR)
+    relationships, paragraph = docx.picture(docx.relationshiplist(),
+                                            EXAMPLE_IMAGE, 'image', 10, 10)
+    part = docx.generated_parts['word/media/image1.png']
+    assert isinstance(part, docx.FilePart)
+    data = open(EXAMPLE_IMAGE, 'rb').read()
+    assert ''.join(part) == data
+    out = StringIO()
+    docxfile = zipfile.ZipFile(out, 'w')
+    docx.write_part(docxfile, 'word/media/image1.png', part, level=0)
+    docxfile.close()
+    assert zipfile.ZipFile(StringIO(out.getvalue())).read(
+        'word/media/image1.png') == data
+    docx.reset_parts()
+
+
+def test_picture_extent():
+    assert docx.picture_extent(10, 20) == (126670, 253340)
+    inch = docx.EMU_PER_INCH
+    assert docx.picture_extent(300, 150, (300, 150)) == (inch, inch)
+    assert docx.picture_extent(300, 150, (0, 0)) == \
+        docx.picture_extent(300, 150)
+    assert docx.picture_extent(300, 150, (150, 150), inch) == \
+        (inch, inch // 2)
+
+
+def test_template_text_width():
+    assert docx.Template.load(docx.TEMPLATE_DIR).text_width == \
+        docx.DEFAULT_TEXT_WIDTH
+    # A4 with 851 twip margins
+    assert docx.Template.load(EXAMPLE_TEMPLATE).text_width == \
+        (11906 - 2 * 851) * docx.EMU_PER_TWIP
+
+
+@with_tempdir
+def test_same_image_content_is_stored_once():
+    try:
+        copy = tempdir('copy.png')
+        other = tempdir('image1.png')
+        shutil.copy(EXAMPLE_IMAGE, copy)
+        open(other, 'wb').write('other content')
+        docx.reset_parts()
+        rels = docx.relationshiplist()
+        first = docx.add_media(rels, EXAMPLE_IMAGE)
+        assert first[2]
+        assert docx.add_media(rels, EXAMPLE_IMAGE) == first[:2] + (False,)
+        assert docx.add_media(rels, copy) == first[:2] + (False,)
+        relid, partname, added = docx.add_media(rels, other)
+        assert added and relid != first[0]
+        assert partname.startswith('word/media/image1-')
+        assert len(docx.generated_parts) == 2
+    finally:
+        docx.reset_parts()
+
+
+def test_picture_references_are_resolved_in_order():
+    docx.set_template(docx.TEMPLATE_DIR)
+    rels = docx.relationshiplist()
+    document = docx.newdocument()
+    for i in range(2):
+        rels, paragraph = docx.picture(rels, EXAMPLE_IMAGE, 'image', 10, 10)
+        document[0].append(paragraph)
+    blips = list(document.iter(docx.A.blip))
+    assert blips[0].get(docx.R.embed).startswith(docx.MEDIA_REF)
+    docx.RefResolver().resolve(document)
+    relid = 'rId%d' % len(rels)
+    assert [b.get(docx.R.embed) for b in blips] == [relid, relid]
+    assert [d.get('id') for d in document.iter(docx.WP.docPr)] == ['1', '2']
+    docx.reset_parts()
+
+
+@with_tempdir
+def test_timestamp_makes_identical_files():
+    names = [tempdir(name) for name in ['a.docx', 'b.docx']]
+    for name in names:
+        _save_example(name, 1, timestamp=1300000000)
+    data = [open(name, 'rb').read() for name in names]
+    info = zipfile.ZipFile(names[0]).getinfo('docProps/core.xml')
+    assert data[0] == data[1]
+    assert info.date_time == (2011, 3, 13, 7, 6, 40)
+
+
+SAVE_EXAMPLE = """
+import sys
+sys.path.insert(0, %r)
+from test_docx import _save_example
+_save_example(sys.argv[1], 1, timestamp=1300000000)
+""" % CURRENT_DIR
+
+
+@with_tempdir
+def test_timestamp_output_does_not_depend_on_hash_seed():
+    data = []
+    for seed in ['1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        filename = tempdir('seed%s.docx' % seed)
+        subprocess.check_call([sys.executable, '-c', SAVE_EXAMPLE, filename],
+                              env=env, stdout=open(os.devnull, 'w'))
+        data.append(open(filename, 'rb').read())
+    assert data[0] == data[1]
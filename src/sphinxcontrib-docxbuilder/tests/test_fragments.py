@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from helpers import tempdir, with_tempdir
+
+import docx
+from fragments import FragmentCache, FragmentRecorder, source_hash
+
+EMBED = '{%s}embed' % docx.nsprefixes['r']
+
+
+@with_tempdir
+def test_recorded_fragment_roundtrip():
+    body = []
+    recorder = FragmentRecorder(body, u'chapter', 'key1')
+    recorder.append(docx.paragraph(u'text'))
+    blip = docx.makeelement('blip', nsprefix='a', attrnsprefix='r',
+                            attributes={'embed': 'media:digest'})
+    recorder.append(blip)
+    recorder.media.append((__file__, 'image.png', 'digest'))
+    assert len(body) == 2
+
+    cache = FragmentCache(tempdir('fragments'))
+    cache.put(u'chapter', 'key1', recorder.fragment(['tail'], 1))
+    assert cache.get(u'chapter', 'key2') is None
+    fragment = cache.get(u'chapter', 'key1')
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert fragment.pending == ['tail']
+    assert fragment.sectionlevel == 1
+
+    paragraph, blip = fragment.elements()
+    assert paragraph.tag == docx.W.p
+    assert blip.get(EMBED) == 'media:digest'
+
+
+def test_recorder_without_body():
+    recorder = FragmentRecorder(None, u'chapter', 'key1')
+    recorder.append(docx.paragraph(u'text'))
+    assert len(recorder.fragment([], 0).elements()) == 1
+
+
+@with_tempdir
+def test_cache_keeps_recent_keys_per_document():
+    cache = FragmentCache(tempdir('fragments'), keep=2)
+    for key in ['key1', 'key2', 'key3']:
+        recorder = FragmentRecorder(None, u'chapter', key)
+        recorder.append(docx.paragraph(key))
+        cache.put(u'chapter', key, recorder.fragment([], 0))
+    assert cache.get(u'chapter', 'key1') is None
+    assert cache.get(u'chapter', 'key2') is not None
+    assert cache.get(u'chapter', 'key3') is not None
+    cache.put(u'chapter', 'key2', recorder.fragment([], 0))
+    cache.put(u'chapter', 'key4', recorder.fragment([], 0))
+    assert cache.get(u'chapter', 'key2') is not None
+    assert cache.get(u'chapter', 'key3') is None
+
+
+@with_tempdir
+def test_source_hash():
+    source = tempdir('module.py')
+    open(source, 'w').write('a = 1\n')
+    digest = source_hash([source + 'c'])
+    assert digest == source_hash([source])
+    open(source, 'w').write('a = 2\n')
+    assert source_hash([source]) != digest
+    assert source_hash([tempdir('missing.pyc')]) == \
+        source_hash([tempdir('other', 'missing.py')])
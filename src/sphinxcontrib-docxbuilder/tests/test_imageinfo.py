@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import struct
+
+from helpers import EXAMPLE_IMAGE, tempdir, with_tempdir
+
+import imageinfo
+from docx import file_hash
+from imageinfo import ImageInfo, ImageProber, read_header, read_pil
+
+
+def write(filename, data):
+    f = open(filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def test_png_header_matches_pil():
+    info = read_header(EXAMPLE_IMAGE)
+    assert info.format == 'PNG'
+    assert info == read_pil(EXAMPLE_IMAGE)
+
+
+@with_tempdir
+def test_gif_and_jpeg_headers():
+    gif = tempdir('a.gif')
+    write(gif, 'GIF89a' + struct.pack('<HH', 640, 480) + '\0' * 10)
+    assert read_header(gif) == ImageInfo(640, 480, None, 'GIF')
+
+    jpeg = tempdir('a.jpg')
+    app0 = 'JFIF\0\1\1' + struct.pack('>BHH', 1, 300, 300) + '\0\0'
+    sof0 = struct.pack('>BHHB', 8, 200, 100, 3) + '\0' * 9
+    write(jpeg, '\xff\xd8' +
+          '\xff\xe0' + struct.pack('>H', len(app0) + 2) + app0 +
+          '\xff\xc0' + struct.pack('>H', len(sof0) + 2) + sof0)
+    assert read_header(jpeg) == ImageInfo(100, 200, (300, 300), 'JPEG')
+
+    write(tempdir('a.bmp'), 'BM')
+    assert read_header(tempdir('a.bmp')) is None
+
+
+@with_tempdir
+def test_prober_caches_by_mtime_and_size():
+    cachefile = tempdir('images.pickle')
+    prober = ImageProber(cachefile)
+    info = prober.probe(EXAMPLE_IMAGE)
+    prober.save()
+    prober = ImageProber(cachefile)
+    assert prober.probe(EXAMPLE_IMAGE) == info
+    assert (prober.hits, prober.misses) == (1, 0)
+
+
+@with_tempdir
+def test_prober_caches_digest():
+    image = tempdir('image.png')
+    shutil.copy(EXAMPLE_IMAGE, image)
+    prober = ImageProber(tempdir('images.pickle'))
+    assert prober.lookup(image) == (None, None)
+    info, digest = prober.lookup(image, info=True, digest=True)
+    assert digest == file_hash(EXAMPLE_IMAGE)
+    prober.save()
+
+    prober = ImageProber(tempdir('images.pickle'))
+    hash_file, imageinfo.file_hash = imageinfo.file_hash, None
+    try:
+        # an unchanged image is not read again
+        assert prober.lookup(image, info=True, digest=True) == (info, digest)
+    finally:
+        imageinfo.file_hash = hash_file
+    write(image, 'changed')
+    assert prober.digest(image) == file_hash(image)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from helpers import tempdir, with_tempdir
+
+from imagenorm import ImageNormalizer, normalize_settings
+from imageinfo import read_header
+
+
+def test_normalize_settings():
+    assert normalize_settings(False) is None
+    assert normalize_settings(True)['max_width'] == 975
+    assert normalize_settings({'max_width': '640'})['max_width'] == 640
+    try:
+        normalize_settings({'width': 640})
+    except ValueError:
+        pass
+    else:
+        assert False, 'unknown setting accepted'
+
+
+@with_tempdir
+def test_images_are_scaled_down_and_cached():
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    big = tempdir('big.png')
+    small = tempdir('small.png')
+    Image.new('RGB', (400, 200), (255, 0, 0)).save(big)
+    Image.new('RGB', (20, 20), (0, 0, 255)).save(small, optimize=True)
+    settings = normalize_settings({'max_width': 100})
+    cachedir = tempdir('cache')
+
+    normalizer = ImageNormalizer(cachedir, settings, workers=2)
+    normalizer.normalize_all([big, small])
+    result = normalizer.normalize(big)
+    assert os.path.dirname(result) == cachedir
+    assert read_header(result).size == (100, 50)
+    # recompressing does not make it smaller, the original is used
+    assert normalizer.normalize(small) == small
+
+    mtime = os.path.getmtime(result)
+    normalizer = ImageNormalizer(cachedir, settings)
+    assert normalizer.normalize(big) == result
+    assert os.path.getmtime(result) == mtime
+    other = ImageNormalizer(cachedir, normalize_settings(True))
+    assert other.normalize(big) != result
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+
+from helpers import EXAMPLE_IMAGE, tempdir, with_tempdir
+
+from docx import file_hash
+from imageinfo import ImageInfo, ImageProber
+from imagenorm import ImageNormalizer, normalize_settings
+from media import make_record, prepare_media
+
+
+@with_tempdir
+def test_prepare_media_records():
+    copy = tempdir('copy.png')
+    shutil.copy(EXAMPLE_IMAGE, copy)
+    prober = ImageProber(tempdir('images.pickle'))
+    missing = tempdir('missing.png')
+    media = prepare_media([EXAMPLE_IMAGE, copy, missing, copy], prober,
+                          workers=4)
+    assert sorted(media) == sorted([EXAMPLE_IMAGE, copy])
+    record = media[copy]
+    assert record.path == copy
+    assert record.digest == file_hash(EXAMPLE_IMAGE)
+    assert record.info == media[EXAMPLE_IMAGE].info
+    assert record.stored == record.info
+
+
+@with_tempdir
+def test_normalized_record_keeps_displayed_size():
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    big = tempdir('big.png')
+    Image.new('RGB', (400, 200), (255, 0, 0)).save(big, dpi=(200, 200))
+    prober = ImageProber(tempdir('images.pickle'))
+    normalizer = ImageNormalizer(tempdir('cache'),
+                                 normalize_settings({'max_width': 100}))
+    record = make_record(big, prober, normalizer)
+    assert record.path != big
+    assert record.info == ImageInfo(400, 200, (200, 200), 'PNG')
+    assert record.stored.size == (100, 50)
+    assert record.stored.dpi == (50, 50)
+    assert record.digest == file_hash(record.path)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import subprocess
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(CURRENT_DIR)
+SRC_DIR = os.path.dirname(BASE_DIR)
+PACKAGE = os.path.basename(BASE_DIR)
+
+# implicit relative imports leave None entries for the names that are not
+# modules of the package, only the loaded modules are printed
+CODE = '''
+import sys
+__import__(%r)
+print(' '.join(sorted(name for name, module in sys.modules.items()
+                      if module is not None)))
+''' % PACKAGE
+
+
+def test_import_does_not_load_writer():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.Popen([sys.executable, '-c', CODE], env=env,
+                            stdout=subprocess.PIPE)
+    modules = proc.communicate()[0].decode('ascii').split()
+    assert proc.returncode == 0
+    assert PACKAGE + '.builder' in modules
+    for name in ('lxml', 'lxml.etree', 'PIL', 'Image', PACKAGE + '.writer',
+                 PACKAGE + '.docx', PACKAGE + '.docx.docx'):
+        assert name not in modules, '%s is imported by the extension' % name
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from helpers import tempdir, with_tempdir
+
+from stats import BuildStats
+
+
+def test_nested_phases_accumulate():
+    stats = BuildStats()
+    with stats.phase('translate'):
+        for i in range(3):
+            with stats.phase('images'):
+                pass
+    with stats.phase('save'):
+        pass
+
+    names = [p.name for p in stats.phases]
+    assert names == ['translate', 'translate/images', 'save'], names
+    assert stats.phases[1].calls == 3
+    assert stats.phases[1].depth == 1
+    assert len(stats.report()) == 4
+
+
+@with_tempdir
+def test_dump_json():
+    stats = BuildStats()
+    with stats.phase('save'):
+        pass
+    filename = tempdir('stats.json')
+    stats.dump(filename)
+    data = json.load(open(filename))
+    assert data['format'] == 3
+    assert data['phases'][0]['name'] == 'save'
+    assert data['phases'][0]['calls'] == 1
+
+
+def test_parts_are_reported():
+    stats = BuildStats()
+    stats.add_part('word/document.xml', 1000, 250, 0.01)
+    stats.add_part('word/media/image1.png', 0, 0, 0.0)
+    lines = stats.report()
+    assert lines[-2].startswith('word/document.xml')
+    assert '25%' in lines[-2]
+    assert stats.todict()['parts'][0]['compressed_bytes'] == 250
+
+
+def test_image_hit_rate():
+    stats = BuildStats()
+    assert stats.image_hit_rate == 0
+    for deduplicated in [False, True, True, False]:
+        stats.add_image(deduplicated)
+    assert stats.image_hit_rate == 0.5
+    assert stats.report()[-1].endswith('2 deduplicated (50%)')
+    assert stats.todict()['images']['references'] == 4
+
+
+def test_merge():
+    stats = BuildStats()
+    with stats.phase('save'):
+        pass
+    other = BuildStats()
+    for i in range(2):
+        with other.phase('save'):
+            pass
+    with other.phase('translate'):
+        pass
+    other.add_part('word/document.xml', 1000, 250, 0.01)
+    other.add_image(True)
+    stats.merge(other)
+    assert [p.name for p in stats.phases] == ['save', 'translate']
+    assert stats.phases[0].calls == 3
+    assert len(stats.parts) == 1
+    assert stats.images_deduplicated == 1
+
+
+def test_merge_into_parent_phase():
+    stats = BuildStats()
+    other = BuildStats()
+    with other.phase('translate'):
+        pass
+    with stats.phase('prepare_fragments'):
+        stats.merge(other, 'prepare_fragments')
+    names = [(p.name, p.depth) for p in stats.phases]
+    assert names == [('prepare_fragments', 0),
+                     ('prepare_fragments/translate', 1)], names
+
+
+def test_phases_record_peak_memory_growth():
+    stats = BuildStats()
+    with stats.phase('save'):
+        pass
+    growth = stats.phases[0].rss_growth
+    if growth is not None:
+        assert 0 <= growth < 1024
+        assert stats.todict()['phases'][0]['rss_growth_kb'] == growth
+
+
+def test_merged_wall_time_is_kept_apart():
+    stats = BuildStats()
+    with stats.phase('prepare_fragments'):
+        for i in range(3):
+            worker = BuildStats()
+            with worker.phase('translate') as translate:
+                pass
+            translate.wall, translate.cpu = 2.0, 1.5
+            stats.merge(worker, 'prepare_fragments')
+    translate = stats.phases[1]
+    assert (translate.wall, translate.worker_wall) == (0.0, 6.0)
+    assert translate.cpu == 4.5
+    assert translate.calls == 3
+    lines = stats.report()
+    assert 'workers(s)' in lines[0]
+    assert lines[2].split()[2:5] == ['0.000', '6.000', '4.500']
+    assert lines[3].startswith('wall: elapsed')
+    assert stats.todict()['phases'][1]['worker_wall'] == 6.0
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from helpers import tempdir, with_tempdir
+
+from docutils import nodes
+from docutils.utils import new_document
+
+from tracing import NodeTracer
+
+
+def visit(translator, node):
+    if isinstance(node, nodes.section):
+        raise nodes.SkipDeparture
+
+
+def depart(translator, node):
+    pass
+
+
+class Translator(nodes.NodeVisitor):
+
+    def __init__(self, document, tracer):
+        nodes.NodeVisitor.__init__(self, document)
+        self.tracer = tracer
+
+    def dispatch_visit(self, node):
+        return self.tracer.visit(visit, self, node)
+
+    def dispatch_departure(self, node):
+        return self.tracer.depart(depart, self, node)
+
+
+@with_tempdir
+def test_trace_indentation_after_skipped_departure():
+    document = new_document('test')
+    section = nodes.section()
+    section += nodes.paragraph()
+    document += section
+    document += nodes.paragraph()
+    tracer = NodeTracer('full', tempdir('docx.log'))
+    document.walkabout(Translator(document, tracer))
+    tracer.close()
+    lines = open(tempdir('docx.log')).read().splitlines()
+    assert lines[:7] == [
+        'visit document',
+        '  visit section',
+        '    visit paragraph',
+        '    depart paragraph',
+        '  visit paragraph',
+        '  depart paragraph',
+        'depart document']
+    assert tracer.stats['section'].visits == 1
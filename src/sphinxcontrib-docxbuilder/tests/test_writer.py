@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+
+from helpers import EXAMPLE_IMAGE, tempdir, with_tempdir
+
+from docutils import nodes
+from docutils.core import publish_doctree
+from lxml import etree
+from sphinx import addnodes
+
+import docx
+import writer
+from fragments import Fragment, FragmentCache
+from imageinfo import ImageProber, read_header
+from stats import BuildStats
+
+
+class Container(object):
+
+    def __init__(self):
+        self.docbody = []
+        self.media = {}
+        self.prepared = {}
+        self.fragments = None
+
+
+class Env(object):
+
+    def __init__(self, srcdir):
+        self.srcdir = srcdir
+
+
+class Builder(object):
+
+    def __init__(self, srcdir):
+        self.env = Env(srcdir)
+        self.stats = BuildStats()
+
+
+def image_container(directory):
+    dc = Container()
+    dc.relationships = docx.relationshiplist()
+    dc.images = ImageProber(os.path.join(directory, 'images.pickle'))
+    dc.normalizer = None
+    dc.text_width = docx.DEFAULT_TEXT_WIDTH
+    return dc
+
+
+def test_dispatch_table():
+    T = writer.DocxTranslator
+    translator = T(nodes.document(None, None), None, Container())
+    assert translator.handlers(nodes.inline) == (None, None)
+    assert translator.handlers(nodes.paragraph) == (
+        T.visit_paragraph.im_func, None)
+    assert translator.handlers(nodes.comment) == (writer.SKIP, None)
+    assert translator.handlers(nodes.decoration) == (writer.SKIP, None)
+
+
+def test_declared_handlers_match_methods():
+    T = writer.DocxTranslator
+    node = nodes.Element()
+    for kind, names in [('visit', T.passthrough_visits),
+                        ('depart', T.passthrough_departs)]:
+        for name in names:
+            translator = T(nodes.document(None, None), None, Container())
+            getattr(translator, '%s_%s' % (kind, name))(node)
+            assert translator.docbody == []
+            assert not translator.buffers[-1], name
+    for name in T.skipped_nodes:
+        translator = T(nodes.document(None, None), None, Container())
+        try:
+            getattr(translator, 'visit_' + name)(node)
+        except nodes.SkipNode:
+            pass
+        else:
+            assert False, 'visit_%s does not skip' % name
+
+
+def test_walk_matches_walkabout():
+    doctree = publish_doctree(
+        '.. _target:\n\nTitle\n=====\n\n.. a comment\n\n'
+        'Some *text* with ``code``.\n\n* one\n* two\n',
+        settings_overrides={'report_level': 5})
+    results = []
+    for table in (False, True):
+        translator = writer.DocxTranslator(doctree, None, Container())
+        if table:
+            translator.walk(doctree)
+        else:
+            doctree.walkabout(translator)
+        results.append([etree.tostring(element)
+                        for element in translator.docbody])
+    assert results[0] == results[1]
+    assert len(results[1]) == 4
+
+
+def test_run_buffer_coalesces_runs():
+    buffer = writer.RunBuffer()
+    for text, format in [('a', ''), ('b', ''), ('c', 'b'), ('d', 'b'),
+                         ('e', '')]:
+        buffer.add(text, format)
+    assert buffer.take() == [('ab', ''), ('cd', 'b'), ('e', '')]
+    assert not buffer
+
+
+def test_formatted_runs():
+    doctree = publish_doctree(
+        'Title\n=====\n\nSome **bold** and *it* ``code``.\n',
+        settings_overrides={'report_level': 5, 'doctitle_xform': False})
+    translator = writer.DocxTranslator(doctree, None, Container())
+    translator.walk(doctree)
+    heading, paragraph = translator.docbody
+    runs = paragraph.findall(docx.W.r)
+    assert [run.findtext(docx.W.t) for run in runs] == [
+        'Some ', 'bold', ' and ', 'it', ' ', 'code', '.']
+    assert runs[1].find(docx.W.rPr).find(docx.W.b) is not None
+    assert runs[3].find(docx.W.rPr).find(docx.W.i) is not None
+    assert runs[5].find(docx.W.rPr).find(docx.W.rFonts) is not None
+    assert runs[0].find(docx.W.t).get(docx.XML_SPACE) == 'preserve'
+
+
+@with_tempdir
+def test_same_image_is_counted_as_deduplicated():
+    shutil.copy(EXAMPLE_IMAGE, tempdir('image.png'))
+    doctree = publish_doctree(
+        '.. image:: image.png\n\ntext\n\n.. image:: image.png\n',
+        settings_overrides={'report_level': 5})
+    docx.set_template(docx.TEMPLATE_DIR)
+    builder = Builder(tempdir())
+    translator = writer.DocxTranslator(doctree, builder,
+                                       image_container(tempdir()))
+    translator.walk(doctree)
+    assert len(docx.media_parts) == 1
+    assert builder.stats.images == 2
+    assert builder.stats.images_deduplicated == 1
+    # not normalized: the pixel size, whatever the resolution of the image
+    extent = translator.docbody[0].find('.//' + docx.WP.extent)
+    info = read_header(EXAMPLE_IMAGE)
+    assert info.dpi is not None
+    assert (int(extent.get('cx')), int(extent.get('cy'))) == \
+        docx.picture_extent(info.width, info.height)
+    docx.reset_parts()
+
+
+@with_tempdir
+def test_reused_fragments_count_their_images():
+    digest = docx.file_hash(EXAMPLE_IMAGE)
+    fragment = Fragment([], [(EXAMPLE_IMAGE, 'image.png', digest)], [], 0)
+    docx.set_template(docx.TEMPLATE_DIR)
+    builder = Builder(tempdir())
+    translator = writer.DocxTranslator(nodes.document(None, None), builder,
+                                       image_container(tempdir()))
+    for i in range(2):
+        translator.buffers.append(writer.RunBuffer())
+        translator.add_fragment(fragment)
+    assert len(docx.media_parts) == 1
+    assert builder.stats.images == 2
+    assert builder.stats.images_deduplicated == 1
+    docx.reset_parts()
+
+
+@with_tempdir
+def test_streaming_records_one_document_at_a_time():
+    outer = addnodes.start_of_file(docname='outer')
+    outer += nodes.paragraph('', 'outer text')
+    inner = addnodes.start_of_file(docname='inner')
+    inner += nodes.paragraph('', 'inner text')
+    outer += inner
+    doctree = nodes.document(None, None)
+    doctree += outer
+    dc = image_container(tempdir())
+    dc.docbody = docx.DocumentStream()
+    dc.fragments = FragmentCache(tempdir('fragments'))
+    dc.fragment_salt = ''
+    builder = Builder(tempdir())
+    translator = writer.DocxTranslator(doctree, builder, dc)
+    try:
+        translator.walk(doctree)
+    finally:
+        dc.docbody.discard()
+    assert translator.recorders == []
+    assert len(os.listdir(tempdir('fragments'))) == 1
+    translator.list_style = []
+    inner_fragment = dc.fragments.get('inner',
+                                      translator.fragment_key(inner))
+    assert len(inner_fragment.elements()) == 1  # the page break
+    assert inner_fragment.pending == [('inner text', '')]
+    assert dc.fragments.get('outer', translator.fragment_key(outer)) is None
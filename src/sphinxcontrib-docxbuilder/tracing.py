@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder.tracing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Node tracing for the docx translator.
+
+    Tracing is enabled by the ``docx_trace`` config value:
+
+    * ``'off'``: no tracing, the translator runs without any hook.
+    * ``'nodes'``: per-node-class counts and handler timings.
+    * ``'full'``: same as 'nodes', and every visit/depart event is written
+      to ``docx.log`` in the output directory.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import logging
+from timeit import default_timer as timer
+
+from docutils import nodes
+
+
+TRACE_LEVELS = ('off', 'nodes', 'full')
+
+logger = logging.getLogger('docx')
+
+
+class NodeStat(object):
+    """Counts and handler timings of one node class."""
+
+    def __init__(self, name):
+        self.name = name
+        self.visits = 0
+        self.skips = 0
+        self.visit_time = 0.0
+        self.depart_time = 0.0
+
+    @property
+    def total_time(self):
+        return self.visit_time + self.depart_time
+
+
+def _depth(node):
+    """Return the number of ancestors of `node`, its indentation in the
+    trace.  Unlike a counter, it does not depend on departures being
+    called, which SkipDeparture and SkipSiblings prevent."""
+    depth = 0
+    while node.parent is not None:
+        depth += 1
+        node = node.parent
+    return depth
+
+
+class NodeTracer(object):
+    """Collect per-node-class statistics from a translator.
+
+    The tracer does not touch the translator by itself; a translator class
+    that should be traced routes its ``dispatch_visit`` and
+    ``dispatch_departure`` through :meth:`visit` and :meth:`depart`.
+    """
+
+    def __init__(self, level='nodes', logfile=None):
+        if level not in TRACE_LEVELS[1:]:
+            raise ValueError('unknown trace level: %r' % level)
+        self.level = level
+        self.stats = {}
+        self.handler = None
+        if level == 'full' and logfile:
+            self.handler = logging.FileHandler(logfile, 'w')
+            self.handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(self.handler)
+            logger.setLevel(logging.INFO)
+
+    def _stat(self, node):
+        name = node.__class__.__name__
+        try:
+            return self.stats[name]
+        except KeyError:
+            stat = self.stats[name] = NodeStat(name)
+            return stat
+
+    def visit(self, handler, translator, node):
+        stat = self._stat(node)
+        stat.visits += 1
+        if self.handler:
+            logger.info('%svisit %s', '  ' * _depth(node), stat.name)
+        start = timer()
+        try:
+            return handler(translator, node)
+        except nodes.SkipNode:
+            stat.skips += 1
+            raise
+        finally:
+            stat.visit_time += timer() - start
+
+    def depart(self, handler, translator, node):
+        stat = self._stat(node)
+        if self.handler:
+            logger.info('%sdepart %s', '  ' * _depth(node), stat.name)
+        start = timer()
+        try:
+            return handler(translator, node)
+        finally:
+            stat.depart_time += timer() - start
+
+    def report(self):
+        """Return summary lines ordered by total handler time."""
+        stats = sorted(self.stats.values(),
+                       key=lambda s: s.total_time, reverse=True)
+        lines = ['%-28s %8s %8s %10s %10s' % (
+            'node class', 'count', 'skipped', 'visit(ms)', 'depart(ms)')]
+        for s in stats:
+            lines.append('%-28s %8d %8d %10.2f %10.2f' % (
+                s.name, s.visits, s.skips,
+                s.visit_time * 1000, s.depart_time * 1000))
+        return lines
+
+    def close(self):
+        if self.handler:
+            for line in self.report():
+                logger.info(line)
+            logger.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
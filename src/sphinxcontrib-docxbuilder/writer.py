@@ -11,6 +11,7 @@
 """
 
 import re
+from itertools import groupby
 
 from docutils import nodes, writers
 
@@ -18,33 +19,22 @@ from sphinx import addnodes
 from sphinx.locale import admonitionlabels, versionlabels, _
 
 import docx
-import sys
 import os
-import zipfile
-import tempfile
-
-import logging
-logging.basicConfig(filename='docx.log', filemode='w', level=logging.INFO,
-        format="%(asctime)-15s  %(message)s")
-logger = logging.getLogger('docx')
-
-
-def dprint(_func=None, **kw):
-    f = sys._getframe(1)
-    if kw:
-        text = ', '.join('%s = %s' % (k, v) for k, v in kw.items())
-    else:
-        try:
-            text = dict((k, repr(v)) for k, v in f.f_locals.items()
-                        if k != 'self')
-            text = unicode(text)
-        except:
-            text = ''
+import sys
+from StringIO import StringIO
 
-    if _func is None:
-        _func = f.f_code.co_name
+from cache import PickleCache, content_hash
+from imageinfo import ImageProber
+from imagenorm import ImageNormalizer, normalize_settings
+from media import make_record, prepare_media
+from fragments import FragmentCache, FragmentRecorder, FRAGMENT_FORMAT, \
+    source_hash
+from tracing import NodeTracer, TRACE_LEVELS
 
-    logger.info(' '.join([_func, text]))
+#: hash of the code translating documents, see DocxTranslator.fragment_key()
+TRANSLATOR_SOURCE = source_hash([
+    __file__, docx.docx.__file__,
+    sys.modules[FragmentRecorder.__module__].__file__])
 
 
 class DocxContaner(object):
@@ -58,90 +48,409 @@ class DocxWriter(writers.Writer):
 
     output = None
 
-    def __init__(self, builder):
+    def __init__(self, builder, template=None):
         writers.Writer.__init__(self)
         self.builder = builder
-        self.template_setup() # setup before call almost docx methods.
+        # setup before call almost docx methods.
+        self.template_setup(template or self.builder.config['docx_template'])
+        self.tracer = self.tracer_setup()
 
         dc = DocxContaner()
-        dc.document = docx.newdocument()
-        dc.docbody = dc.document.xpath(
-                '/w:document/w:body', namespaces=docx.nsprefixes)[0]
+        if self.builder.config['docx_streaming']:
+            # a docx.DocumentStream, opened by translate()
+            dc.document = dc.docbody = None
+        else:
+            dc.document = docx.newdocument()
+            dc.docbody = dc.document.xpath(
+                    '/w:document/w:body', namespaces=docx.nsprefixes)[0]
         dc.relationships = docx.relationshiplist()
+        # images are not displayed wider than this, in EMU
+        dc.text_width = docx.get_template().text_width
         dc.appprops = docx.appproperties()
         dc.contenttypes = docx.contenttypes()
         dc.websettings = docx.websettings()
+        dc.images = ImageProber(os.path.join(
+                self.builder.doctreedir, 'docx-images.pickle'))
+        dc.normalizer = self.normalizer_setup(dc.images)
+        dc.media = {}  # {source file: MediaRecord}, see prepare_images()
+        dc.prepared = {}  # {fragment key: Fragment}, see prepare_fragments()
+        dc.fragments = None
+        if self.builder.config['docx_fragment_cache']:
+            dc.fragments = FragmentCache(os.path.join(
+                    self.builder.doctreedir, 'docx-fragments'))
+        # what translated fragments depend on besides the doctree
+        dc.fragment_salt = repr((FRAGMENT_FORMAT, TRANSLATOR_SOURCE,
+                                 self.builder.config_hash(),
+                                 sorted(docx.stylenames.items()),
+                                 dc.text_width))
         self.docx_container = dc
 
-    def template_setup(self):
-        dotx = self.builder.config['docx_template']
+    def template_setup(self, dotx):
+        docx.reset_parts()
         if dotx:
-            dotx = os.path.join(self.builder.env.srcdir, dotx)
-            z = zipfile.ZipFile(dotx, 'r')
-            template_dir = tempfile.mkdtemp(prefix='docx-')
-            z.extractall(template_dir)
-            docx.set_template(template_dir)
+            # the archive is used as it is, parts are read from it
+            template_path = os.path.join(self.builder.env.srcdir, dotx)
+        else:
+            template_path = docx.TEMPLATE_DIR
+        template = docx.Template.load(template_path)
+        docx.set_template(template_path, self.template_stylenames(
+                template.read('word/styles.xml')))
+
+    def template_stylenames(self, data):
+        """Return the style name mapping of styles.xml content `data`.
+
+        Mappings are cached in the doctree directory by content hash of
+        styles.xml, so a template is parsed once for all builds.
+        """
+        key = content_hash(data)
+        cache = PickleCache(os.path.join(
+                self.builder.doctreedir, 'docx-stylenames.pickle'))
+        names = cache.get(key)
+        if names is None:
+            names = cache[key] = docx.read_stylenames(StringIO(data))
+            try:
+                cache.save()
+            except (IOError, OSError), err:
+                self.builder.warn('error writing style name cache: %s' % err)
+        return names
+
+    def normalizer_setup(self, prober):
+        setting = self.builder.config['docx_image_normalize']
+        try:
+            settings = normalize_settings(setting)
+        except (TypeError, ValueError), err:
+            self.builder.warn('invalid docx_image_normalize %r (%s), images '
+                              'are not normalized' % (setting, err))
+            return None
+        if settings is None:
+            return None
+        return ImageNormalizer(
+                os.path.join(self.builder.doctreedir, 'docx-images'),
+                settings, self.builder.process_workers(), prober.digest)
+
+    def prepare_images(self, doctree):
+        """Probe, normalize and hash all images of doctree at once, in
+        parallel, so that translation only looks up the results."""
+        dc = self.docx_container
+        srcdir = self.builder.env.srcdir
+        dc.media = prepare_media(
+                [os.path.join(srcdir, node['uri'])
+                 for node in doctree.traverse(nodes.image)],
+                dc.images, dc.normalizer, self.builder.parallel_workers())
+        if dc.normalizer:
+            for source, error in sorted(dc.normalizer.errors.items()):
+                self.builder.warn('image %s is not normalized: %s' %
+                                  (os.path.relpath(source, srcdir), error))
+
+    def parallel_nodes(self, doctree):
+        """Return the start_of_file nodes of doctree that are translated
+        the same on their own: the top-level ones, outside of lists and
+        tables."""
+        result = []
+
+        def collect(node):
+            for child in node.children:
+                if isinstance(child, addnodes.start_of_file):
+                    result.append(child)
+                elif isinstance(child, (nodes.section, nodes.compound)):
+                    collect(child)
+        collect(doctree)
+        return result
+
+    def prepare_fragments(self, doctree):
+        """Translate the top-level documents of doctree into fragments in
+        worker processes, which the translator adds in place of them.
+
+        Documents found in the fragment cache are left to the translator.
+        The workers are forked, so they share the doctree and the prepared
+        images; without fork() everything is translated here.  Their
+        statistics are merged back and their warnings emitted here.
+        """
+        global _writer
+        dc = self.docx_container
+        workers = self.builder.process_workers()
+        if workers < 2 or self.tracer or not hasattr(os, 'fork'):
+            return
+        translator = DocxTranslator(doctree, self.builder, dc)
+        jobs = []
+        for index, node in enumerate(self.parallel_nodes(doctree)):
+            key = translator.fragment_key(node)
+            if dc.fragments is None or \
+                    dc.fragments.get(node['docname'], key) is None:
+                jobs.append((index, key))
+        if len(jobs) < 2:
+            return
+        from multiprocessing import Pool
+        _writer = (self, doctree)
+        try:
+            pool = Pool(min(workers, len(jobs)))
+            try:
+                results = pool.map(_translate_fragment, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _writer = None
+        for (index, key), (fragment, stats, warnings) in zip(jobs, results):
+            if fragment is not None:
+                dc.prepared[key] = fragment
+            self.builder.stats.merge(stats, 'prepare_fragments')
+            self.builder.emit_warnings(warnings)
+
+    def tracer_setup(self):
+        level = self.builder.config['docx_trace'] or 'off'
+        if level not in TRACE_LEVELS:
+            self.builder.warn('unknown docx_trace value %r, tracing is '
+                              'disabled (use one of %s)' %
+                              (level, ', '.join(TRACE_LEVELS)))
+            return None
+        if level == 'off':
+            return None
+        logfile = os.path.join(self.builder.outdir, 'docx.log')
+        return NodeTracer(level, logfile)
 
     def save(self, filename):
         dc = self.docx_container
         wordrelationships = docx.wordrelationships(dc.relationships)
+        timestamp = self.timestamp_setup()
         coreprops = docx.coreproperties(
                 title='Python docx demo',
                 subject='A practical example of making docx from Python',
                 creator='Mike MacCana',
-                keywords=['python', 'Office Open XML', 'Word'])
+                keywords=['python', 'Office Open XML', 'Word'],
+                timestamp=timestamp)
 
         docx.savedocx(dc.document, coreprops, dc.appprops, dc.contenttypes,
-                dc.websettings, wordrelationships, filename)
+                dc.websettings, wordrelationships, filename,
+                timer=self.builder.stats,
+                compression=self.compression_setup(),
+                workers=self.builder.parallel_workers(),
+                timestamp=timestamp)
+        try:
+            dc.images.save()
+        except (IOError, OSError), err:
+            self.builder.warn('error writing image cache: %s' % err)
+
+    def discard(self):
+        """Remove the temporary file of a streamed document, which is
+        left when translating or saving it failed."""
+        document = self.docx_container.document
+        if isinstance(document, docx.DocumentStream):
+            document.discard()
+
+    def compression_setup(self):
+        setting = self.builder.config['docx_compression']
+        try:
+            return docx.compression_policy(setting)
+        except (TypeError, ValueError), err:
+            self.builder.warn('invalid docx_compression %r (%s), using the '
+                              'default compression' % (setting, err))
+            return docx.compression_policy()
+
+    def timestamp_setup(self):
+        """Return the POSIX timestamp the document is dated at, None for
+        now: SOURCE_DATE_EPOCH if it is set, else the earliest zip date
+        in docx_reproducible mode."""
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch:
+            try:
+                return max(int(epoch), 0)
+            except ValueError:
+                self.builder.warn('invalid SOURCE_DATE_EPOCH %r, ignored' %
+                                  epoch)
+        if self.builder.config['docx_reproducible']:
+            return docx.ZIP_EPOCH
+        return None
 
     def translate(self):
-        visitor = DocxTranslator(
-                self.document, self.builder, self.docx_container)
-        self.document.walkabout(visitor)
+        dc = self.docx_container
+        if self.builder.config['docx_streaming']:
+            # blocks are serialized as soon as they are appended
+            dc.document = dc.docbody = docx.DocumentStream()
+        if self.tracer:
+            visitor = TracingDocxTranslator(
+                    self.document, self.builder, self.docx_container,
+                    self.tracer)
+            # the tracer hooks dispatch_visit/dispatch_departure
+            self.document.walkabout(visitor)
+        else:
+            visitor = DocxTranslator(
+                    self.document, self.builder, self.docx_container)
+            visitor.walk(self.document)
         self.output = ''  # visitor.body
 
 
+#: dispatch table entry of a node type that is skipped, see
+#: DocxTranslator.handlers()
+SKIP = 'skip'
+
+
+# {translator class: {node class: (visit, depart)}}, see DocxTranslator.walk
+_dispatch_tables = {}
+
+
+class RunBuffer(object):
+    """Text waiting for its paragraph, as (text, format) runs (see
+    docx.run())."""
+
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return len(self.runs)
+
+    def add(self, text, format=''):
+        self.runs.append((text, format))
+
+    def extend(self, runs):
+        self.runs.extend(runs)
+
+    def take(self):
+        """Return the runs, adjacent runs of the same format coalesced into
+        one, and empty the buffer."""
+        runs = [(''.join(text for text, format in group), format)
+                for format, group in groupby(self.runs, lambda r: r[1])]
+        self.runs = []
+        return runs
+
+
 class DocxTranslator(nodes.NodeVisitor):
 
+    # How walk() dispatches node types, by node class name.  The handlers
+    # below still do the same for walkabout(); keep both in line.
+    #: node types whose visit_* handler does nothing
+    passthrough_visits = frozenset([
+        'abbreviation', 'caption', 'centered', 'compact_paragraph', 'compound',
+        'desc', 'desc_addname', 'desc_annotation', 'desc_name', 'desc_type',
+        'description', 'download_reference', 'field', 'field_list',
+        'generated', 'glossary', 'hlist', 'hlistcol', 'inline', 'line',
+        'option_list', 'option_string', 'pending_xref', 'refcount',
+        'reference', 'subtitle', 'tgroup', 'thead', 'title_reference'])
+    #: node types whose depart_* handler does nothing
+    passthrough_departs = frozenset([
+        'Text', 'abbreviation', 'caption', 'centered', 'colspec',
+        'compact_paragraph', 'compound', 'desc', 'desc_addname',
+        'desc_annotation', 'desc_name', 'desc_type', 'description',
+        'download_reference', 'field', 'field_list', 'generated', 'glossary',
+        'hlist', 'hlistcol', 'image', 'inline', 'line', 'option_list',
+        'option_string', 'paragraph', 'pending_xref', 'refcount', 'reference',
+        'row', 'subtitle', 'tbody', 'tgroup', 'thead', 'title_reference'])
+    #: node types whose visit_* handler raises SkipNode; node types
+    #: without a visit_* handler are skipped too, like unknown_visit() does
+    skipped_nodes = frozenset([
+        'acks', 'admonition', 'attention', 'attribution', 'caution',
+        'citation', 'citation_reference', 'classifier', 'comment', 'danger',
+        'definition', 'definition_list', 'definition_list_item',
+        'desc_content', 'desc_optional', 'desc_parameter',
+        'desc_parameterlist', 'desc_returns', 'desc_signature',
+        'doctest_block', 'error', 'field_body', 'field_name', 'footnote',
+        'footnote_reference', 'highlightlang', 'hint', 'important', 'index',
+        'label', 'line_block', 'meta', 'note', 'option', 'option_argument',
+        'option_group', 'option_list_item', 'problematic', 'productionlist',
+        'raw', 'rubric', 'sidebar', 'subscript', 'substitution_definition',
+        'superscript', 'system_message', 'tabular_col_spec', 'target', 'term',
+        'tip', 'topic', 'transition', 'versionmodified', 'warning'])
+
     def __init__(self, document, builder, docx_container):
         self.builder = builder
         self.docx_container = docx_container
         self.docbody = docx_container.docbody
         nodes.NodeVisitor.__init__(self, document)
 
-        self.states = [[]]
+        self.buffers = [RunBuffer()]
+        # format characters of the inline nodes being translated
+        self.formats = []
+        self.format = ''
         self.list_style = []
         self.sectionlevel = 0
         self.table = None
+        self.recorders = []
+        # {fragment key: Fragment} of all translated documents if a dict
+        self.translated = None
+
+    def handlers(self, nodeclass):
+        """Return the (visit, depart) handlers of nodes of `nodeclass` as
+        unbound functions, None for the ones that do nothing, or (SKIP,
+        None) if the nodes are skipped.  They are looked up once per class
+        and node class, as declared by passthrough_visits,
+        passthrough_departs and skipped_nodes."""
+        table = _dispatch_tables.setdefault(self.__class__, {})
+        entry = table.get(nodeclass)
+        if entry is None:
+            cls = self.__class__
+            name = nodeclass.__name__
+            if name in cls.skipped_nodes or \
+                    not hasattr(cls, 'visit_' + name):
+                entry = (SKIP, None)
+            else:
+                visit = depart = None
+                if name not in cls.passthrough_visits:
+                    visit = getattr(cls, 'visit_' + name).im_func
+                if name not in cls.passthrough_departs:
+                    depart = getattr(cls, 'depart_' + name,
+                                     cls.unknown_departure).im_func
+                entry = (visit, depart)
+            table[nodeclass] = entry
+        return entry
+
+    def walk(self, node):
+        """Translate `node` like node.walkabout(self), with the handlers of
+        the dispatch table: nodes with no-op handlers are descended into
+        without calls, skipped ones are left without raising SkipNode."""
+        visit, depart = self.handlers(node.__class__)
+        if visit is SKIP:
+            return False
+        stop = False
+        try:
+            try:
+                if visit is not None:
+                    visit(self, node)
+            except nodes.SkipNode:
+                return False
+            except nodes.SkipDeparture:
+                depart = None
+            try:
+                for child in node.children:
+                    if self.walk(child):
+                        stop = True
+                        break
+            except nodes.SkipSiblings:
+                pass
+        except nodes.SkipChildren:
+            pass
+        except nodes.StopTraversal:
+            stop = True
+        if depart is not None:
+            depart(self, node)
+        return stop
 
     def add_text(self, text):
-        dprint()
-        self.states[-1].append(text)
+        self.buffers[-1].add(text, self.format)
+
+    def push_format(self, format):
+        self.formats.append(format)
+        self.format = ''.join(sorted(set(''.join(self.formats))))
+
+    def pop_format(self):
+        self.formats.pop()
+        self.format = ''.join(sorted(set(''.join(self.formats))))
 
     def new_state(self):
-        dprint()
         self.ensure_state()
-        self.states.append([])
+        self.buffers.append(RunBuffer())
 
     def ensure_state(self):
-        if self.states and self.states[-1]:
-            result = self.states[-1]
-            self.states[-1] = []
+        if self.buffers and self.buffers[-1]:
             self.docbody.append(
-                    docx.paragraph(''.join(result), breakbefore=True))
+                    docx.paragraph(self.buffers[-1].take(), breakbefore=True))
 
     def end_state(self, first=None):
-        dprint()
-        result = self.states.pop()
+        result = self.buffers.pop()
         if first is not None and result:
-            item = result[0]
-            if item:
-                result.insert(0, [first + item[0]])
-                result[1] = item[1:]
-        self.states[-1].extend(result)
+            result.runs.insert(0, (first, ''))
+        self.buffers[-1].extend(result.runs)
 
     def visit_start_of_file(self, node):
-        dprint()
         self.new_state()
 
         # FIXME: visit_start_of_file not close previous section.
@@ -151,41 +460,106 @@ class DocxTranslator(nodes.NodeVisitor):
         # (BTW Sphinx has heading levels per file? or entire document?)
         self.sectionlevel = 0
 
+        dc = self.docx_container
+        if self.table is None and (dc.prepared or
+                                   dc.fragments is not None or
+                                   self.translated is not None):
+            key = self.fragment_key(node)
+            fragment = dc.prepared.pop(key, None)
+            if fragment is None and dc.fragments is not None:
+                fragment = dc.fragments.get(node['docname'], key)
+                self.builder.stats.add_fragment(fragment is not None)
+            elif fragment is None:
+                self.builder.stats.add_fragment(False)
+            if fragment is not None:
+                self.add_fragment(fragment)
+                raise nodes.SkipNode
+            if self.translated is None and \
+                    isinstance(dc.docbody, docx.DocumentStream):
+                # streaming holds the blocks of one document at a time:
+                # the documents including this one are not recorded (nor
+                # cached), it is, and its blocks are released after it
+                for outer in self.recorders:
+                    outer.release()
+            recorder = FragmentRecorder(self.docbody, node['docname'], key)
+            self.recorders.append(recorder)
+            self.docbody = recorder
+
         self.docbody.append(docx.pagebreak(type='page', orient='portrait'))
 
     def depart_start_of_file(self, node):
-        dprint()
+        recorder = None
+        if self.recorders and self.recorders[-1].docname == node['docname']:
+            recorder = self.recorders.pop()
+            self.docbody = recorder.docbody
+            pending = list(self.buffers[-1].runs)
         self.end_state()
+        if recorder is None:
+            return
+        fragment = recorder.fragment(pending, self.sectionlevel)
+        if fragment is None:
+            return
+        if self.translated is not None:
+            self.translated[recorder.key] = fragment
+        if self.docx_container.fragments is not None:
+            try:
+                self.docx_container.fragments.put(
+                        recorder.docname, recorder.key, fragment)
+            except (IOError, OSError), err:
+                self.builder.warn('error writing fragment cache: %s' % err)
+
+    def fragment_key(self, node):
+        """Return the fragment cache key of a start_of_file node."""
+        dc = self.docx_container
+        images = []
+        for image in node.traverse(nodes.image):
+            record = dc.media.get(
+                    os.path.join(self.builder.env.srcdir, image['uri']))
+            if record is not None:
+                images.append((record.digest, record.path,
+                               record.stored.size, record.stored.dpi))
+        data = repr((dc.fragment_salt, self.list_style, images))
+        return content_hash(data + node.pformat().encode('utf-8'))
+
+    def add_fragment(self, fragment):
+        """Add a cached fragment in place of translating its node."""
+        dc = self.docx_container
+        for media in fragment.media:
+            path, medianame, digest = media
+            added = docx.add_media(dc.relationships, path, medianame,
+                                   digest)[2]
+            self.builder.stats.add_image(not added)
+            for recorder in self.recorders:
+                recorder.media.append(media)
+        for element in fragment.elements():
+            self.docbody.append(element)
+        # what depart_start_of_file would have done
+        self.buffers.pop()
+        self.buffers[-1].extend(fragment.pending)
+        self.sectionlevel = fragment.sectionlevel
 
     def visit_document(self, node):
-        dprint()
         self.new_state()
 
     def depart_document(self, node):
-        dprint()
         self.end_state()
 
     def visit_highlightlang(self, node):
-        dprint()
         raise nodes.SkipNode
 
     def visit_section(self, node):
-        dprint()
         self.sectionlevel += 1
 
     def depart_section(self, node):
-        dprint()
         self.ensure_state()
         if self.sectionlevel > 0:
             self.sectionlevel -= 1
 
     def visit_topic(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_topic(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
@@ -193,130 +567,102 @@ class DocxTranslator(nodes.NodeVisitor):
     depart_sidebar = depart_topic
 
     def visit_rubric(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #self.add_text('-[ ')
 
     def depart_rubric(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(' ]-')
         #self.end_state()
 
     def visit_compound(self, node):
-        dprint()
         pass
 
     def depart_compound(self, node):
-        dprint()
         pass
 
     def visit_glossary(self, node):
-        dprint()
         pass
 
     def depart_glossary(self, node):
-        dprint()
         pass
 
     def visit_title(self, node):
-        dprint()
         #if isinstance(node.parent, nodes.Admonition):
         #    self.add_text(node.astext()+': ')
         #    raise nodes.SkipNode
         self.new_state()
 
     def depart_title(self, node):
-        dprint()
-        text = ''.join(self.states.pop())
-        dprint(_func='* heading', text=repr(text), level=self.sectionlevel)
-        self.docbody.append(docx.heading(text, self.sectionlevel))
+        runs = self.buffers.pop().take()
+        self.docbody.append(docx.heading(runs, self.sectionlevel))
 
     def visit_subtitle(self, node):
-        dprint()
         pass
 
     def depart_subtitle(self, node):
-        dprint()
         pass
 
     def visit_attribution(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('-- ')
 
     def depart_attribution(self, node):
-        dprint()
         pass
 
     def visit_desc(self, node):
-        dprint()
         pass
 
     def depart_desc(self, node):
-        dprint()
         pass
 
     def visit_desc_signature(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #if node.parent['objtype'] in ('class', 'exception'):
         #    self.add_text('%s ' % node.parent['objtype'])
 
     def depart_desc_signature(self, node):
-        dprint()
         raise nodes.SkipNode
         ## XXX: wrap signatures in a way that makes sense
         #self.end_state()
 
     def visit_desc_name(self, node):
-        dprint()
         pass
 
     def depart_desc_name(self, node):
-        dprint()
         pass
 
     def visit_desc_addname(self, node):
-        dprint()
         pass
 
     def depart_desc_addname(self, node):
-        dprint()
         pass
 
     def visit_desc_type(self, node):
-        dprint()
         pass
 
     def depart_desc_type(self, node):
-        dprint()
         pass
 
     def visit_desc_returns(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(' -> ')
 
     def depart_desc_returns(self, node):
-        dprint()
         pass
 
     def visit_desc_parameterlist(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('(')
         #self.first_param = 1
 
     def depart_desc_parameterlist(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(')')
 
     def visit_desc_parameter(self, node):
-        dprint()
         raise nodes.SkipNode
         #if not self.first_param:
         #    self.add_text(', ')
@@ -326,61 +672,48 @@ class DocxTranslator(nodes.NodeVisitor):
         #raise nodes.SkipNode
 
     def visit_desc_optional(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('[')
 
     def depart_desc_optional(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(']')
 
     def visit_desc_annotation(self, node):
-        dprint()
         pass
 
     def depart_desc_annotation(self, node):
-        dprint()
         pass
 
     def visit_refcount(self, node):
-        dprint()
         pass
 
     def depart_refcount(self, node):
-        dprint()
         pass
 
     def visit_desc_content(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #self.add_text('\n')
 
     def depart_desc_content(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_figure(self, node):
         # FIXME: figure text become normal paragraph instead of caption.
-        dprint()
         self.new_state()
 
     def depart_figure(self, node):
-        dprint()
         self.end_state()
 
     def visit_caption(self, node):
-        dprint()
         pass
 
     def depart_caption(self, node):
-        dprint()
         pass
 
     def visit_productionlist(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #names = []
@@ -398,26 +731,21 @@ class DocxTranslator(nodes.NodeVisitor):
         #raise nodes.SkipNode
 
     def visit_seealso(self, node):
-        dprint()
         self.new_state()
 
     def depart_seealso(self, node):
-        dprint()
         self.end_state(first='')
 
     def visit_footnote(self, node):
-        dprint()
         raise nodes.SkipNode
         #self._footnote = node.children[0].astext().strip()
         #self.new_state()
 
     def depart_footnote(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state(first='[%s] ' % self._footnote)
 
     def visit_citation(self, node):
-        dprint()
         raise nodes.SkipNode
         #if len(node) and isinstance(node[0], nodes.label):
         #    self._citlabel = node[0].astext()
@@ -426,46 +754,37 @@ class DocxTranslator(nodes.NodeVisitor):
         #self.new_state()
 
     def depart_citation(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state(first='[%s] ' % self._citlabel)
 
     def visit_label(self, node):
-        dprint()
         raise nodes.SkipNode
 
     # XXX: option list could use some better styling
 
     def visit_option_list(self, node):
-        dprint()
         pass
 
     def depart_option_list(self, node):
-        dprint()
         pass
 
     def visit_option_list_item(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_option_list_item(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_option_group(self, node):
-        dprint()
         raise nodes.SkipNode
         #self._firstoption = True
 
     def depart_option_group(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('     ')
 
     def visit_option(self, node):
-        dprint()
         raise nodes.SkipNode
         #if self._firstoption:
         #    self._firstoption = False
@@ -473,98 +792,76 @@ class DocxTranslator(nodes.NodeVisitor):
         #    self.add_text(', ')
 
     def depart_option(self, node):
-        dprint()
         pass
 
     def visit_option_string(self, node):
-        dprint()
         pass
 
     def depart_option_string(self, node):
-        dprint()
         pass
 
     def visit_option_argument(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(node['delimiter'])
 
     def depart_option_argument(self, node):
-        dprint()
         pass
 
     def visit_description(self, node):
-        dprint()
         pass
 
     def depart_description(self, node):
-        dprint()
         pass
 
     def visit_tabular_col_spec(self, node):
-        dprint()
         raise nodes.SkipNode
 
     def visit_colspec(self, node):
-        dprint()
         self.table[0].append(node['colwidth'])
 
     def depart_colspec(self, node):
-        dprint()
+        pass
 
     def visit_tgroup(self, node):
-        dprint()
         pass
 
     def depart_tgroup(self, node):
-        dprint()
         pass
 
     def visit_thead(self, node):
-        dprint()
         pass
 
     def depart_thead(self, node):
-        dprint()
         pass
 
     def visit_tbody(self, node):
-        dprint()
         self.table.append('sep')
 
     def depart_tbody(self, node):
-        dprint()
         pass
 
     def visit_row(self, node):
-        dprint()
         self.table.append([])
 
     def depart_row(self, node):
-        dprint()
         pass
 
     def visit_entry(self, node):
-        dprint()
         if 'morerows' in node or 'morecols' in node:
             raise NotImplementedError('Column or row spanning cells are '
                                       'not implemented.')
         self.new_state()
 
     def depart_entry(self, node):
-        dprint()
-        text = '\n'.join('\n'.join(x) for x in self.states.pop())
-        self.table[-1].append(text)
+        self.table[-1].append(self.buffers.pop().take())
 
     def visit_table(self, node):
-        dprint()
         if self.table:
             raise NotImplementedError('Nested tables are not supported.')
         self.new_state()
         self.table = [[]]
 
     def depart_table(self, node):
-        dprint()
         lines = self.table[1:]
         fmted_rows = []
 
@@ -580,7 +877,6 @@ class DocxTranslator(nodes.NodeVisitor):
         self.end_state()
 
     def visit_acks(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #self.add_text(', '.join(n.astext() for n in node.children[0].children)
@@ -589,180 +885,164 @@ class DocxTranslator(nodes.NodeVisitor):
         raise nodes.SkipNode
 
     def visit_image(self, node):
-        dprint()
         uri = node.attributes['uri']
         file_path = os.path.join(self.builder.env.srcdir, uri)
         dc = self.docx_container
-        dc.relationships, picpara = docx.picture(
-                dc.relationships, file_path, '')
+        parts_before = len(docx.media_parts)
+        with self.builder.stats.phase('images'):
+            record = dc.media.get(file_path)
+            if record is None:
+                record = make_record(file_path, dc.images, dc.normalizer)
+            if dc.normalizer is None:
+                # the original pixels, each docx.EMU_PER_PIXEL
+                extent = docx.picture_extent(record.info.width,
+                                             record.info.height)
+            else:
+                # the normalized pixels at their resolution, not wider
+                # than the text of the page
+                stored = record.stored
+                extent = docx.picture_extent(stored.width, stored.height,
+                                             stored.dpi, dc.text_width)
+            dc.relationships, picpara = docx.picture(
+                    dc.relationships, record.path, '',
+                    medianame=file_path, digest=record.digest,
+                    extent=extent)
+        self.builder.stats.add_image(len(docx.media_parts) == parts_before)
+        for recorder in self.recorders:
+            recorder.media.append((record.path, file_path, record.digest))
         self.docbody.append(picpara)
 
     def depart_image(self, node):
-        dprint()
+        pass
 
     def visit_transition(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #self.add_text('=' * 70)
         #self.end_state()
 
     def visit_bullet_list(self, node):
-        dprint()
         self.list_style.append('ListBullet')
 
     def depart_bullet_list(self, node):
-        dprint()
         self.list_style.pop()
 
     def visit_enumerated_list(self, node):
-        dprint()
         self.list_style.append('ListNumber')
 
     def depart_enumerated_list(self, node):
-        dprint()
         self.list_style.pop()
 
     def visit_definition_list(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.list_style.append(-2)
 
     def depart_definition_list(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.list_style.pop()
 
     def visit_list_item(self, node):
-        dprint()
         self.new_state()
 
     def depart_list_item(self, node):
-        dprint()
-        text = ''.join(self.states.pop())
+        runs = self.buffers.pop().take()
         self.docbody.append(
-                docx.paragraph(text, self.list_style[-1], breakbefore=True))
+                docx.paragraph(runs, self.list_style[-1], breakbefore=True))
 
     def visit_definition_list_item(self, node):
-        dprint()
         raise nodes.SkipNode
         #self._li_has_classifier = len(node) >= 2 and \
         #                          isinstance(node[1], nodes.classifier)
 
     def depart_definition_list_item(self, node):
-        dprint()
         pass
 
     def visit_term(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_term(self, node):
-        dprint()
         raise nodes.SkipNode
         #if not self._li_has_classifier:
         #    self.end_state()
 
     def visit_classifier(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(' : ')
 
     def depart_classifier(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_definition(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_definition(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_field_list(self, node):
-        dprint()
         pass
 
     def depart_field_list(self, node):
-        dprint()
         pass
 
     def visit_field(self, node):
-        dprint()
         pass
 
     def depart_field(self, node):
-        dprint()
         pass
 
     def visit_field_name(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_field_name(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text(':')
         #self.end_state()
 
     def visit_field_body(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_field_body(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_centered(self, node):
-        dprint()
         pass
 
     def depart_centered(self, node):
-        dprint()
         pass
 
     def visit_hlist(self, node):
-        dprint()
         pass
 
     def depart_hlist(self, node):
-        dprint()
         pass
 
     def visit_hlistcol(self, node):
-        dprint()
         pass
 
     def depart_hlistcol(self, node):
-        dprint()
         pass
 
     def visit_admonition(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_admonition(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def _visit_admonition(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def _make_depart_admonition(name):
         def depart_admonition(self, node):
-            dprint()
             raise nodes.SkipNode
             #self.end_state(first=admonitionlabels[name] + ': ')
         return depart_admonition
@@ -787,7 +1067,6 @@ class DocxTranslator(nodes.NodeVisitor):
     depart_warning = _make_depart_admonition('warning')
 
     def visit_versionmodified(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #if node.children:
@@ -798,247 +1077,237 @@ class DocxTranslator(nodes.NodeVisitor):
         #            versionlabels[node['type']] % node['version'] + '.')
 
     def depart_versionmodified(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_literal_block(self, node):
         # FIXME: working but broken.
-        dprint()
         self.new_state()
 
     def depart_literal_block(self, node):
-        dprint()
         self.end_state()
 
     def visit_doctest_block(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_doctest_block(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_line_block(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
 
     def depart_line_block(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.end_state()
 
     def visit_line(self, node):
-        dprint()
         pass
 
     def depart_line(self, node):
-        dprint()
         pass
 
     def visit_block_quote(self, node):
         # FIXME: working but broken.
-        dprint()
         self.new_state()
 
     def depart_block_quote(self, node):
-        dprint()
         self.end_state()
 
     def visit_compact_paragraph(self, node):
-        dprint()
         pass
 
     def depart_compact_paragraph(self, node):
-        dprint()
         pass
 
     def visit_paragraph(self, node):
-        dprint()
         self.ensure_state()
         #if not isinstance(node.parent, nodes.Admonition) or \
         #       isinstance(node.parent, addnodes.seealso):
         #    self.new_state()
 
     def depart_paragraph(self, node):
-        dprint()
+        pass
         #if not isinstance(node.parent, nodes.Admonition) or \
         #       isinstance(node.parent, addnodes.seealso):
         #    self.end_state()
 
     def visit_target(self, node):
-        dprint()
         raise nodes.SkipNode
 
     def visit_index(self, node):
-        dprint()
         raise nodes.SkipNode
 
     def visit_substitution_definition(self, node):
-        dprint()
         raise nodes.SkipNode
 
     def visit_pending_xref(self, node):
-        dprint()
         pass
 
     def depart_pending_xref(self, node):
-        dprint()
         pass
 
     def visit_reference(self, node):
-        dprint()
         pass
 
     def depart_reference(self, node):
-        dprint()
         pass
 
     def visit_download_reference(self, node):
-        dprint()
         pass
 
     def depart_download_reference(self, node):
-        dprint()
         pass
 
     def visit_emphasis(self, node):
-        dprint()
-        #self.add_text('*')
+        self.push_format('i')
 
     def depart_emphasis(self, node):
-        dprint()
-        #self.add_text('*')
+        self.pop_format()
 
     def visit_literal_emphasis(self, node):
-        dprint()
-        #self.add_text('*')
+        self.push_format('ci')
 
     def depart_literal_emphasis(self, node):
-        dprint()
-        #self.add_text('*')
+        self.pop_format()
 
     def visit_strong(self, node):
-        dprint()
-        #self.add_text('**')
+        self.push_format('b')
 
     def depart_strong(self, node):
-        dprint()
-        #self.add_text('**')
+        self.pop_format()
 
     def visit_abbreviation(self, node):
-        dprint()
+        pass
         #self.add_text('')
 
     def depart_abbreviation(self, node):
-        dprint()
+        pass
         #if node.hasattr('explanation'):
         #    self.add_text(' (%s)' % node['explanation'])
 
     def visit_title_reference(self, node):
-        dprint()
+        pass
         #self.add_text('*')
 
     def depart_title_reference(self, node):
-        dprint()
+        pass
         #self.add_text('*')
 
     def visit_literal(self, node):
-        dprint()
-        #self.add_text('``')
+        self.push_format('c')
 
     def depart_literal(self, node):
-        dprint()
-        #self.add_text('``')
+        self.pop_format()
 
     def visit_subscript(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('_')
 
     def depart_subscript(self, node):
-        dprint()
         pass
 
     def visit_superscript(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('^')
 
     def depart_superscript(self, node):
-        dprint()
         pass
 
     def visit_footnote_reference(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('[%s]' % node.astext())
 
     def visit_citation_reference(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('[%s]' % node.astext())
 
     def visit_Text(self, node):
-        dprint()
         self.add_text(node.astext())
 
     def depart_Text(self, node):
-        dprint()
         pass
 
     def visit_generated(self, node):
-        dprint()
         pass
 
     def depart_generated(self, node):
-        dprint()
         pass
 
     def visit_inline(self, node):
-        dprint()
         pass
 
     def depart_inline(self, node):
-        dprint()
         pass
 
     def visit_problematic(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('>>')
 
     def depart_problematic(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.add_text('<<')
 
     def visit_system_message(self, node):
-        dprint()
         raise nodes.SkipNode
         #self.new_state()
         #self.add_text('<SYSTEM MESSAGE: %s>' % node.astext())
         #self.end_state()
 
     def visit_comment(self, node):
-        dprint()
         raise nodes.SkipNode
 
     def visit_meta(self, node):
-        dprint()
         raise nodes.SkipNode
         # only valid for HTML
 
     def visit_raw(self, node):
-        dprint()
         raise nodes.SkipNode
         #if 'text' in node.get('format', '').split():
         #    self.body.append(node.astext())
 
     def unknown_visit(self, node):
-        dprint()
         raise nodes.SkipNode
         #raise NotImplementedError('Unknown node: ' + node.__class__.__name__)
+
+
+class TracingDocxTranslator(DocxTranslator):
+    """DocxTranslator that reports every node to a NodeTracer.
+
+    Only used when ``docx_trace`` is enabled, so an untraced build does not
+    pay for the hook.
+    """
+
+    def __init__(self, document, builder, docx_container, tracer):
+        DocxTranslator.__init__(self, document, builder, docx_container)
+        self.tracer = tracer
+
+    def dispatch_visit(self, node):
+        return self.tracer.visit(
+                DocxTranslator.dispatch_visit, self, node)
+
+    def dispatch_departure(self, node):
+        return self.tracer.depart(
+                DocxTranslator.dispatch_departure, self, node)
+
+
+# the (writer, doctree) of prepare_fragments(), inherited by its workers
+_writer = None
+
+
+def _translate_fragment(job):
+    index, key = job
+    writer, doctree = _writer
+    builder = writer.builder
+    builder.start_worker()
+    node = writer.parallel_nodes(doctree)[index]
+    visitor = DocxTranslator(doctree, builder, writer.docx_container)
+    # blocks are only recorded; the body belongs to the parent process
+    visitor.docbody = None
+    visitor.translated = {}
+    with builder.stats.phase('translate'):
+        visitor.walk(node)
+    return (visitor.translated.get(key), builder.stats,
+            builder.worker_warnings)